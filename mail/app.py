@@ -1,23 +1,21 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort
 import os
-from functools import wraps
-from datetime import datetime
-import uuid
 from werkzeug.utils import secure_filename
 import mimetypes
-import base64
-import io
 import re
 import logging
 from logging.handlers import RotatingFileHandler
 import os.path
 
-from auth import authenticate_user, create_user, delete_user, get_user_stats, get_admin_stats
-from mailer import EmailSender, parse_recipients, get_campaign_id
+from auth import authenticate_user, create_user, delete_user, get_user_stats, get_admin_stats, login_required, admin_required
+from mailer import parse_recipients, get_campaign_id
+from recipient_source import spool_upload
+from campaign_jobs import campaign_jobs
 from dashboard import dashboard
-from pixel_tracker_py2 import track_pixel, Base, PixelTrack
-import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
+from db import tracking_db, init_databases
+from tracking_store import open_row, open_buffer, message_open_row, get_device_info
+from tracking_token import decode_token
+from pixel import pixel_response
 
 # Constants and path configurations
 import os.path
@@ -26,7 +24,6 @@ import os.path
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
-DB_PATH = os.path.join(BASE_DIR, 'tracking.db')
 
 # Create required directories
 for directory in [UPLOAD_FOLDER, LOGS_DIR]:
@@ -80,40 +77,21 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.register_blueprint(dashboard, url_prefix='/dashboard')
 
-# Create a 1x1 transparent GIF pixel
-PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
 
 # Setup logging
 setup_logging()
 
-# Update database engine creation
-def get_db_engine():
-    db_url = f'sqlite:///{DB_PATH}'
-    return sa.create_engine(db_url,
-        pool_size=20,
-        max_overflow=10,
-        pool_recycle=300,
-        pool_pre_ping=True
-    )
+# Create database engines and run schema setup once at startup
+init_databases()
 
-# Add Redis-based caching initialization and error handling
-from flask_caching import Cache
+# Jobs interrupted by the last shutdown wait for their sender password again
+campaign_jobs.recover()
 
-# Configure caching
-cache = Cache(config={
-    'CACHE_TYPE': 'RedisCache',
-    'CACHE_REDIS_URL': 'redis://localhost:6379/0',
-    'CACHE_DEFAULT_TIMEOUT': 300
-})
+def get_db_engine():
+    return tracking_db.engine
 
-try:
-    cache.init_app(app)
-    app.logger.info('Cache initialization successful')
-except ConnectionError as e:
-    app.logger.error(f'Cache connection failed: {str(e)}')
-    # Fallback to simple in-memory cache
-    cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
-    cache.init_app(app)
+# Aggregate stats (admin, user, dashboard) are cached by stats_cache, in Redis
+# at CACHE_REDIS_URL when it answers and in process memory otherwise
 
 # Error handlers
 @app.errorhandler(404)
@@ -133,112 +111,50 @@ def internal_error(error):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Authentication decorator
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            flash('Please log in first')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session or not session.get('is_admin'):
-            flash('Admin access required')
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-from threading import Lock
-
-track_lock = Lock()
-
 @app.route('/track/<campaign_id>/<recipient_id>')
 def track(campaign_id, recipient_id):
-    with track_lock:
-        """Track email opens"""
-        try:
-            # Get tracking parameters
-            sender = request.args.get('sender')
-            
-            if not campaign_id or not recipient_id or not sender:
-                app.logger.error(f'Missing tracking parameters - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-                return send_file(
-                    io.BytesIO(PIXEL_GIF),
-                    mimetype='image/gif',
-                    cache_control='no-cache, no-store, must-revalidate'
-                )
-            
-            app.logger.info(f'Processing tracking request - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-            
-            # Create database engine using the new function
-            engine = get_db_engine()
-            Base.metadata.create_all(engine)
-            Session = sessionmaker(bind=engine)
-            session = Session()
-            
-            try:
-                # Find existing record
-                existing_track = session.query(PixelTrack).filter(
-                    PixelTrack.campaign_id == campaign_id,
-                    PixelTrack.recipient == recipient_id,
-                    PixelTrack.sender_email == sender
-                ).first()
-                
-                if existing_track:
-                    app.logger.info(f'Found existing tracking record - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-                    # Update existing record only if not already opened
-                    if not existing_track.is_opened:
-                        existing_track.is_opened = True
-                        existing_track.opened_timestamp = datetime.utcnow()
-                        existing_track.user_agent = request.headers.get('User-Agent', 'unknown')
-                        existing_track.ip_address = request.remote_addr
-                        session.commit()
-                        app.logger.info(f'Updated tracking record - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-                    else:
-                        app.logger.info(f'Email already tracked as opened - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-                else:
-                    app.logger.warning(f'No tracking record found - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-                    # Create new record if none exists
-                    track = PixelTrack(
-                        id=str(uuid.uuid4()),
-                        campaign_id=campaign_id,
-                        recipient=recipient_id,
-                        sender_email=sender,
-                        is_opened=True,
-                        opened_timestamp=datetime.utcnow(),
-                        user_agent=request.headers.get('User-Agent', 'unknown'),
-                        ip_address=request.remote_addr
-                    )
-                    session.add(track)
-                    session.commit()
-                    app.logger.info(f'Created new tracking record - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
-            
-            except Exception as e:
-                app.logger.error(f'Database error while tracking: {str(e)}')
-                session.rollback()
-            finally:
-                session.close()
-                
-            # Return tracking pixel with no-cache headers
-            response = send_file(
-                io.BytesIO(PIXEL_GIF),
-                mimetype='image/gif',
-                cache_timeout=0
-            )
-            response.headers['Cache-Control'] = 'no-store, max-age=0'
-            return response
+    """Track email opens"""
+    try:
+        # Get tracking parameters
+        sender = request.args.get('sender')
         
-        except Exception as e:
-            app.logger.error(f'Tracking error: {str(e)}')
-            return send_file(
-                io.BytesIO(PIXEL_GIF),
-                mimetype='image/gif',
-                cache_control='no-cache, no-store, must-revalidate'
-            )
+        if not campaign_id or not recipient_id or not sender:
+            app.logger.error(f'Missing tracking parameters - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
+            return pixel_response(app.response_class)
+        
+        app.logger.info(f'Processing tracking request - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
+        
+        # Queue the open; the buffer upserts it in the background
+        if not open_buffer.put(open_row(
+            campaign_id,
+            sender,
+            recipient_id,
+            user_agent=request.headers.get('User-Agent', 'unknown'),
+            ip_address=request.remote_addr
+        )):
+            app.logger.warning(f'Open event buffer full, dropped - Campaign: {campaign_id}, Recipient: {recipient_id}, Sender: {sender}')
+            
+        # Return tracking pixel with no-cache headers
+        return pixel_response(app.response_class)
+    
+    except Exception as e:
+        app.logger.error(f'Tracking error: {str(e)}')
+        return pixel_response(app.response_class)
+
+@app.route('/t/<token>')
+def track_token(token):
+    """Track email opens from signed tracking tokens"""
+    # Forged or garbage tokens are rejected before any database work
+    message_id = decode_token(token)
+    if message_id is not None:
+        user_agent = request.headers.get('User-Agent', 'unknown')
+        open_buffer.put(message_open_row(
+            message_id,
+            user_agent=user_agent,
+            ip_address=request.remote_addr,
+            device_info=get_device_info(user_agent)
+        ))
+    return pixel_response(app.response_class)
 
 @app.route('/')
 def index():
@@ -289,13 +205,18 @@ def send_email():
             body = request.form.get('body')
             recipients_method = request.form.get('recipients_method', 'manual')
             
-            # Get recipients based on method
+            if not sender_email or not sender_password:
+                flash('Sender email and password are required', 'error')
+                return render_template('send_email.html')
+            
+            # Get recipients based on method; both are streamed while sending
+            recipients_spool = None
             if recipients_method == 'manual':
                 recipients_text = request.form.get('recipients', '').strip()
                 if not recipients_text:
                     flash('Please enter at least one recipient email address', 'error')
                     return render_template('send_email.html')
-                recipients = [email.strip() for email in recipients_text.split(',') if email.strip()]
+                recipients = parse_recipients(recipients_text)
             else:  # file method
                 if 'recipients_file' not in request.files:
                     flash('Please upload a recipients file', 'error')
@@ -306,14 +227,13 @@ def send_email():
                     flash('No file selected', 'error')
                     return render_template('send_email.html')
                     
-                # Read recipients from file
-                recipients = []
-                for line in file.read().decode('utf-8').splitlines():
-                    email = line.strip()
-                    if email:
-                        recipients.append(email)
+                # Spool the upload to disk instead of reading it into memory
+                recipients_spool = spool_upload(file)
+                recipients = parse_recipients(None, recipients_spool)
                         
-            if not recipients:
+            if recipients.is_empty():
+                if recipients_spool:
+                    os.remove(recipients_spool)
                 flash('No valid recipient email addresses found', 'error')
                 return render_template('send_email.html')
                 
@@ -328,55 +248,30 @@ def send_email():
                         file.save(filepath)
                         attachments.append(filepath)
             
-            # Initialize EmailSender
-            sender = EmailSender(
-                username=sender_email,
-                password=sender_password,
-                tracking_server=request.url_root.rstrip('/')
-            )
-            
-            # Generate campaign ID
-            campaign_id = get_campaign_id()
-            
-            # Send emails
-            success_count = 0
-            error_messages = []
-            
-            for recipient in recipients:
-                try:
-                    success = sender.send_single_email(
-                        recipient=recipient,
-                        subject=subject,
-                        body=body,
-                        campaign_id=campaign_id,
-                        attachments=attachments
-                    )
-                    if success:
-                        success_count += 1
-                    else:
-                        error_messages.append(f"Failed to send email to {recipient}")
-                except Exception as e:
-                    error_messages.append(f"Error sending to {recipient}: {str(e)}")
-            
-            # Clean up attachment files
-            for attachment in attachments:
-                try:
-                    os.remove(attachment)
-                except:
-                    pass
+            # Persist the campaign and hand it to the background senders
+            try:
+                job_id = campaign_jobs.submit(
+                    sender_email=sender_email,
+                    sender_password=sender_password,
+                    subject=subject,
+                    body=body,
+                    campaign_id=get_campaign_id(),
+                    recipients=recipients,
+                    attachments=attachments,
+                    tracking_server=request.url_root.rstrip('/'),
+                    owner=session.get('username')
+                )
+            finally:
+                if recipients_spool:
+                    os.remove(recipients_spool)
             
-            # Flash appropriate messages
-            if success_count == len(recipients):
-                flash(f'Successfully sent emails to all {len(recipients)} recipients!', 'success')
-            elif success_count > 0:
-                flash(f'Partially successful: Sent {success_count} out of {len(recipients)} emails', 'warning')
-                for error in error_messages:
-                    flash(error, 'error')
-            else:
-                flash('Failed to send any emails', 'error')
-                for error in error_messages:
-                    flash(error, 'error')
+            status_url = url_for('campaign_status', job_id=job_id)
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'job_id': job_id, 'status_url': status_url}), 202
             
+            flash(f'Campaign queued (job {job_id}). Progress: {status_url}', 'success')
+            if recipients.duplicates:
+                flash(f'Skipped {recipients.duplicates} duplicate recipient addresses', 'info')
             return redirect(url_for('dashboard.index'))
             
         except Exception as e:
@@ -386,6 +281,28 @@ def send_email():
     
     return render_template('send_email.html')
 
+@app.route('/campaigns/<job_id>/status')
+@login_required
+def campaign_status(job_id):
+    status = campaign_jobs.status(job_id)
+    if status is None or (status['owner'] != session.get('username') and not session.get('is_admin')):
+        return jsonify({'error': 'Campaign job not found'}), 404
+    return jsonify(status)
+
+@app.route('/campaigns/<job_id>/resume', methods=['POST'])
+@login_required
+def resume_campaign(job_id):
+    status = campaign_jobs.status(job_id)
+    if status is None or (status['owner'] != session.get('username') and not session.get('is_admin')):
+        return jsonify({'error': 'Campaign job not found'}), 404
+    data = request.get_json(silent=True) or request.form
+    sender_password = data.get('sender_password')
+    if not sender_password:
+        return jsonify({'error': 'sender_password is required'}), 400
+    if not campaign_jobs.resume(job_id, sender_password):
+        return jsonify({'error': 'Campaign job is not paused', 'status': status['status']}), 409
+    return jsonify({'job_id': job_id, 'status_url': url_for('campaign_status', job_id=job_id)}), 202
+
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
@@ -0,0 +1,405 @@
+import asyncio
+import logging
+import functools
+
+import mailer
+from mailer import EmailSender
+from tracking_store import sent_writer
+from attachment_cache import attachment_cache
+from tracking_token import message_ids
+from retry_policy import TRANSIENT, PERMANENT
+from host_governor import get_governor
+from smtp_endpoints import SSL, STARTTLS
+from compiled_message import UNDISCLOSED_RECIPIENTS, check_size, envelope_options
+
+# aiosmtplib is optional; the threaded EmailSender works without it
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+
+class AsyncSession(object):
+    def __init__(self):
+        """
+        Slot in a host's session pool; smtp is None until the first transaction connects it
+        """
+        self.smtp = None
+        self.messages_sent = 0
+
+
+class AsyncEmailSender(EmailSender):
+    def __init__(self, username, password, concurrency=200, per_host_limit=100, **kwargs):
+        """
+        Email sender that drives many SMTP transactions on one asyncio event loop
+
+        Accepts the same arguments as EmailSender, plus:
+
+        :param concurrency: Number of sender coroutines
+        :param per_host_limit: Maximum SMTP sessions, and so in-flight transactions, per
+                               SMTP host; the host's governor may allow fewer
+        """
+        if aiosmtplib is None:
+            raise ImportError("aiosmtplib is required for the asyncio sending engine")
+        super(AsyncEmailSender, self).__init__(username, password, **kwargs)
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        self.session_pools = {}
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.reconnects = 0
+
+    def _session_pool(self, host):
+        """
+        Get the queue of SMTP sessions shared by every coroutine sending to a host
+
+        Holds min(per_host_limit, governor.max_concurrent) sessions, opened
+        on first use; a coroutine takes one for each transaction, so no more
+        sessions are ever logged in than the host allows.
+        """
+        if host not in self.session_pools:
+            limit = min(self.per_host_limit, get_governor(host).max_concurrent)
+            pool = asyncio.Queue()
+            for _ in range(limit):
+                pool.put_nowait(AsyncSession())
+            self.session_pools[host] = pool
+        return self.session_pools[host]
+
+    async def _close_sessions(self):
+        """
+        Quit every pooled session once the workers are done
+        """
+        for pool in self.session_pools.values():
+            while not pool.empty():
+                session = pool.get_nowait()
+                if session.smtp is not None:
+                    await self._close(session.smtp)
+        self.session_pools = {}
+
+    def build_message(self, recipient, subject, body, campaign_id, attachments=None, message_id=None):
+        """
+        Build the message for a single recipient as bytes for aiosmtplib
+
+        aiosmtplib does its own dot-stuffing, so this joins the compiled
+        chunks without it instead of returning them for send_chunks.
+
+        :return: Message bytes
+        """
+        compiled = self.compile_message(subject, body, campaign_id, attachments)
+        pixel_url = self.tracking_url(recipient, campaign_id, message_id) if self.track_opens else ''
+        return compiled.as_bytes(recipient, pixel_url)
+
+    def build_batch_message(self, subject, body, campaign_id, attachments=None):
+        """
+        Build the untracked batch message as bytes for aiosmtplib
+        """
+        compiled = self.compile_message(subject, body, campaign_id, attachments)
+        return compiled.as_bytes(UNDISCLOSED_RECIPIENTS, '')
+
+    async def _connect(self, host, port):
+        """
+        Open an authenticated SMTP session on the account's resolved endpoint
+
+        The endpoint is probed once per domain (see smtp_endpoints), off the
+        event loop; a cached endpoint that stops answering is probed again.
+
+        :return: Connected aiosmtplib.SMTP object
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            endpoint = await loop.run_in_executor(None, self._smtp_endpoint)
+            try:
+                smtp = await self._open(endpoint)
+            except (OSError, aiosmtplib.SMTPConnectError, aiosmtplib.SMTPServerDisconnected) as e:
+                logging.warning(f"SMTP connection to {endpoint['host']}:{endpoint['port']} failed, "
+                                f"rediscovering endpoint: {str(e)}")
+                endpoint = await loop.run_in_executor(None, self._smtp_endpoint, endpoint)
+                smtp = await self._open(endpoint)
+            try:
+                await smtp.login(self.username, self.password)
+            except Exception:
+                await self._close(smtp, graceful=False)
+                raise
+        except aiosmtplib.SMTPAuthenticationError:
+            raise
+        except Exception as e:
+            raise aiosmtplib.SMTPAuthenticationError(
+                -1, f"Failed to connect to SMTP server {host}. Error: {str(e)}")
+        self.connections_opened += 1
+        return smtp
+
+    async def _open(self, endpoint):
+        smtp = aiosmtplib.SMTP(hostname=endpoint['host'], port=endpoint['port'], timeout=30,
+                               use_tls=endpoint['mode'] == SSL, start_tls=endpoint['mode'] == STARTTLS)
+        await smtp.connect()
+        return smtp
+
+    async def _close(self, smtp, graceful=True):
+        """
+        Close an SMTP session, ignoring errors
+        """
+        try:
+            if graceful:
+                await smtp.quit()
+            else:
+                smtp.close()
+        except Exception:
+            pass
+
+    async def _reconnect(self, session, host, port):
+        smtp, session.smtp = session.smtp, None
+        await self._close(smtp, graceful=False)
+        self.reconnects += 1
+        session.smtp = await self._connect(host, port)
+        session.messages_sent = 0
+
+    async def _send_async(self, session, host, port, recipients, message):
+        """
+        Send one message on a pooled session, connecting it if needed and reconnecting
+        once if the session dropped
+
+        aiosmtplib pipelines the envelope itself when the server supports it.
+
+        :param session: AsyncSession taken from the host's pool
+        :param recipients: List of envelope recipients
+        :return: Dictionary of refused address -> (code, message)
+        """
+        if session.smtp is None:
+            session.smtp = await self._connect(host, port)
+            session.messages_sent = 0
+        else:
+            try:
+                await session.smtp.rset()
+                self.connections_reused += 1
+            except aiosmtplib.SMTPException:
+                await self._reconnect(session, host, port)
+        # Connecting resolved the endpoint, so its cached capabilities are known here
+        capabilities = self._capabilities()
+        check_size(len(message), capabilities.get('size'))
+        mail_options, refused = envelope_options(self.username, recipients, bool(capabilities.get('smtputf8')) and
+                                                 session.smtp.supports_extension('smtputf8'))
+        if len(refused) == len(recipients):
+            raise aiosmtplib.SMTPRecipientsRefused([aiosmtplib.SMTPRecipientRefused(code, error, address)
+                                                    for address, (code, error) in refused.items()])
+        recipients = [each for each in recipients if each not in refused]
+
+        try:
+            errors, _ = await session.smtp.sendmail(self.username, recipients, message, mail_options=mail_options)
+        except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as e:
+            logging.warning(f"SMTP session lost, reconnecting: {str(e)}")
+            await self._reconnect(session, host, port)
+            errors, _ = await session.smtp.sendmail(self.username, recipients, message, mail_options=mail_options)
+        except aiosmtplib.SMTPResponseException as e:
+            if e.code != 421:
+                raise
+            logging.warning("SMTP server closing session (421), reconnecting")
+            get_governor(host).on_throttle()
+            await self._reconnect(session, host, port)
+            errors, _ = await session.smtp.sendmail(self.username, recipients, message, mail_options=mail_options)
+        refused.update((address, (reply.code, reply.message)) for address, reply in errors.items())
+        return refused
+
+    async def _transaction(self, host, port, recipients, message):
+        """
+        Send one message on a session from the host's pool, within the host's rate limit
+
+        Waits for a free session when all of the host's sessions are busy.
+
+        :return: Dictionary of refused address -> (code, message)
+        """
+        pool = self._session_pool(host)
+        session = await pool.get()
+        try:
+            wait = get_governor(host).reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            refused = await self._send_async(session, host, port, recipients, message)
+            session.messages_sent += 1
+            if session.messages_sent >= self.smtp_pool.max_messages_per_connection:
+                smtp, session.smtp = session.smtp, None
+                await self._close(smtp)
+            return refused
+        finally:
+            pool.put_nowait(session)
+
+    async def _blocking(self, function, *args):
+        """
+        Run work that may block (SQLite writes in message_ids and the result
+        callbacks, attachment encoding) on the default executor
+
+        :return: The function's return value
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+    def _build_one(self, recipient, subject, body, campaign_id, attachments):
+        message_id = message_ids.next()
+        return message_id, self.build_message(recipient, subject, body, campaign_id, attachments, message_id)
+
+    def _fail_all(self, error_msg, error, batch, attempt):
+        return [(email_details, self._handle_failure(error_msg, error, email_details, attempt))
+                for email_details in batch]
+
+    def _notify(self, outcomes, attempt):
+        for email_details, (success, error) in outcomes:
+            self.on_result(email_details, success, error, attempt)
+
+    async def _report(self, outcomes, attempt):
+        """
+        Record final results and run on_result off the loop; None results are scheduled retries
+
+        :param outcomes: List of (email_details, (success, error_message))
+        """
+        outcomes = [(email_details, result) for email_details, result in outcomes if result[0] is not None]
+        self.results.extend(result for _, result in outcomes)
+        if outcomes and self.on_result is not None:
+            await self._blocking(self._notify, outcomes, attempt)
+
+    async def _send_one(self, host, port, email_details, attempt):
+        """
+        Send one email and record its result
+        """
+        recipient, subject, body, campaign_id, attachments = email_details
+        try:
+            message_id, message = await self._blocking(
+                self._build_one, recipient, subject, body, campaign_id, attachments)
+            await self._transaction(host, port, [recipient], message)
+            get_governor(host).on_success()
+            logging.info(f"Email sent successfully to {recipient}")
+        except aiosmtplib.SMTPAuthenticationError as e:
+            result = await self._blocking(self._handle_failure, f"SMTP Authentication failed: {str(e)}",
+                                          e, email_details, attempt)
+        except aiosmtplib.SMTPException as e:
+            result = await self._blocking(self._handle_failure, f"SMTP Error: {str(e)}", e, email_details, attempt)
+        except Exception as e:
+            result = await self._blocking(self._handle_failure, f"Error sending email: {str(e)}",
+                                          e, email_details, attempt)
+        else:
+            result = self.record_sent(recipient, campaign_id, message_id)
+        await self._report([(email_details, result)], attempt)
+
+    async def _send_batch(self, host, port, batch, attempt):
+        """
+        Send one untracked message to a batch of recipients and record each recipient's result
+        """
+        recipients = [email_details[0] for email_details in batch]
+        _, subject, body, campaign_id, attachments = batch[0]
+        outcomes = None
+        try:
+            message = await self._blocking(self.build_batch_message, subject, body, campaign_id, attachments)
+            refused = await self._transaction(host, port, recipients, message)
+            get_governor(host).on_success()
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            refused = dict((each.recipient, (each.code, each.message)) for each in e.recipients)
+        except aiosmtplib.SMTPException as e:
+            outcomes = await self._blocking(self._fail_all, f"SMTP Error: {str(e)}", e, batch, attempt)
+        except Exception as e:
+            outcomes = await self._blocking(self._fail_all, f"Error sending email: {str(e)}", e, batch, attempt)
+        if outcomes is None:
+            outcomes = await self._blocking(self.batch_results, batch, refused, attempt)
+        await self._report(outcomes, attempt)
+
+    async def _worker(self, email_queue, host, port):
+        """
+        Sender coroutine; takes a pooled session for each transaction
+
+        Takes due retries before new messages, like EmailSender.worker.
+        """
+        while True:
+            retry = self.retries.pop_due()
+            if retry is not None:
+                try:
+                    await self._send_one(host, port, *retry)
+                finally:
+                    self.retries.done()
+                continue
+            try:
+                email_details = await asyncio.wait_for(email_queue.get(), self.retries.wait_time())
+            except asyncio.TimeoutError:
+                continue
+            try:
+                if email_details is None:
+                    break
+                if mailer.STOP_THREADS:
+                    batch = email_details if isinstance(email_details, list) else [email_details]
+                    await self._report([(each, self.record_interrupted()) for each in batch], 1)
+                    continue
+                if isinstance(email_details, list):
+                    await self._send_batch(host, port, email_details, 1)
+                else:
+                    await self._send_one(host, port, email_details, 1)
+            finally:
+                email_queue.task_done()
+
+    async def send_emails_async(self, email_list):
+        """
+        Send multiple emails concurrently on the running event loop
+
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments);
+                           read on the default executor, so it may block (e.g. send_queue.iter_claims)
+        :return: Result dictionary in the same shape as EmailSender.send_emails_threaded
+        """
+        mailer.STOP_THREADS = False
+
+        # Reset counters and results
+        self.sent_count = 0
+        self.failed_count = 0
+        self.results = []
+        self.error_messages = []
+        self.error_classes = {TRANSIENT: 0, PERMANENT: 0}
+        self.error_reasons = {}
+        self.retries.clear()
+        self.compiled_messages.clear()
+        self.session_pools = {}
+
+        host, port = self._get_smtp_settings()
+        email_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._worker(email_queue, host, port))
+                   for _ in range(self.concurrency)]
+
+        total_count = 0
+        items = iter(email_list if self.track_opens else self.batch_emails(email_list))
+        while not mailer.STOP_THREADS:
+            item = await self._blocking(next, items, None)
+            if item is None:
+                break
+            await email_queue.put(item)
+            total_count += len(item) if isinstance(item, list) else 1
+        # Transient failures are retried by the same coroutines; let them drain first
+        await email_queue.join()
+        while not mailer.STOP_THREADS and not self.retries.idle():
+            await asyncio.sleep(0.2)
+        for _ in workers:
+            await email_queue.put(None)
+        await asyncio.gather(*workers)
+        await self._close_sessions()
+        # Make sure every sent row is in tracking.db before reporting
+        await self._blocking(sent_writer.flush)
+
+        logging.info('Email sending completed. Sent: {}, Failed: {}, SMTP connections opened: {}'.format(
+            self.sent_count, self.failed_count, self.connections_opened))
+
+        return {
+            'success_count': self.sent_count,
+            'failure_count': self.failed_count,
+            'total_count': total_count,
+            'results': self.results,
+            'error_messages': list(set(self.error_messages)),  # Unique error messages
+            'smtp_pool': {
+                'hits': self.connections_reused,
+                'misses': self.connections_opened,
+                'reconnects': self.reconnects
+            },
+            'errors_by_class': dict(self.error_classes, reasons=dict(self.error_reasons)),
+            'retries': self.retries.stats(),
+            'governor': get_governor(host).stats(),
+            'tracking_writer': sent_writer.stats(),
+            'attachment_cache': attachment_cache.stats()
+        }
+
+    def send_emails_threaded(self, email_list):
+        """
+        Drop-in replacement for EmailSender.send_emails_threaded using the asyncio engine
+
+        :param email_list: List of tuples (recipient, subject, body, campaign_id, attachments)
+        """
+        return asyncio.run(self.send_emails_async(email_list))
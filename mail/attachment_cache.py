@@ -0,0 +1,147 @@
+import os
+import mmap
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from email.mime.application import MIMEApplication
+from email import policy as email_policy
+
+# MIME parts are cached in the wire form CompiledMessage sends
+PART_POLICY = email_policy.compat32.clone(linesep='\r\n')
+
+
+class AttachmentPart(object):
+    def __init__(self, key, data, spilled=False):
+        """
+        Encoded attachment MIME part, ready to be written after a multipart boundary
+
+        :param key: Cache key (path, mtime_ns, size)
+        :param data: Part bytes, or a memoryview over an mmap'd temp file
+        :param spilled: True if data lives in a temp file instead of the heap
+        """
+        self.key = key
+        self.data = data
+        self.size = len(data)
+        self.spilled = spilled
+
+
+def encode_attachment(filepath):
+    """
+    Encode a file as a base64 application MIME part with CRLF line endings
+
+    :param filepath: Path of the file to attach
+    :return: Part bytes; header and base64 lines never start with '.', so no dot-stuffing is needed
+    """
+    with open(filepath, 'rb') as file:
+        part = MIMEApplication(file.read(), Name=os.path.basename(filepath))
+    part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(filepath))
+    return part.as_bytes(policy=PART_POLICY)
+
+
+class AttachmentCache(object):
+    def __init__(self, max_bytes=256 * 1024 * 1024, spill_threshold=4 * 1024 * 1024, spill_dir=None):
+        """
+        LRU cache of encoded attachment parts keyed by (path, mtime, size)
+
+        Editing a file changes its key, so stale parts are never served.
+
+        :param max_bytes: Total encoded bytes kept before least recently used parts are evicted
+        :param spill_threshold: Parts larger than this are kept in an mmap'd temp file
+        :param spill_dir: Directory for spilled parts, defaults to the system temp dir
+        """
+        self.max_bytes = max_bytes
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.lock = threading.Lock()
+        self.parts = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _spill(self, data):
+        """
+        Move part bytes into an anonymous temp file and map it read-only
+
+        :return: memoryview over the mapping
+        """
+        with tempfile.TemporaryFile(dir=self.spill_dir, prefix='attachment-') as file:
+            file.write(data)
+            file.flush()
+            # The mapping stays valid after the file is closed
+            mapped = mmap.mmap(file.fileno(), len(data), access=mmap.ACCESS_READ)
+        return memoryview(mapped)
+
+    def _evict(self, keep):
+        """
+        Drop least recently used parts until the cache fits max_bytes; caller holds lock
+        """
+        while self.total_bytes > self.max_bytes and len(self.parts) > 1:
+            key, part = next(iter(self.parts.items()))
+            if key == keep:
+                break
+            del self.parts[key]
+            self.total_bytes -= part.size
+            self.evictions += 1
+            # Senders still holding part.data keep the mapping alive until they finish
+
+    def get(self, filepath):
+        """
+        Get the encoded MIME part for a file, encoding it on first use
+
+        :param filepath: Path of the file to attach
+        :return: AttachmentPart, or None if the file does not exist
+        """
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            logging.warning(f'Attachment file not found - {filepath}')
+            return None
+        key = (os.path.abspath(filepath), st.st_mtime_ns, st.st_size)
+
+        with self.lock:
+            part = self.parts.get(key)
+            if part is not None:
+                self.parts.move_to_end(key)
+                self.hits += 1
+                return part
+
+            # Encoding under the lock means concurrent campaigns encode a file only once
+            self.misses += 1
+            data = encode_attachment(filepath)
+            spilled = len(data) > self.spill_threshold
+            if spilled:
+                data = self._spill(data)
+            part = AttachmentPart(key, data, spilled)
+            logging.info(f"Encoded attachment {filepath} ({part.size} bytes{', spilled to disk' if spilled else ''})")
+
+            self.parts[key] = part
+            self.total_bytes += part.size
+            self._evict(key)
+            return part
+
+    def clear(self):
+        with self.lock:
+            self.parts.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+        Cache counters
+
+        :return: Dictionary of counters
+        """
+        with self.lock:
+            return {
+                'entries': len(self.parts),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+# Shared by every sender in the process
+attachment_cache = AttachmentCache(
+    max_bytes=int(os.environ.get('ATTACHMENT_CACHE_MB', 256)) * 1024 * 1024)
@@ -1,11 +1,12 @@
 import sqlite3
 import hashlib
 from functools import wraps
-import os
 from typing import Optional, Tuple
+import flask
 import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
-from pixel_tracker_py2 import Base, PixelTrack
+from models import Base, PixelTrack
+from db import mailer_db, tracking_db
+from stats_cache import stats_cache, TRACKING, USERS, sender_scope
 
 # Define User model if not already defined
 class User(Base):
@@ -17,9 +18,8 @@ class User(Base):
     is_admin = sa.Column(sa.Boolean, default=False)
 
 def get_db_connection():
-    """Get database connection"""
-    db_path = os.path.join(os.path.dirname(__file__), 'mailer.db')
-    return sqlite3.connect(db_path)
+    """Get a pooled database connection; close() returns it to the pool"""
+    return mailer_db.raw_connection()
 
 def hash_password(password: str) -> str:
     """Hash a password using SHA-256"""
@@ -65,6 +65,7 @@ def create_user(admin_username: str, admin_password: str, new_username: str, new
             (new_username, hash_password(new_password), False)
         )
         conn.commit()
+        stats_cache.bump([USERS])
         return True
     except sqlite3.IntegrityError:
         # Username already exists
@@ -96,27 +97,15 @@ def delete_user(admin_username: str, admin_password: str, username_to_delete: st
         cursor.execute('DELETE FROM users WHERE username = ? AND is_admin = 0', 
                       (username_to_delete,))
         conn.commit()
+        stats_cache.bump([USERS])
         return cursor.rowcount > 0
     finally:
         conn.close()
 
-def get_user_stats(user_id):
-    """Get statistics for a specific user"""
-    engine = sa.create_engine('sqlite:///tracking.db')
-    Base.metadata.create_all(engine)  # Ensure tables exist
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def _user_stats(user_email):
+    """Aggregate a sender's tracking rows"""
+    session = tracking_db.Session()
     try:
-        # Get user's email from user_id using SQLite connection
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        result = cursor.fetchone()
-        if not result:
-            raise ValueError(f"User not found with id {user_id}")
-        user_email = result[0]
-        conn.close()
-        
         # Get campaign stats for this user using updated syntax
         stats = session.query(
             sa.func.count(sa.distinct(PixelTrack.campaign_id)).label('total_campaigns'),
@@ -127,11 +116,11 @@ def get_user_stats(user_id):
             )).label('total_sent'),
             sa.func.count(PixelTrack.id).label('total_opens')
         ).filter(PixelTrack.sender_email == user_email).first()
-        
+
         # Handle None values
         total_sent = stats.total_sent or 0
         total_opens = stats.total_opens or 0
-        
+
         return {
             'total_campaigns': stats.total_campaigns or 0,
             'total_recipients': stats.total_recipients or 0,
@@ -139,6 +128,29 @@ def get_user_stats(user_id):
             'total_opens': total_opens,
             'avg_open_rate': round((total_opens / max(total_sent, 1)) * 100, 1) if total_sent else 0
         }
+    finally:
+        session.close()
+
+def get_user_stats(user_id):
+    """Get statistics for a specific user, cached until their next send or open"""
+    try:
+        # Get user's email from user_id using SQLite connection
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
+            result = cursor.fetchone()
+        finally:
+            conn.close()
+        if not result:
+            raise ValueError(f"User not found with id {user_id}")
+        user_email = result[0]
+
+        return stats_cache.get_or_compute(
+            'user_stats:{}'.format(user_email),
+            [sender_scope(user_email)],
+            lambda: _user_stats(user_email)
+        )
     except Exception as e:
         print(f"Error getting user stats: {e}")
         return {
@@ -148,15 +160,10 @@ def get_user_stats(user_id):
             'total_opens': 0,
             'avg_open_rate': 0
         }
-    finally:
-        session.close()
 
-def get_admin_stats():
-    """Get overall statistics for admin"""
-    engine = sa.create_engine('sqlite:///tracking.db')
-    Base.metadata.create_all(engine)  # Ensure tables exist
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def _admin_stats():
+    """Aggregate all tracking rows and count users"""
+    session = tracking_db.Session()
     try:
         # Get overall stats using updated syntax
         stats = session.query(
@@ -168,26 +175,35 @@ def get_admin_stats():
             )).label('total_sent'),
             sa.func.count(PixelTrack.id).label('total_opens')
         ).first()
-        
-        # Get user count from SQLite database
-        conn = get_db_connection()
+    finally:
+        session.close()
+
+    # Get user count from SQLite database
+    conn = get_db_connection()
+    try:
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM users')
         user_count = cursor.fetchone()[0]
+    finally:
         conn.close()
-        
-        # Handle None values
-        total_sent = stats.total_sent or 0
-        total_opens = stats.total_opens or 0
-        
-        return {
-            'total_users': user_count,
-            'total_campaigns': stats.total_campaigns or 0,
-            'total_recipients': stats.total_recipients or 0,
-            'total_sent': total_sent,
-            'total_opens': total_opens,
-            'avg_open_rate': round((total_opens / max(total_sent, 1)) * 100, 1) if total_sent else 0
-        }
+
+    # Handle None values
+    total_sent = stats.total_sent or 0
+    total_opens = stats.total_opens or 0
+
+    return {
+        'total_users': user_count,
+        'total_campaigns': stats.total_campaigns or 0,
+        'total_recipients': stats.total_recipients or 0,
+        'total_sent': total_sent,
+        'total_opens': total_opens,
+        'avg_open_rate': round((total_opens / max(total_sent, 1)) * 100, 1) if total_sent else 0
+    }
+
+def get_admin_stats():
+    """Get overall statistics for admin, cached until the next write or user change"""
+    try:
+        return stats_cache.get_or_compute('admin_stats', [TRACKING, USERS], _admin_stats)
     except Exception as e:
         print(f"Error getting admin stats: {e}")
         return {
@@ -198,5 +214,28 @@ def get_admin_stats():
             'total_opens': 0,
             'avg_open_rate': 0
         }
-    finally:
-        session.close()
\ No newline at end of file
+
+# Authentication decorators, shared by the app and its blueprints
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in flask.session:
+            flask.flash('Please log in first')
+            return flask.redirect(flask.url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in flask.session or not flask.session.get('is_admin'):
+            flask.flash('Admin access required')
+            return flask.redirect(flask.url_for('login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def can_view_sender(sender_emails) -> bool:
+    """
+    True if the logged in user is an admin or sends as one of sender_emails
+    """
+    return bool(flask.session.get('is_admin')) or flask.session.get('username') in sender_emails
@@ -0,0 +1,52 @@
+"""
+Micro-benchmark for the tracking pixel response
+
+Compares the old send_file(io.BytesIO(PIXEL_GIF)) path with the
+prebuilt pixel_response, both for building the response alone and for
+a full request through the Flask test client.
+
+Usage:
+    python bench_pixel.py [iterations]
+"""
+import io
+import sys
+import timeit
+
+from flask import Flask, send_file
+
+from pixel import PIXEL_GIF, pixel_response
+
+app = Flask(__name__)
+
+
+@app.route('/send_file')
+def old_pixel():
+    response = send_file(io.BytesIO(PIXEL_GIF), mimetype='image/gif')
+    response.headers['Cache-Control'] = 'no-store, max-age=0'
+    return response
+
+
+@app.route('/prebuilt')
+def new_pixel():
+    return pixel_response(app.response_class)
+
+
+def report(name, seconds, iterations):
+    print('{:<32} {:>8.2f} us/hit'.format(name, seconds / iterations * 1e6))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with app.test_request_context('/'):
+        report('send_file build', timeit.timeit(old_pixel, number=iterations), iterations)
+        report('pixel_response build', timeit.timeit(new_pixel, number=iterations), iterations)
+
+    client = app.test_client()
+    assert client.get('/send_file').data == client.get('/prebuilt').data == PIXEL_GIF
+    report('send_file request', timeit.timeit(lambda: client.get('/send_file'), number=iterations // 10), iterations // 10)
+    report('pixel_response request', timeit.timeit(lambda: client.get('/prebuilt'), number=iterations // 10), iterations // 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import io
+import csv
+import json
+import zlib
+import datetime
+
+import sqlalchemy as sa
+
+from models import PixelTrack
+
+# Rows fetched from SQLite per round trip, and bytes buffered per response chunk
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = (
+    PixelTrack.campaign_id,
+    PixelTrack.sender_email,
+    PixelTrack.recipient,
+    PixelTrack.is_sent,
+    PixelTrack.sent_timestamp,
+    PixelTrack.is_opened,
+    PixelTrack.opened_timestamp,
+    PixelTrack.device_info,
+    PixelTrack.location,
+    PixelTrack.user_agent,
+    PixelTrack.ip_address,
+)
+EXPORT_FIELDS = tuple(column.key for column in EXPORT_COLUMNS)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def iter_campaign_tracks(engine, campaign_id, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Tracking rows of one campaign, fetched batch_size at a time from an open cursor
+
+    The connection is held until the generator is exhausted or closed, so
+    memory stays flat however large the campaign is.
+
+    :param engine: Tracking database engine
+    :param campaign_id: Campaign to export
+    :return: Generator of dictionaries keyed by EXPORT_FIELDS
+    """
+    query = sa.select(*EXPORT_COLUMNS).where(
+        PixelTrack.campaign_id == campaign_id
+    ).order_by(PixelTrack.recipient)
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(query)
+        for row in result:
+            yield dict(zip(EXPORT_FIELDS, row))
+
+
+def _value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Encode rows as CSV with a header line, yielding about chunk_size bytes at a time
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow(['' if row[field] is None else _value(row[field]) for field in EXPORT_FIELDS])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Encode rows as one JSON object per line, yielding about chunk_size bytes at a time
+    """
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict((field, _value(row[field])) for field in EXPORT_FIELDS)) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Gzip a stream of byte chunks on the fly
+
+    :param chunks: Iterable of bytes
+    :param level: zlib compression level
+    :return: Generator of gzip-framed bytes
+    """
+    # wbits 16 + MAX_WBITS writes a gzip header and trailer instead of a zlib one
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(engine, campaign_id, export_format, compress=False):
+    """
+    Body of a campaign export as a stream of byte chunks
+
+    :param engine: Tracking database engine
+    :param campaign_id: Campaign to export
+    :param export_format: 'csv' or 'ndjson'
+    :param compress: Gzip the output
+    :return: Generator of bytes
+    """
+    encode = csv_chunks if export_format == 'csv' else ndjson_chunks
+    chunks = encode(iter_campaign_tracks(engine, campaign_id))
+    return gzip_chunks(chunks) if compress else chunks
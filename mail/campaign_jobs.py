@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import mailer
+from db import mailer_db, BASE_DIR
+from mailer import EmailSender
+from send_queue import send_queue, PENDING, INFLIGHT, SENT, FAILED
+
+JOBS_DIR = os.path.join(BASE_DIR, 'campaign_jobs')
+
+CREATE_JOBS_TABLE = """
+CREATE TABLE IF NOT EXISTS campaign_jobs (
+    id TEXT PRIMARY KEY,
+    owner TEXT,
+    sender_email TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    campaign_id TEXT NOT NULL,
+    tracking_server TEXT,
+    attachments TEXT,
+    job_dir TEXT,
+    status TEXT NOT NULL,
+    total_count INTEGER DEFAULT 0,
+    sent_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    duplicates INTEGER DEFAULT 0,
+    error TEXT,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL
+)
+"""
+
+JOB_COLUMNS = ('id', 'owner', 'sender_email', 'subject', 'campaign_id', 'status', 'total_count',
+               'sent_count', 'failed_count', 'duplicates', 'error', 'created_at', 'started_at', 'finished_at')
+
+
+def get_db_connection():
+    """Get a pooled mailer.db connection; close() returns it to the pool"""
+    return mailer_db.raw_connection()
+
+
+def job_status(row, counts, live=None):
+    """
+    Build the status dictionary reported for a job
+
+    :param row: Dictionary of JOB_COLUMNS values
+    :param counts: Message counts by state from the send queue
+    :param live: Optional (sent, failed) counters of the current run, used for throughput
+    :return: Status dictionary
+    """
+    sent, failed = counts[SENT], counts[FAILED]
+    started = row['started_at']
+    elapsed = ((row['finished_at'] or time.time()) - started) if started else 0
+    done_this_run = sum(live) if live else sent + failed
+    return {
+        'job_id': row['id'],
+        'campaign_id': row['campaign_id'],
+        'sender_email': row['sender_email'],
+        'owner': row['owner'],
+        'status': row['status'],
+        'total': row['total_count'] or 0,
+        'sent': sent,
+        'failed': failed,
+        'pending': counts[PENDING] + counts[INFLIGHT],
+        'inflight': counts[INFLIGHT],
+        'duplicates_skipped': row['duplicates'] or 0,
+        'throughput_per_sec': round(done_this_run / elapsed, 2) if elapsed > 0 else 0.0,
+        'elapsed_sec': round(elapsed, 1),
+        'error': row['error'],
+        'created_at': row['created_at'],
+        'started_at': started,
+        'finished_at': row['finished_at']
+    }
+
+
+class CampaignJobManager(object):
+    def __init__(self, workers=2, sender_class=EmailSender, jobs_dir=JOBS_DIR):
+        """
+        Runs campaigns on background threads instead of inside the HTTP request
+
+        Job metadata and per-recipient send state are persisted (see send_queue);
+        the sender password is only ever held in memory. Jobs interrupted by a
+        restart are paused until they are resumed with the password again.
+
+        :param workers: Number of campaigns sent at the same time
+        :param sender_class: EmailSender subclass used to send
+        :param jobs_dir: Directory holding each job's attachments
+        """
+        self.workers = workers
+        self.sender_class = sender_class
+        self.jobs_dir = jobs_dir
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.credentials = {}
+        self.running = {}
+        self.threads = []
+        self.table_ready = False
+
+    def _ensure_table(self):
+        if self.table_ready:
+            return
+        conn = get_db_connection()
+        try:
+            conn.cursor().execute(CREATE_JOBS_TABLE)
+            conn.commit()
+        finally:
+            conn.close()
+        self.table_ready = True
+
+    def _start_workers(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self.worker, name='campaign-job-{}'.format(i))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def _update(self, job_id, **fields):
+        conn = get_db_connection()
+        try:
+            assignments = ', '.join('{} = ?'.format(name) for name in fields)
+            conn.cursor().execute('UPDATE campaign_jobs SET {} WHERE id = ?'.format(assignments),
+                                  list(fields.values()) + [job_id])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def submit(self, sender_email, sender_password, subject, body, campaign_id, recipients,
+               attachments=None, tracking_server=None, owner=None):
+        """
+        Persist a campaign and queue it for the background workers
+
+        :param sender_email: Account to send from
+        :param sender_password: Account password, kept in memory only
+        :param subject: Email subject
+        :param body: Email body
+        :param campaign_id: Campaign identifier
+        :param recipients: RecipientSource (or iterable of addresses), streamed into the send queue
+        :param attachments: List of uploaded file paths; they are moved into the job directory
+        :param tracking_server: Tracking server URL for the pixel
+        :param owner: Username of the dashboard user creating the job
+        :return: Job ID
+        """
+        self._ensure_table()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(job_dir)
+
+        # Persist the validated, deduplicated list; workers claim it back in batches
+        total_count = send_queue.enqueue(job_id, recipients)
+
+        job_attachments = []
+        for filepath in attachments or ():
+            target = os.path.join(job_dir, os.path.basename(filepath))
+            shutil.move(filepath, target)
+            job_attachments.append(target)
+
+        conn = get_db_connection()
+        try:
+            conn.cursor().execute(
+                'INSERT INTO campaign_jobs (id, owner, sender_email, subject, body, campaign_id, tracking_server, '
+                'attachments, job_dir, status, total_count, duplicates, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, owner, sender_email, subject, body, campaign_id, tracking_server,
+                 json.dumps(job_attachments), job_dir, 'queued', total_count,
+                 getattr(recipients, 'duplicates', 0), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self.lock:
+            self.credentials[job_id] = sender_password
+        self._start_workers()
+        self.jobs.put(job_id)
+        logging.info('Queued campaign job {} ({} recipients)'.format(job_id, total_count))
+        return job_id
+
+    def _load(self, job_id):
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT sender_email, subject, body, campaign_id, tracking_server, attachments, job_dir '
+                           'FROM campaign_jobs WHERE id = ?', (job_id,))
+            return cursor.fetchone()
+        finally:
+            conn.close()
+
+    def run_job(self, job_id):
+        """
+        Send one job's pending messages on the calling thread
+        """
+        with self.lock:
+            password = self.credentials.pop(job_id, None)
+        row = self._load(job_id)
+        if row is None:
+            return
+        sender_email, subject, body, campaign_id, tracking_server, attachments, job_dir = row
+        if password is None:
+            self._update(job_id, status='paused', error='Sender credentials are not available; resume the job')
+            return
+
+        attachments = json.loads(attachments or '[]')
+        self._update(job_id, status='running', started_at=time.time(), finished_at=None, error=None)
+        try:
+            sender = self.sender_class(sender_email, password, tracking_server=tracking_server)
+            sender.on_result = lambda email_details, success, error, attempt: self._ack(
+                job_id, email_details, success, error, attempt)
+            sender.on_retry = lambda email_details, due: self._renew(job_id, email_details, due)
+            with self.lock:
+                self.running[job_id] = sender
+            recipients = send_queue.iter_claims(job_id, stop=lambda: mailer.STOP_THREADS)
+            results = sender.send_emails_threaded(
+                (recipient, subject, body, campaign_id, attachments) for recipient in recipients)
+            send_queue.flush()
+            send_queue.release_held(job_id)
+            error = '; '.join(results['error_messages'][:5]) or None
+            self._finish(job_id, error)
+        except Exception as e:
+            logging.error('Campaign job {} failed: {}'.format(job_id, e))
+            send_queue.flush()
+            send_queue.release_held(job_id)
+            self._finish(job_id, str(e), status='failed')
+        finally:
+            with self.lock:
+                self.running.pop(job_id, None)
+
+    def _ack(self, job_id, email_details, success, error, attempt):
+        recipient = email_details[0]
+        if success:
+            send_queue.ack(job_id, recipient, SENT, attempts=attempt)
+        elif mailer.STOP_THREADS:
+            # Interrupted before this attempt was made; keep it for the next run
+            send_queue.ack(job_id, recipient, PENDING, attempts=attempt - 1)
+        else:
+            send_queue.ack(job_id, recipient, FAILED, error, attempts=attempt)
+
+    def _renew(self, job_id, email_details, due):
+        # Keep the message leased through its backoff and the retry itself
+        try:
+            send_queue.renew(job_id, [email_details[0]], due - time.time() + send_queue.lease_seconds)
+        except Exception as e:
+            logging.error('Renewing the lease of {} failed: {}'.format(email_details[0], e))
+
+    def _finish(self, job_id, error, status=None):
+        """
+        Store final counts and mark the job completed, or paused if messages are left
+        """
+        counts = send_queue.counts(job_id)
+        remaining = counts[PENDING] + counts[INFLIGHT]
+        if status is None:
+            status = 'paused' if remaining else 'completed'
+        self._update(job_id, status=status, sent_count=counts[SENT], failed_count=counts[FAILED],
+                     error=error, finished_at=time.time())
+        logging.info('Campaign job {} {}. Sent: {}, Failed: {}, Remaining: {}'.format(
+            job_id, status, counts[SENT], counts[FAILED], remaining))
+        if status == 'completed':
+            row = self._load(job_id)
+            if row is not None and row[6]:
+                shutil.rmtree(row[6], ignore_errors=True)
+
+    def recover(self):
+        """
+        Pause jobs left queued or running by a previous process
+
+        Their passwords were only in that process' memory, so they wait for resume().
+        """
+        self._ensure_table()
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE campaign_jobs SET status = 'paused', "
+                           "error = 'Interrupted by a restart; resume the job to continue' "
+                           "WHERE status IN ('queued', 'running')")
+            conn.commit()
+            if cursor.rowcount:
+                logging.info('Paused {} campaign jobs interrupted by a restart'.format(cursor.rowcount))
+        finally:
+            conn.close()
+
+    def resume(self, job_id, sender_password):
+        """
+        Queue a paused or failed job again; messages already sent are not resent
+
+        :param job_id: Job ID
+        :param sender_password: Password of the job's sender account
+        :return: True if the job was queued
+        """
+        self._ensure_table()
+        with self.lock:
+            if job_id in self.running or job_id in self.credentials:
+                return False
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE campaign_jobs SET status = 'queued', error = NULL "
+                           "WHERE id = ? AND status IN ('paused', 'failed')", (job_id,))
+            conn.commit()
+            if not cursor.rowcount:
+                return False
+        finally:
+            conn.close()
+
+        # Nothing of this job runs anywhere now, so its leases are stale
+        send_queue.release_job(job_id)
+        with self.lock:
+            self.credentials[job_id] = sender_password
+        self._start_workers()
+        self.jobs.put(job_id)
+        logging.info('Resumed campaign job {}'.format(job_id))
+        return True
+
+    def worker(self):
+        """
+        Background thread taking job IDs off the queue
+        """
+        while True:
+            job_id = self.jobs.get()
+            try:
+                self.run_job(job_id)
+            except Exception as e:
+                logging.error('Campaign job worker error: {}'.format(e))
+            finally:
+                self.jobs.task_done()
+
+    def _live_counts(self, job_id):
+        with self.lock:
+            sender = self.running.get(job_id)
+        if sender is None:
+            return None
+        return sender.sent_count, sender.failed_count
+
+    def status(self, job_id):
+        """
+        Progress of a job from its send queue state
+
+        :param job_id: Job ID returned by submit
+        :return: Status dictionary, or None if the job does not exist
+        """
+        self._ensure_table()
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT {} FROM campaign_jobs WHERE id = ?'.format(', '.join(JOB_COLUMNS)), (job_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return job_status(dict(zip(JOB_COLUMNS, row)), send_queue.counts(job_id), self._live_counts(job_id))
+
+
+campaign_jobs = CampaignJobManager(workers=int(os.environ.get('CAMPAIGN_JOB_WORKERS', 2)))
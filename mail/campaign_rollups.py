@@ -0,0 +1,169 @@
+"""
+Per-campaign counters kept next to pixel_tracks by SQLite triggers
+
+Every insert, update and delete on pixel_tracks adjusts the matching
+campaign_rollups row in the same transaction, whichever process or code
+path wrote it, so the dashboard reads one row per campaign instead of
+aggregating the whole history.
+
+Usage:
+    python campaign_rollups.py [--check]
+
+Rebuilds campaign_rollups from pixel_tracks and reports how many rows were
+out of date. With --check nothing is written and the exit status is 1 if
+any rollup differs from the raw rows.
+"""
+import sys
+import logging
+
+# Adds one pixel_tracks row (NEW) to its rollup
+ADD_NEW = """
+INSERT INTO campaign_rollups (campaign_id, sender_email, tracks, recipients, sent, opened, first_open, last_open)
+VALUES (COALESCE(NEW.campaign_id, ''), COALESCE(NEW.sender_email, ''), 1, NEW.recipient IS NOT NULL,
+        COALESCE(NEW.is_sent, 0), COALESCE(NEW.is_opened, 0),
+        CASE WHEN NEW.is_opened THEN NEW.opened_timestamp END,
+        CASE WHEN NEW.is_opened THEN NEW.opened_timestamp END)
+ON CONFLICT (campaign_id, sender_email) DO UPDATE SET
+    tracks = tracks + 1,
+    recipients = recipients + excluded.recipients,
+    sent = sent + excluded.sent,
+    opened = opened + excluded.opened,
+    first_open = COALESCE(MIN(first_open, excluded.first_open), first_open, excluded.first_open),
+    last_open = COALESCE(MAX(last_open, excluded.last_open), last_open, excluded.last_open);
+"""
+
+# Removes one pixel_tracks row (OLD) from its rollup; first/last open only ever
+# widen, which holds because opens are never undone (rebuild() fixes the rest)
+SUBTRACT_OLD = """
+UPDATE campaign_rollups SET
+    tracks = tracks - 1,
+    recipients = recipients - (OLD.recipient IS NOT NULL),
+    sent = sent - COALESCE(OLD.is_sent, 0),
+    opened = opened - COALESCE(OLD.is_opened, 0)
+WHERE campaign_id = COALESCE(OLD.campaign_id, '') AND sender_email = COALESCE(OLD.sender_email, '');
+"""
+
+DROP_EMPTY_OLD = """
+DELETE FROM campaign_rollups
+WHERE campaign_id = COALESCE(OLD.campaign_id, '') AND sender_email = COALESCE(OLD.sender_email, '')
+  AND tracks <= 0;
+"""
+
+# Re-sends only touch sent_timestamp/message_id, so most updates skip the trigger
+COUNTED_COLUMNS_CHANGED = """
+OLD.campaign_id IS NOT NEW.campaign_id OR OLD.sender_email IS NOT NEW.sender_email
+OR OLD.recipient IS NOT NEW.recipient OR OLD.is_sent IS NOT NEW.is_sent
+OR OLD.is_opened IS NOT NEW.is_opened OR OLD.opened_timestamp IS NOT NEW.opened_timestamp
+"""
+
+ROLLUP_TRIGGERS = (
+    ('campaign_rollups_insert',
+     'CREATE TRIGGER campaign_rollups_insert AFTER INSERT ON pixel_tracks BEGIN {} END'.format(ADD_NEW)),
+    ('campaign_rollups_update',
+     'CREATE TRIGGER campaign_rollups_update AFTER UPDATE ON pixel_tracks WHEN {} BEGIN {} {} {} END'.format(
+         COUNTED_COLUMNS_CHANGED, SUBTRACT_OLD, DROP_EMPTY_OLD, ADD_NEW)),
+    ('campaign_rollups_delete',
+     'CREATE TRIGGER campaign_rollups_delete AFTER DELETE ON pixel_tracks BEGIN {} {} END'.format(
+         SUBTRACT_OLD, DROP_EMPTY_OLD)),
+)
+
+ROLLUP_COLUMNS = ('campaign_id', 'sender_email', 'tracks', 'recipients', 'sent', 'opened', 'first_open', 'last_open')
+
+AGGREGATE_ROLLUPS = """
+SELECT COALESCE(campaign_id, ''), COALESCE(sender_email, ''), COUNT(*), COUNT(recipient),
+       SUM(COALESCE(is_sent, 0)), SUM(COALESCE(is_opened, 0)),
+       MIN(CASE WHEN is_opened THEN opened_timestamp END), MAX(CASE WHEN is_opened THEN opened_timestamp END)
+FROM pixel_tracks
+GROUP BY COALESCE(campaign_id, ''), COALESCE(sender_email, '')
+"""
+
+
+def reconcile(cursor, write=True):
+    """
+    Compare campaign_rollups with an aggregate over pixel_tracks, replacing it if asked
+
+    Runs inside the caller's transaction.
+
+    :param cursor: DB-API cursor on tracking.db
+    :param write: Replace the rollups with the fresh aggregate
+    :return: Tuple of (number of campaigns, number of rollup rows that were wrong or missing)
+    """
+    cursor.execute(AGGREGATE_ROLLUPS)
+    fresh = dict((tuple(row[:2]), tuple(row)) for row in cursor.fetchall())
+    cursor.execute('SELECT {} FROM campaign_rollups'.format(', '.join(ROLLUP_COLUMNS)))
+    current = dict((tuple(row[:2]), tuple(row)) for row in cursor.fetchall())
+    wrong = sum(1 for key in set(fresh) | set(current) if fresh.get(key) != current.get(key))
+    if write:
+        cursor.execute('DELETE FROM campaign_rollups')
+        cursor.executemany('INSERT INTO campaign_rollups ({}) VALUES ({})'.format(
+            ', '.join(ROLLUP_COLUMNS), ', '.join('?' * len(ROLLUP_COLUMNS))), list(fresh.values()))
+    return len(fresh), wrong
+
+
+def install_rollups(engine):
+    """
+    Create the pixel_tracks triggers, filling campaign_rollups from existing rows the first time
+
+    Used as the tracking database's setup hook, after create_all.
+    """
+    names = [name for name, _ in ROLLUP_TRIGGERS]
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        query = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN ({})".format(
+            ', '.join('?' * len(names)))
+        cursor.execute(query, names)
+        if cursor.fetchone()[0] == len(names):
+            return
+        # Block writers so no row lands between the triggers and the initial fill
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(query, names)
+        if cursor.fetchone()[0] != len(names):
+            for name, statement in ROLLUP_TRIGGERS:
+                cursor.execute('DROP TRIGGER IF EXISTS {}'.format(name))
+                cursor.execute(statement)
+            campaigns, _ = reconcile(cursor)
+            logging.info('Built campaign_rollups for {} campaigns'.format(campaigns))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.error('Campaign rollup setup error: {}'.format(e))
+    finally:
+        conn.close()
+
+
+def rebuild(write=True):
+    """
+    Reconcile campaign_rollups against pixel_tracks
+
+    :param write: False to only count differences
+    :return: Tuple of (number of campaigns, number of rollup rows that were wrong or missing)
+    """
+    from db import tracking_db
+
+    conn = tracking_db.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        result = reconcile(cursor, write=write)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def main():
+    check = '--check' in sys.argv[1:]
+    campaigns, wrong = rebuild(write=not check)
+    if check:
+        print('{} campaigns, {} rollups out of date'.format(campaigns, wrong))
+        return 1 if wrong else 0
+    print('Rebuilt rollups for {} campaigns ({} were out of date)'.format(campaigns, wrong))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+import smtplib
+import threading
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from attachment_cache import attachment_cache
+
+# Stand-ins serialized into the template and replaced per recipient
+TO_PLACEHOLDER = 'to-placeholder@compiled.invalid'
+PIXEL_URL_PLACEHOLDER = 'pixel-url-placeholder.compiled.invalid'
+
+# To header of a message sent to several recipients in one transaction
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
+CRLF = b'\r\n'
+
+
+def quote_periods(data):
+    """
+    Dot-stuff lines starting with '.' as the SMTP DATA command requires
+
+    Only valid for a chunk that starts at the beginning of the message or
+    right after a line break.
+    """
+    if data.startswith(b'.'):
+        data = b'.' + data
+    return data.replace(b'\n.', b'\n..')
+
+
+def encode_header_value(value):
+    """
+    Encode a header value as bytes, using RFC 2047 only when it is not plain ASCII
+    """
+    try:
+        return value.encode('ascii')
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode().encode('ascii')
+
+
+class CompiledMessage(object):
+    def __init__(self, from_header, subject, html_body, attachments=None, cache=None):
+        """
+        Campaign message serialized once, with the To header and pixel URL spliced per recipient
+
+        :param from_header: Value of the From header
+        :param subject: Email subject
+        :param html_body: HTML body that contains PIXEL_URL_PLACEHOLDER where the pixel URL goes,
+                          or no placeholder for an untracked message
+        :param attachments: List of file paths to attach
+        :param cache: AttachmentCache supplying encoded parts, defaults to the shared one
+        """
+        cache = cache or attachment_cache
+        self.html_body = html_body
+        self.policy = None
+
+        msg = MIMEMultipart()
+        msg['From'] = from_header
+        msg['To'] = TO_PLACEHOLDER
+        msg['Subject'] = subject
+        html_part = MIMEText(html_body, 'html')
+        msg.attach(html_part)
+
+        # Encoded attachment parts come from the shared cache and are written
+        # after the HTML part as-is, mmap'd parts included
+        parts = [cache.get(filepath) for filepath in attachments or ()]
+        parts = [part for part in parts if part is not None]
+
+        # SMTP wants CRLF on the wire; serializing the multipart also fixes its boundary
+        self.policy = msg.policy.clone(linesep='\r\n')
+        data = msg.as_bytes(policy=self.policy)
+        html_data = html_part.as_bytes(policy=self.policy)
+
+        to_line = CRLF + b'To: ' + TO_PLACEHOLDER.encode('ascii') + CRLF
+        to_start = data.index(to_line) + len(CRLF) + len(b'To: ')
+        to_end = to_start + len(TO_PLACEHOLDER)
+        html_start = data.index(html_data, to_end)
+        html_end = html_start + len(html_data)
+
+        self.head = quote_periods(data[:to_start])
+        self.after_to = quote_periods(data[to_end:html_start])
+        boundary = CRLF + b'--' + msg.get_boundary().encode('ascii') + CRLF
+        self.tail = []
+        for part in parts:
+            self.tail.extend([boundary, part.data])
+        closing = quote_periods(data[html_end:])
+        if not closing.endswith(CRLF):
+            closing += CRLF
+        self.tail.append(closing)
+
+        # A 7bit HTML part keeps the placeholder verbatim and can be split around it.
+        # base64 (non-ASCII bodies) hides it, so that part is re-encoded per recipient.
+        url_start = html_data.find(PIXEL_URL_PLACEHOLDER.encode('ascii'))
+        self.static_html = None
+        if PIXEL_URL_PLACEHOLDER not in html_body:
+            # No pixel (tracking disabled): the part is the same for everyone
+            self.static_html = quote_periods(html_data)
+            self.html_before_url = self.html_after_url = None
+        elif html_part.get_content_charset() == 'us-ascii' and url_start != -1:
+            self.html_before_url = quote_periods(html_data[:url_start])
+            # Starts mid-line, so only line breaks need stuffing
+            self.html_after_url = html_data[url_start + len(PIXEL_URL_PLACEHOLDER):].replace(b'\n.', b'\n..')
+        else:
+            self.html_before_url = self.html_after_url = None
+
+    def render_html(self, pixel_url):
+        """
+        HTML part bytes for one recipient
+
+        :param pixel_url: Tracking pixel URL
+        :return: List of byte chunks
+        """
+        if self.static_html is not None:
+            return [self.static_html]
+        if self.html_before_url is not None:
+            try:
+                url = pixel_url.encode('ascii')
+            except UnicodeEncodeError:
+                url = None
+            if url is not None:
+                return [self.html_before_url, url, self.html_after_url]
+        part = MIMEText(self.html_body.replace(PIXEL_URL_PLACEHOLDER, pixel_url), 'html')
+        return [quote_periods(part.as_bytes(policy=self.policy))]
+
+    def render(self, recipient, pixel_url):
+        """
+        Wire chunks for one recipient, already CRLF terminated and dot-stuffed
+
+        Static chunks are shared between recipients, only the To value and
+        pixel URL are new bytes.
+
+        :param recipient: Email address of recipient
+        :param pixel_url: Tracking pixel URL
+        :return: List of byte chunks
+        """
+        chunks = [self.head, encode_header_value(recipient), self.after_to]
+        chunks.extend(self.render_html(pixel_url))
+        chunks.extend(self.tail)
+        return chunks
+
+    def as_bytes(self, recipient, pixel_url):
+        """
+        Complete message for one recipient as a single bytes object, without dot-stuffing
+
+        :param recipient: Email address of recipient
+        :param pixel_url: Tracking pixel URL
+        :return: Message bytes
+        """
+        return b''.join(self.render(recipient, pixel_url)).replace(b'\n..', b'\n.')
+
+
+def pipeline_envelope(smtp, from_addr, to_addrs, mail_options=()):
+    """
+    Send MAIL FROM and every RCPT TO in one write and read their replies (RFC 2920)
+
+    :param smtp: Connected smtplib.SMTP object whose server advertised PIPELINING
+    :param from_addr: Envelope sender
+    :param to_addrs: List of envelope recipients
+    :param mail_options: ESMTP options for MAIL FROM, from envelope_options
+    :return: List of (code, message) replies, MAIL FROM first
+    """
+    if 'SMTPUTF8' in mail_options:
+        # smtp.mail() switches the encoding itself; here the commands are written directly
+        smtp.command_encoding = 'utf-8'
+    commands = [' '.join(['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr))] + list(mail_options))]
+    commands.extend('RCPT TO:{}'.format(smtplib.quoteaddr(each)) for each in to_addrs)
+    smtp.send(''.join(command + '\r\n' for command in commands))
+    return [smtp.getreply() for _ in commands]
+
+
+def check_size(size, max_size):
+    """
+    Refuse a message larger than the server's advertised SIZE (RFC 1870) before sending it
+
+    :param size: Message size in bytes
+    :param max_size: SIZE from the endpoint's capabilities, or None if not advertised
+    :raises smtplib.SMTPResponseException: 552, a permanent failure, if the message is too large
+    """
+    if max_size and size > max_size:
+        raise smtplib.SMTPResponseException(
+            552, 'Message size {} exceeds the server limit of {} bytes'.format(size, max_size))
+
+
+def envelope_options(from_addr, to_addrs, smtputf8):
+    """
+    MAIL FROM options for an envelope; non-ASCII addresses need SMTPUTF8 (RFC 6531)
+
+    Without SMTPUTF8 such recipients are refused up front with a permanent
+    553 instead of being sent, so the rest of a batch still goes out.
+
+    :param from_addr: Envelope sender
+    :param to_addrs: List of envelope recipients
+    :param smtputf8: Whether the server advertised SMTPUTF8
+    :return: Tuple of (mail_options, refused), refused mapping address -> (code, message)
+    :raises smtplib.SMTPSenderRefused: 553 if the sender needs SMTPUTF8 and the server lacks it
+    """
+    if smtputf8:
+        if from_addr.isascii() and all(each.isascii() for each in to_addrs):
+            return [], {}
+        return ['SMTPUTF8'], {}
+    error = 'Address needs SMTPUTF8, which the server does not support'
+    if not from_addr.isascii():
+        raise smtplib.SMTPSenderRefused(553, error, from_addr)
+    return [], dict((each, (553, error)) for each in to_addrs if not each.isascii())
+
+
+def send_chunks(smtp, from_addr, to_addrs, chunks, pipelining=False, max_size=None, smtputf8=False):
+    """
+    Send pre-stuffed message chunks over an smtplib session
+
+    Equivalent to smtp.sendmail, but writes the chunks straight to the
+    socket instead of joining and re-scanning the whole message.
+
+    :param smtp: Connected smtplib.SMTP object
+    :param from_addr: Envelope sender
+    :param to_addrs: Envelope recipient or list of recipients
+    :param chunks: Byte chunks from CompiledMessage.render
+    :param pipelining: Send the envelope in one round trip; pass the server's cached PIPELINING capability
+    :param max_size: The server's cached SIZE capability; larger messages are refused before MAIL FROM
+    :param smtputf8: The server's cached SMTPUTF8 capability, needed for non-ASCII addresses
+    :return: Dictionary of refused recipients, as smtp.sendmail returns
+    """
+    check_size(sum(len(chunk) for chunk in chunks), max_size)
+    smtp.ehlo_or_helo_if_needed()
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    # The cached capabilities may be stale; only use an extension this session also advertised
+    pipelining = pipelining and smtp.has_extn('pipelining')
+    mail_options, refused = envelope_options(from_addr, to_addrs, smtputf8 and smtp.has_extn('smtputf8'))
+    if len(refused) == len(to_addrs):
+        raise smtplib.SMTPRecipientsRefused(refused)
+    envelope = [each for each in to_addrs if each not in refused]
+
+    replies = None
+    if pipelining and len(envelope) > 1:
+        replies = pipeline_envelope(smtp, from_addr, envelope, mail_options)
+
+    code, resp = replies[0] if replies else smtp.mail(from_addr, mail_options)
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp._rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    for i, each in enumerate(envelope):
+        code, resp = replies[i + 1] if replies else smtp.rcpt(each)
+        if code not in (250, 251):
+            refused[each] = (code, resp)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        smtp._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    smtp.putcmd('data')
+    code, resp = smtp.getreply()
+    if code != 354:
+        smtp._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in chunks:
+        smtp.send(chunk)
+    smtp.send(b'.' + CRLF)
+    code, resp = smtp.getreply()
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp._rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+class CompiledMessageCache(object):
+    def __init__(self, max_entries=16):
+        """
+        Per-sender cache of compiled campaign messages
+
+        :param max_entries: Number of distinct campaign messages kept
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.messages = {}
+
+    def get(self, key, compile):
+        """
+        Get the compiled message for key, compiling it once if missing
+
+        :param key: Hashable campaign message key
+        :param compile: Callable returning a CompiledMessage
+        :return: CompiledMessage
+        """
+        message = self.messages.get(key)
+        if message is not None:
+            return message
+        with self.lock:
+            message = self.messages.get(key)
+            if message is None:
+                if len(self.messages) >= self.max_entries:
+                    self.messages.clear()
+                message = self.messages[key] = compile()
+        return message
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
@@ -1,45 +1,87 @@
-from flask import Blueprint, render_template, jsonify
+from flask import Blueprint, Response, render_template, jsonify, request, session
+from werkzeug.utils import secure_filename
 from datetime import datetime
 import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
-from pixel_tracker_py2 import Base, PixelTrack
+from models import PixelTrack, CampaignRollup
+from db import get_database, TRACKING_DB_PATH
+from campaign_export import EXPORT_FORMATS, export_chunks
+from stats_cache import stats_cache, TRACKING
+from live_updates import live_updates
+from auth import login_required, can_view_sender
 import logging
+import base64
+import json
 
 dashboard = Blueprint('dashboard', __name__)
 
+RECIPIENT_PAGE_SIZE = 100
+MAX_RECIPIENT_PAGE_SIZE = 1000
+RECIPIENT_STATUSES = ('all', 'opened', 'unopened')
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# SQLite's rowid ends every index, so it is a free unique tie-breaker for keyset pages
+ROWID = sa.literal_column('pixel_tracks.rowid', sa.Integer)
+
+# Sort columns per sort key, each backed by an index led by campaign_id (see models.py)
+RECIPIENT_SORTS = {
+    'email': (PixelTrack.recipient,),
+    'opens': (PixelTrack.is_opened, PixelTrack.recipient),
+    'first_open': (PixelTrack.opened_timestamp,),
+}
+
+
+def encode_cursor(values):
+    """
+    Opaque page cursor from the sort values of the last entry on a page
+    """
+    values = [value.strftime(CURSOR_TIME_FORMAT) if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+    """
+    Sort values from a cursor made by encode_cursor for the same sort keys
+
+    :raises ValueError: If the cursor is malformed or belongs to another sort
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor: {}'.format(e))
+    if not isinstance(values, list) or len(values) != len(keys) or not isinstance(values[-1], int):
+        raise ValueError('Invalid cursor')
+    for i, key in enumerate(keys):
+        if isinstance(key.type, sa.DateTime) and values[i] is not None:
+            values[i] = datetime.strptime(values[i], CURSOR_TIME_FORMAT)
+    return values
+
 class DashboardManager:
-    def __init__(self, db_path='tracking.db'):
-        self.engine = sa.create_engine(f'sqlite:///{db_path}')
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+    def __init__(self, db_path=TRACKING_DB_PATH):
+        # Shared process-wide engine and sessions from db.py
+        self.database = get_database(db_path)
+        self.Session = self.database.Session
 
     def get_campaign_stats(self):
+        try:
+            # Recomputed by one worker after each batch of sends or opens
+            return stats_cache.get_or_compute('campaign_stats', [TRACKING], self._campaign_stats)
+        except Exception as e:
+            logging.error(f"Error getting campaign stats: {e}")
+            return [], {
+                'total_campaigns': 0,
+                'total_recipients': 0,
+                'total_sent': 0,
+                'total_opens': 0,
+                'avg_open_rate': 0
+            }
+
+    def _campaign_stats(self):
         session = self.Session()
         try:
-            # Get campaign-level statistics using updated SQLAlchemy syntax
-            campaign_stats = session.query(
-                PixelTrack.campaign_id,
-                PixelTrack.sender_email,
-                sa.func.count(sa.distinct(PixelTrack.recipient)).label('unique_recipients'),
-                sa.func.sum(sa.case(
-                    (PixelTrack.is_sent.is_(True), 1),
-                    else_=0
-                )).label('total_sent'),
-                sa.func.sum(sa.case(
-                    (PixelTrack.is_opened.is_(True), 1),
-                    else_=0
-                )).label('total_opens'),
-                sa.func.min(sa.case(
-                    (PixelTrack.is_opened.is_(True), PixelTrack.opened_timestamp),
-                    else_=None
-                )).label('first_open'),
-                sa.func.max(sa.case(
-                    (PixelTrack.is_opened.is_(True), PixelTrack.opened_timestamp),
-                    else_=None
-                )).label('last_open')
-            ).group_by(
-                PixelTrack.campaign_id,
-                PixelTrack.sender_email
+            # One pre-aggregated row per campaign and sender, kept current by triggers
+            campaign_stats = session.query(CampaignRollup).order_by(
+                CampaignRollup.campaign_id,
+                CampaignRollup.sender_email
             ).all()
 
             # Format campaign data
@@ -50,13 +92,13 @@ class DashboardManager:
 
             for stat in campaign_stats:
                 # Handle None values
-                sent = stat.total_sent or 0
-                opens = stat.total_opens or 0
+                sent = stat.sent or 0
+                opens = stat.opened or 0
                 
                 campaign = {
-                    'id': stat.campaign_id,
-                    'sender_email': stat.sender_email,
-                    'recipients': stat.unique_recipients,
+                    'id': stat.campaign_id or None,
+                    'sender_email': stat.sender_email or None,
+                    'recipients': stat.recipients,
                     'total_sent': sent,
                     'total_opens': opens,
                     'open_rate': round((opens / max(sent, 1)) * 100, 1),
@@ -64,7 +106,7 @@ class DashboardManager:
                     'last_open': stat.last_open.strftime('%Y-%m-%d %H:%M:%S') if stat.last_open else 'N/A'
                 }
                 campaigns.append(campaign)
-                total_recipients += stat.unique_recipients
+                total_recipients += stat.recipients
                 total_sent += sent
                 total_opens += opens
 
@@ -78,69 +120,134 @@ class DashboardManager:
             }
 
             return campaigns, stats
-
-        except Exception as e:
-            logging.error(f"Error getting campaign stats: {e}")
-            return [], {
-                'total_campaigns': 0,
-                'total_recipients': 0,
-                'total_sent': 0,
-                'total_opens': 0,
-                'avg_open_rate': 0
-            }
         finally:
             session.close()
 
-    def get_campaign_recipients(self, campaign_id):
+    def get_campaign_recipients(self, campaign_id, limit=RECIPIENT_PAGE_SIZE, after=None,
+                                sort='email', order='asc', status='all'):
+        """
+        One page of a campaign's recipients, one entry per message (recipient and sender)
+
+        Pages are keyset-paginated: each query seeks straight to the row after
+        the cursor through an index on (campaign_id, sort columns), so the last
+        page of a large campaign costs the same as the first.
+
+        :param campaign_id: Campaign to list
+        :param limit: Entries per page
+        :param after: Cursor returned as 'next' by the previous page
+        :param sort: 'email', 'opens' or 'first_open'
+        :param order: 'asc' or 'desc'
+        :param status: 'all', 'opened' or 'unopened'
+        :return: Tuple of (list of recipient dictionaries, cursor for the next page or None)
+        """
+        columns = RECIPIENT_SORTS[sort]
+        descending = order == 'desc'
+        keys = list(columns) + [ROWID]
+        position = decode_cursor(after, keys) if after else None
         session = self.Session()
         try:
-            # Get recipient-level statistics for the campaign using updated syntax
-            recipient_stats = session.query(
+            query = session.query(
                 PixelTrack.recipient,
-                sa.func.sum(sa.case(
-                    (PixelTrack.is_sent.is_(True), 1),
-                    else_=0
-                )).label('sent'),
-                sa.func.sum(sa.case(
-                    (PixelTrack.is_opened.is_(True), 1),
-                    else_=0
-                )).label('opens'),
-                sa.func.min(sa.case(
-                    (PixelTrack.is_opened.is_(True), PixelTrack.opened_timestamp),
-                    else_=None
-                )).label('first_open'),
-                sa.func.max(sa.case(
-                    (PixelTrack.is_opened.is_(True), PixelTrack.opened_timestamp),
-                    else_=None
-                )).label('last_open')
+                PixelTrack.sender_email,
+                PixelTrack.is_sent,
+                PixelTrack.is_opened,
+                PixelTrack.opened_timestamp,
+                PixelTrack.device_info,
+                PixelTrack.location,
+                ROWID
             ).filter(
-                PixelTrack.campaign_id == campaign_id
-            ).group_by(
-                PixelTrack.recipient
-            ).all()
+                PixelTrack.campaign_id == campaign_id,
+                PixelTrack.recipient.isnot(None)
+            )
+            if status != 'all':
+                query = query.filter(PixelTrack.is_opened == (status == 'opened'))
+
+            # NULLs of the leading sort column come first ascending and last
+            # descending; each part is read as its own index range
+            first = columns[0]
+            segments = [True, False] if not descending else [False, True]
+            if position is not None:
+                segments = segments[segments.index(position[0] is None):]
+
+            rows = []
+            for is_null in segments:
+                part = query.filter(first.is_(None) if is_null else first.isnot(None))
+                part_keys = keys[1:] if is_null else keys
+                if position is not None and is_null == (position[0] is None):
+                    bound = tuple(position[1:] if is_null else position)
+                    part = part.filter(sa.tuple_(*part_keys) < bound if descending else sa.tuple_(*part_keys) > bound)
+                # One extra row tells whether there is a next page
+                rows.extend(part.order_by(*[key.desc() if descending else key for key in part_keys])
+                            .limit(limit + 1 - len(rows)).all())
+                if len(rows) > limit:
+                    break
+
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last = rows[-1]
+                next_cursor = encode_cursor([getattr(last, column.key) for column in columns] + [last[-1]])
 
-            # Format recipient data
             recipients = []
-            for stat in recipient_stats:
-                recipient = {
-                    'email': stat.recipient,
-                    'sent': stat.sent or 0,
-                    'opens': stat.opens or 0,
-                    'first_open': stat.first_open.strftime('%Y-%m-%d %H:%M:%S') if stat.first_open else 'N/A',
-                    'last_open': stat.last_open.strftime('%Y-%m-%d %H:%M:%S') if stat.last_open else 'N/A'
-                }
-                recipients.append(recipient)
+            for row in rows:
+                opened = row.opened_timestamp.strftime('%Y-%m-%d %H:%M:%S') \
+                    if row.is_opened and row.opened_timestamp else 'N/A'
+                recipients.append({
+                    'email': row.recipient,
+                    'sender_email': row.sender_email,
+                    'sent': 1 if row.is_sent else 0,
+                    'opens': 1 if row.is_opened else 0,
+                    'first_open': opened,
+                    'last_open': opened,
+                    'device_info': row.device_info,
+                    'location': row.location
+                })
 
-            return recipients
+            return recipients, next_cursor
 
         except Exception as e:
             logging.error(f"Error getting campaign recipients: {e}")
-            return []
+            return [], None
+        finally:
+            session.close()
+
+    def campaign_senders(self, campaign_id):
+        """
+        Sender addresses of a campaign, empty if there is no such campaign
+        """
+        session = self.Session()
+        try:
+            rows = session.query(CampaignRollup.sender_email).filter(
+                CampaignRollup.campaign_id == campaign_id,
+                CampaignRollup.tracks > 0
+            ).all()
+            return set(row.sender_email for row in rows)
         finally:
             session.close()
 
+    def export_campaign(self, campaign_id, export_format, compress=False):
+        """
+        Stream every tracking row of a campaign as CSV or NDJSON bytes
+
+        See campaign_export.export_chunks.
+        """
+        return export_chunks(self.database.engine, campaign_id, export_format, compress=compress)
+
 dashboard_manager = DashboardManager()
 
+def campaign_access_error(campaign_id):
+    """
+    Error response if the campaign does not exist or the user is neither its sender nor an admin
+
+    :return: (response, status) tuple, or None if access is allowed
+    """
+    senders = dashboard_manager.campaign_senders(campaign_id)
+    if not senders:
+        return jsonify({'error': 'Unknown campaign'}), 404
+    if not can_view_sender(senders):
+        return jsonify({'error': 'Access denied'}), 403
+    return None
+
 @dashboard.route('/')
 def index():
     try:
@@ -157,10 +264,83 @@ def index():
         })
 
 @dashboard.route('/api/campaign/<campaign_id>/recipients')
+@login_required
 def campaign_recipients(campaign_id):
+    """
+    Recipients of a campaign, a page at a time; only for its sender or an admin
+
+    Query parameters: limit, after (the 'next' cursor of the previous page),
+    sort (email, opens, first_open), order (asc, desc) and status
+    (all, opened, unopened).
+    """
+    error = campaign_access_error(campaign_id)
+    if error is not None:
+        return error
+    sort = request.args.get('sort', 'email')
+    order = request.args.get('order', 'asc')
+    status = request.args.get('status', 'all')
+    if sort not in RECIPIENT_SORTS or order not in ('asc', 'desc') or status not in RECIPIENT_STATUSES:
+        return jsonify({'error': 'Invalid sort, order or status'}), 400
+    limit = request.args.get('limit', RECIPIENT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_RECIPIENT_PAGE_SIZE))
     try:
-        recipients = dashboard_manager.get_campaign_recipients(campaign_id)
-        return jsonify({'recipients': recipients})
-    except Exception as e:
-        print(f"Error in campaign recipients: {e}")
-        return jsonify({'recipients': []})
+        recipients, next_cursor = dashboard_manager.get_campaign_recipients(
+            campaign_id, limit=limit, after=request.args.get('after'), sort=sort, order=order, status=status)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'recipients': recipients,
+        'next': next_cursor,
+        'limit': limit,
+        'sort': sort,
+        'order': order,
+        'status': status
+    })
+
+@dashboard.route('/api/campaign/<campaign_id>/export.<export_format>')
+@login_required
+def campaign_export(campaign_id, export_format):
+    """
+    Download all tracking rows of a campaign as CSV or NDJSON; only for its sender or an admin
+
+    The body is streamed from the database as it is read, gzip-encoded when
+    the client accepts it (pass gzip=0 to turn that off).
+    """
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Unknown export format'}), 404
+    error = campaign_access_error(campaign_id)
+    if error is not None:
+        return error
+    compress = 'gzip' in request.accept_encodings and request.args.get('gzip', '1') != '0'
+    response = Response(
+        dashboard_manager.export_campaign(campaign_id, export_format, compress=compress),
+        content_type=EXPORT_FORMATS[export_format]
+    )
+    filename = secure_filename('campaign_{}.{}'.format(campaign_id, export_format))
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@dashboard.route('/stream')
+@login_required
+def stream():
+    """
+    Server-Sent Events with campaign counter changes for the open dashboard
+
+    Sends a 'snapshot' event on connect (and after falling behind), then
+    'update' events with per-campaign deltas and new totals. Admins see
+    every campaign, other users only the campaigns they sent.
+    """
+    sender_email = None if session.get('is_admin') else session.get('username')
+    subscriber = live_updates.subscribe(sender_email)
+    if subscriber is None:
+        return Response('Too many live dashboard connections\n', status=503,
+                        headers={'Retry-After': '30'}, mimetype='text/plain')
+    response = Response(live_updates.stream(subscriber), mimetype='text/event-stream')
+    # Also covers a client that disconnects before the body is started
+    response.call_on_close(lambda: live_updates.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,180 @@
+import os
+import logging
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, scoped_session
+from sqlalchemy.pool import QueuePool
+
+from models import Base, PixelTrack
+from campaign_rollups import install_rollups
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+TRACKING_DB_PATH = os.path.join(BASE_DIR, 'tracking.db')
+MAILER_DB_PATH = os.path.join(BASE_DIR, 'mailer.db')
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -20000),  # Negative value is in KiB, so about 20MB
+)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Per-connection PRAGMA setup hook
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+# Folds duplicate (campaign_id, sender_email, recipient) rows into the oldest
+# one so the unique index can be built on databases from older versions
+MERGE_DUPLICATE_TRACKS = """
+UPDATE pixel_tracks SET
+    is_sent = (SELECT MAX(d.is_sent) FROM pixel_tracks d {match}),
+    sent_timestamp = (SELECT MIN(d.sent_timestamp) FROM pixel_tracks d {match}),
+    is_opened = (SELECT MAX(d.is_opened) FROM pixel_tracks d {match}),
+    opened_timestamp = (SELECT MIN(d.opened_timestamp) FROM pixel_tracks d {match})
+WHERE rowid IN ({duplicates})
+"""
+DELETE_DUPLICATE_TRACKS = """
+DELETE FROM pixel_tracks
+WHERE campaign_id IS NOT NULL AND sender_email IS NOT NULL AND recipient IS NOT NULL
+  AND rowid NOT IN (
+    SELECT MIN(rowid) FROM pixel_tracks
+    WHERE campaign_id IS NOT NULL AND sender_email IS NOT NULL AND recipient IS NOT NULL
+    GROUP BY campaign_id, sender_email, recipient)
+"""
+DUPLICATE_KEEPERS = """
+SELECT MIN(rowid) FROM pixel_tracks
+WHERE campaign_id IS NOT NULL AND sender_email IS NOT NULL AND recipient IS NOT NULL
+GROUP BY campaign_id, sender_email, recipient HAVING COUNT(*) > 1
+"""
+MATCH_TRACK = """
+WHERE d.campaign_id = pixel_tracks.campaign_id AND d.sender_email = pixel_tracks.sender_email
+  AND d.recipient = pixel_tracks.recipient
+"""
+
+
+def migrate_tracking_schema(engine):
+    """
+    Add pixel_tracks columns and indexes missing from databases created by older versions
+    """
+    try:
+        inspector = sa.inspect(engine)
+        if not inspector.has_table('pixel_tracks'):
+            return
+        existing = set(column['name'] for column in inspector.get_columns('pixel_tracks'))
+        indexes = set(index['name'] for index in inspector.get_indexes('pixel_tracks'))
+        with engine.begin() as conn:
+            for column, column_type in (('sender_email', 'TEXT'), ('recipient', 'TEXT'),
+                                        ('device_info', 'TEXT'), ('location', 'TEXT'),
+                                        ('message_id', 'INTEGER')):
+                if column not in existing:
+                    conn.execute(sa.text('ALTER TABLE pixel_tracks ADD COLUMN {} {}'.format(column, column_type)))
+
+            if 'ix_pixel_tracks_campaign_sender_recipient' not in indexes:
+                conn.execute(sa.text(MERGE_DUPLICATE_TRACKS.format(
+                    match=MATCH_TRACK, duplicates=DUPLICATE_KEEPERS)))
+                deleted = conn.execute(sa.text(DELETE_DUPLICATE_TRACKS)).rowcount
+                if deleted:
+                    logging.info('Merged {} duplicate pixel_tracks rows'.format(deleted))
+
+            if 'ix_pixel_tracks_campaign_opened_recipient' not in indexes:
+                # Very old rows may predate the is_sent/is_opened defaults; the
+                # opened/unopened filter matches on 1/0 only
+                conn.execute(sa.text('UPDATE pixel_tracks SET is_opened = 0 WHERE is_opened IS NULL'))
+                conn.execute(sa.text('UPDATE pixel_tracks SET is_sent = 0 WHERE is_sent IS NULL'))
+
+            for index in PixelTrack.__table__.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+    except Exception as e:
+        logging.error('Database migration error: {}'.format(e))
+
+
+class Database(object):
+    def __init__(self, path, metadata=None, migrate=None, setup=None):
+        """
+        Lazily created, process-wide engine and scoped session registry for one SQLite file
+
+        :param path: Path to the SQLite database file
+        :param metadata: Optional MetaData whose tables are created once on first use
+        :param migrate: Optional callable(engine) run once before create_all
+        :param setup: Optional callable(engine) run once after create_all
+        """
+        self.path = path
+        self.metadata = metadata
+        self.migrate = migrate
+        self.setup = setup
+        self.lock = threading.Lock()
+        self._engine = None
+        # Thread-local sessions; the engine is only created when the first session is
+        self.Session = scoped_session(self._new_session)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self.lock:
+                if self._engine is None:
+                    engine = sa.create_engine(
+                        'sqlite:///{}'.format(self.path),
+                        poolclass=QueuePool,
+                        pool_size=10,
+                        max_overflow=20,
+                        connect_args={'check_same_thread': False, 'timeout': 30}
+                    )
+                    sa.event.listen(engine, 'connect', set_sqlite_pragmas)
+                    # Schema setup runs exactly once per process
+                    if self.migrate:
+                        self.migrate(engine)
+                    if self.metadata is not None:
+                        self.metadata.create_all(engine)
+                    if self.setup:
+                        self.setup(engine)
+                    self._engine = engine
+        return self._engine
+
+    def _new_session(self, **kwargs):
+        return Session(bind=self.engine, **kwargs)
+
+    def raw_connection(self):
+        """
+        Pooled DB-API connection; close() returns it to the pool
+        """
+        return self.engine.raw_connection()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path, metadata=None, migrate=None, setup=None):
+    """
+    Get the process-wide Database for a file path, creating it on first use
+    """
+    path = os.path.abspath(path)
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = Database(path, metadata, migrate, setup)
+        return _databases[path]
+
+
+tracking_db = get_database(TRACKING_DB_PATH, Base.metadata, migrate_tracking_schema, install_rollups)
+mailer_db = get_database(MAILER_DB_PATH)
+
+
+def init_databases():
+    """
+    Create engines and run schema setup at startup instead of on the first request
+    """
+    tracking_db.engine
+    mailer_db.engine
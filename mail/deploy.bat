@@ -2,7 +2,7 @@
 setlocal enabledelayedexpansion
 
 REM Check if required files exist
-set REQUIRED_FILES[0]=pixel_tracker_py2.py
+set REQUIRED_FILES[0]=track_service.py
 set REQUIRED_FILES[1]=requirements.txt
 set REQUIRED_FILES[2]=mailer.py
 
@@ -28,7 +28,7 @@ REM Install dependencies
 pip install -r requirements.txt
 
 REM Start pixel tracker in background
-start /B gunicorn -w 4 -b 0.0.0.0:8080 pixel_tracker_py2:app
+start /B gunicorn -w 4 -b 0.0.0.0:8080 track_service:app
 
 REM Optional: Start dashboard in background
 start /B streamlit run dashboard.py --server.port 8501
@@ -6,7 +6,7 @@
 set -e
 
 # Check if required files exist
-REQUIRED_FILES=("pixel_tracker_py2.py" "requirements.txt" "mailer.py")
+REQUIRED_FILES=("track_service.py" "requirements.txt" "mailer.py")
 for file in "${REQUIRED_FILES[@]}"; do
     if [ ! -f "$file" ]; then
         echo "Error: $file is missing"
@@ -31,8 +31,8 @@ pip install -r requirements.txt
 # Ensure tracking data directory exists
 mkdir -p tracking_logs
 
-# Start pixel tracker in background
-nohup gunicorn -w 4 -b 0.0.0.0:8080 pixel_tracker_py2:app &
+# Start pixel tracker in background (TRACKER_WORKERS processes share one listener)
+nohup gunicorn -w "${TRACKER_WORKERS:-4}" -b 0.0.0.0:8080 track_service:app &
 
 # Optional: Start dashboard in background
 nohup streamlit run dashboard.py --server.port 8501 &
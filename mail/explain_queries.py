@@ -0,0 +1,79 @@
+"""
+Print EXPLAIN QUERY PLAN for the hot pixel_tracks queries
+
+Usage:
+    python explain_queries.py [--strict]
+
+With --strict the exit status is 1 if any query scans pixel_tracks
+without an index, so it can be used as a regression check.
+"""
+import sys
+
+import sqlalchemy as sa
+
+from models import PixelTrack, CampaignRollup
+from db import tracking_db
+
+
+def hot_queries():
+    """
+    Queries issued on every pixel hit, send and dashboard load
+
+    :return: List of (name, statement) tuples
+    """
+    sent = sa.case((PixelTrack.is_sent.is_(True), 1), else_=0)
+    return [
+        ('pixel open lookup (app.track, pixel_tracker_py2.track_pixel)',
+         sa.select(PixelTrack.id).where(
+             PixelTrack.campaign_id == 'campaign',
+             PixelTrack.sender_email == 'sender@example.com',
+             PixelTrack.recipient == 'recipient@example.com')),
+        ('dashboard campaign stats (DashboardManager.get_campaign_stats)',
+         sa.select(CampaignRollup).order_by(CampaignRollup.campaign_id, CampaignRollup.sender_email)),
+        ('campaign recipients (DashboardManager.get_campaign_recipients)',
+         sa.select(PixelTrack.recipient, PixelTrack.is_opened, PixelTrack.opened_timestamp)
+         .where(PixelTrack.campaign_id == 'campaign', PixelTrack.recipient.isnot(None),
+                sa.tuple_(PixelTrack.recipient, sa.literal_column('pixel_tracks.rowid')) > ('r@example.com', 1))
+         .order_by(PixelTrack.recipient, sa.literal_column('pixel_tracks.rowid'))
+         .limit(101)),
+        ('campaign recipients by first open (DashboardManager.get_campaign_recipients)',
+         sa.select(PixelTrack.recipient, PixelTrack.opened_timestamp)
+         .where(PixelTrack.campaign_id == 'campaign', PixelTrack.opened_timestamp.isnot(None))
+         .order_by(PixelTrack.opened_timestamp.desc(), sa.literal_column('pixel_tracks.rowid').desc())
+         .limit(101)),
+        ('user stats (auth.get_user_stats)',
+         sa.select(
+             sa.func.count(sa.distinct(PixelTrack.campaign_id)),
+             sa.func.count(sa.distinct(PixelTrack.recipient)),
+             sa.func.sum(sent)
+         ).where(PixelTrack.sender_email == 'sender@example.com')),
+    ]
+
+
+def explain(conn, stmt):
+    """
+    :return: List of plan detail strings
+    """
+    sql = str(stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+    return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def main():
+    strict = '--strict' in sys.argv[1:]
+    full_scans = 0
+    with tracking_db.engine.connect() as conn:
+        for name, stmt in hot_queries():
+            print(name)
+            for detail in explain(conn, stmt):
+                unindexed = detail.startswith('SCAN pixel_tracks') and 'INDEX' not in detail
+                full_scans += unindexed
+                print('    {}{}'.format(detail, '    <-- full table scan' if unindexed else ''))
+            print('')
+    if strict and full_scans:
+        print('{} hot queries scan pixel_tracks without an index'.format(full_scans))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Sustained messages/sec and concurrent transactions per SMTP host, kept a little
+# under what each provider publishes so bursts are absorbed instead of throttled
+SMTP_HOST_LIMITS = {
+    'smtp.gmail.com': {'rate': 5.0, 'max_concurrent': 5},
+    'smtp.mail.yahoo.com': {'rate': 2.0, 'max_concurrent': 3},
+    'smtp.live.com': {'rate': 0.5, 'max_concurrent': 3},
+    'smtp.office365.com': {'rate': 0.5, 'max_concurrent': 3},
+    'smtp.aol.com': {'rate': 2.0, 'max_concurrent': 3},
+    'smtp.rediffmail.com': {'rate': 2.0, 'max_concurrent': 3},
+    'smtp.rediffmailpro.com': {'rate': 2.0, 'max_concurrent': 3},
+}
+DEFAULT_HOST_LIMITS = {'rate': 10.0, 'max_concurrent': 10}
+
+# Replies that mean "slow down" rather than "this message is bad"
+THROTTLE_CODES = (421, 451)
+
+
+def is_throttle(error):
+    """
+    True if a send error is the server asking us to slow down (421/451)
+    """
+    code = getattr(error, 'smtp_code', None) or getattr(error, 'code', None)
+    if code in THROTTLE_CODES:
+        return True
+    refused = getattr(error, 'recipients', None)
+    if isinstance(refused, dict):
+        return any(reply[0] in THROTTLE_CODES for reply in refused.values())
+    if isinstance(refused, list):
+        return any(getattr(each, 'code', None) in THROTTLE_CODES for each in refused)
+    return False
+
+
+class HostGovernor(object):
+    def __init__(self, host, rate, max_concurrent, min_rate=None, increase=None, decrease=0.5, cooldown=5.0):
+        """
+        Token bucket rate limit plus concurrency cap for one SMTP host
+
+        The rate adapts AIMD-style: every throttle reply multiplies it by
+        decrease, and after cooldown seconds without one each success adds
+        increase msgs/sec, never going above the configured rate.
+
+        :param host: SMTP host name
+        :param rate: Highest messages/sec allowed
+        :param max_concurrent: Concurrent SMTP transactions allowed
+        :param min_rate: Lowest rate the governor backs off to, defaults to rate / 10
+        :param increase: Additive increase per success (messages/sec), defaults to rate / 50
+        :param decrease: Multiplicative decrease per throttle reply
+        :param cooldown: Seconds after a throttle reply before the rate grows again
+        """
+        self.host = host
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate or self.max_rate / 10
+        self.max_concurrent = max_concurrent
+        self.increase = increase or self.max_rate / 50
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.tokens = max(1.0, float(max_concurrent))
+        self.updated = time.time()
+        self.last_throttle = 0.0
+        self.throttles = 0
+        self.waited = 0.0
+
+    def reserve(self):
+        """
+        Take one token, returning how long the caller must wait before sending
+
+        :return: Seconds to wait (0 when a token is available)
+        """
+        with self.lock:
+            now = time.time()
+            burst = max(1.0, float(self.max_concurrent))
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+            return wait
+
+    @contextmanager
+    def slot(self):
+        """
+        Hold one of max_concurrent transaction slots and wait for a token; for threads
+        """
+        with self.slots:
+            wait = self.reserve()
+            if wait:
+                time.sleep(wait)
+            yield
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate and time.time() - self.last_throttle > self.cooldown:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        """
+        Slow down after a 421/451; one burst of rejections only halves the rate once
+        """
+        with self.lock:
+            self.throttles += 1
+            now = time.time()
+            if now - self.last_throttle < 1.0:
+                return
+            self.last_throttle = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Drop saved-up tokens so the slower rate applies right away
+            self.tokens = min(self.tokens, 0.0)
+            rate = self.rate
+        logging.warning('SMTP host {} is throttling, slowing down to {:.2f} msgs/sec'.format(self.host, rate))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'host': self.host,
+                'rate': round(self.rate, 3),
+                'max_rate': self.max_rate,
+                'max_concurrent': self.max_concurrent,
+                'throttles': self.throttles,
+                'waited_sec': round(self.waited, 2)
+            }
+
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+def get_governor(host):
+    """
+    Get the process-wide governor for an SMTP host, shared by every sender
+    """
+    with _governors_lock:
+        if host not in _governors:
+            limits = SMTP_HOST_LIMITS.get(host, DEFAULT_HOST_LIMITS)
+            _governors[host] = HostGovernor(host, limits['rate'], limits['max_concurrent'])
+        return _governors[host]
@@ -0,0 +1,344 @@
+"""
+Live campaign counters for the dashboard over Server-Sent Events
+
+One poller thread per process watches tracking.db for commits (PRAGMA
+data_version, which changes whenever any connection or process commits)
+and only then reads campaign_rollups, one row per campaign. Changes are
+published once as a JSON delta and fanned out to every open /dashboard/stream
+connection, so the database cost does not grow with the number of viewers.
+Connections of non-admin users only get the campaigns of their own sender
+address; those messages are built once per sender.
+
+Each connection has a small bounded queue. A client that falls behind has
+its backlog dropped and gets a fresh snapshot instead of the missed deltas.
+"""
+import os
+import json
+import time
+import logging
+import threading
+import collections
+
+ROLLUP_QUERY = """
+SELECT campaign_id, sender_email, recipients, sent, opened, first_open, last_open
+FROM campaign_rollups
+"""
+
+# Returned by Subscriber.pop when the client has to be sent a new snapshot
+RESYNC = object()
+
+
+def format_event(event, data, event_id=None):
+    """
+    Encode one SSE message
+
+    :param event: Event name
+    :param data: JSON text
+    :param event_id: Optional id line
+    :return: Message text
+    """
+    lines = []
+    if event_id is not None:
+        lines.append('id: {}'.format(event_id))
+    lines.append('event: {}'.format(event))
+    lines.append('data: {}'.format(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+def _timestamp(value):
+    # campaign_rollups stores SQLAlchemy's 'YYYY-MM-DD HH:MM:SS.ffffff' text
+    return value[:19] if value else 'N/A'
+
+
+class Subscriber(object):
+    def __init__(self, max_events, sender_email=None):
+        """
+        Pending events of one stream connection
+
+        :param max_events: Events kept before the backlog is dropped for a resync
+        :param sender_email: Only send campaigns of this sender, or every campaign if None
+        """
+        self.max_events = max_events
+        self.sender_email = sender_email
+        self.events = collections.deque()
+        self.condition = threading.Condition()
+        self.resync = False
+        self.dropped = 0
+
+    def push(self, event):
+        """
+        Queue a (version, message) tuple; never blocks the publisher
+        """
+        with self.condition:
+            if self.resync:
+                # The snapshot sent next already covers this event
+                return
+            if len(self.events) >= self.max_events:
+                self.dropped += len(self.events)
+                self.events.clear()
+                self.resync = True
+            else:
+                self.events.append(event)
+            self.condition.notify()
+
+    def pop(self, timeout):
+        """
+        Next event, waiting up to timeout seconds
+
+        :return: (version, message) tuple, RESYNC, or None on timeout
+        """
+        with self.condition:
+            if not self.events and not self.resync:
+                self.condition.wait(timeout)
+            if self.resync:
+                self.resync = False
+                return RESYNC
+            if self.events:
+                return self.events.popleft()
+            return None
+
+
+class UpdateHub(object):
+    def __init__(self, database=None, interval=0.5, heartbeat=15, max_events=100,
+                 max_subscribers=100, max_age=600, retry_ms=3000):
+        """
+        In-process pub/sub of campaign counter changes
+
+        :param database: db.Database for tracking.db, defaults to db.tracking_db
+        :param interval: Seconds between data_version checks while anyone is listening
+        :param heartbeat: Seconds of silence before a stream sends a keep-alive comment
+        :param max_events: Queued events per connection before it is resynced
+        :param max_subscribers: Open streams allowed; each holds a server thread
+        :param max_age: Seconds after which a stream ends and the browser reconnects
+        :param retry_ms: Reconnect delay suggested to the browser
+        """
+        self.database = database
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.max_events = max_events
+        self.max_subscribers = max_subscribers
+        self.max_age = max_age
+        self.retry_ms = retry_ms
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.state = {}
+        self.version = 0
+        self.snapshot_message = None
+        self.loaded = threading.Event()
+        self.wake = threading.Event()
+        self.thread = None
+        self.polls = 0
+        self.published = 0
+
+    def subscribe(self, sender_email=None):
+        """
+        Register a new stream connection
+
+        :param sender_email: Only stream campaigns of this sender, or every campaign if None
+        :return: Subscriber, or None if max_subscribers streams are already open
+        """
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.max_events, sender_email)
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='live-updates')
+                self.thread.daemon = True
+                self.thread.start()
+        self.wake.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def _run(self):
+        conn = None
+        data_version = None
+        while True:
+            with self.lock:
+                idle = not self.subscribers
+            if idle:
+                # Nobody is watching: drop the connection and let the state go stale
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                self.loaded.clear()
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            try:
+                if conn is None:
+                    if self.database is None:
+                        from db import tracking_db
+                        self.database = tracking_db
+                    conn = self.database.raw_connection()
+                    data_version = None
+                cursor = conn.cursor()
+                cursor.execute('PRAGMA data_version')
+                version = cursor.fetchone()[0]
+                if version != data_version or not self.loaded.is_set():
+                    cursor.execute(ROLLUP_QUERY)
+                    rows = cursor.fetchall()
+                    data_version = version
+                    self._apply(rows)
+                    self.loaded.set()
+                cursor.close()
+            except Exception as e:
+                logging.error('Live update poll failed: {}'.format(e))
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def _apply(self, rows):
+        """
+        Diff fresh rollup rows against the last state and publish the changes
+        """
+        fresh = dict(((row[0], row[1]), tuple(row[2:])) for row in rows)
+        changes = []
+        for key in set(self.state) | set(fresh):
+            old = self.state.get(key)
+            new = fresh.get(key)
+            if old == new:
+                continue
+            old_counts = old[:3] if old else (0, 0, 0)
+            new_counts = new[:3] if new else (0, 0, 0)
+            changes.append({
+                'id': key[0] or None,
+                'sender_email': key[1] or None,
+                'recipients': new_counts[0] - old_counts[0],
+                'sent': new_counts[1] - old_counts[1],
+                'opened': new_counts[2] - old_counts[2],
+                'first_open': _timestamp(new[3] if new else None),
+                'last_open': _timestamp(new[4] if new else None),
+                'removed': new is None
+            })
+        self.polls += 1
+        if not changes and self.loaded.is_set():
+            return
+        with self.lock:
+            self.state = fresh
+            self.version += 1
+            self.snapshot_message = None
+            subscribers = list(self.subscribers)
+            version = self.version
+            senders = set(subscriber.sender_email for subscriber in subscribers)
+            stats = dict((sender_email, self._totals(sender_email)) for sender_email in senders)
+        if not changes:
+            return
+        # Serialized once per audience, shared by every connection in it
+        messages = {}
+        for sender_email in senders:
+            visible = [change for change in changes
+                       if sender_email is None or (change['sender_email'] or '') == sender_email]
+            if visible:
+                messages[sender_email] = format_event('update', json.dumps({
+                    'version': version,
+                    'changes': visible,
+                    'stats': stats[sender_email]
+                }), version)
+        for subscriber in subscribers:
+            message = messages.get(subscriber.sender_email)
+            if message is not None:
+                subscriber.push((version, message))
+        self.published += 1
+
+    def _campaigns(self, sender_email=None):
+        # Rollup state of every campaign, or of one sender's campaigns
+        if sender_email is None:
+            return self.state
+        return dict((key, counts) for key, counts in self.state.items() if key[1] == sender_email)
+
+    def _totals(self, sender_email=None):
+        state = self._campaigns(sender_email)
+        total_sent = sum(counts[1] for counts in state.values())
+        total_opens = sum(counts[2] for counts in state.values())
+        return {
+            'total_campaigns': len(state),
+            'total_recipients': sum(counts[0] for counts in state.values()),
+            'total_sent': total_sent,
+            'total_opens': total_opens,
+            'avg_open_rate': round((total_opens / max(total_sent, 1)) * 100, 1)
+        }
+
+    def snapshot(self, timeout=5.0, sender_email=None):
+        """
+        Full current state as an SSE message; the unfiltered one is built once per version
+
+        :param sender_email: Only include campaigns of this sender, or every campaign if None
+        :return: Tuple of (version, message), or None if the first poll has not finished
+        """
+        if not self.loaded.wait(timeout):
+            return None
+        with self.lock:
+            if sender_email is not None:
+                return self.version, self._snapshot_message(sender_email)
+            if self.snapshot_message is None:
+                self.snapshot_message = self._snapshot_message()
+            return self.version, self.snapshot_message
+
+    def _snapshot_message(self, sender_email=None):
+        campaigns = [{
+            'id': key[0] or None,
+            'sender_email': key[1] or None,
+            'recipients': counts[0],
+            'sent': counts[1],
+            'opened': counts[2],
+            'first_open': _timestamp(counts[3]),
+            'last_open': _timestamp(counts[4])
+        } for key, counts in sorted(self._campaigns(sender_email).items())]
+        return format_event('snapshot', json.dumps({
+            'version': self.version,
+            'campaigns': campaigns,
+            'stats': self._totals(sender_email)
+        }), self.version)
+
+    def stream(self, subscriber):
+        """
+        SSE body for one connection: a snapshot, then deltas and heartbeats
+
+        Ends after max_age seconds so threads of clients that went away
+        silently are returned; the browser reconnects on its own.
+
+        :param subscriber: Subscriber from subscribe()
+        :return: Generator of message strings
+        """
+        try:
+            yield 'retry: {}\n\n'.format(self.retry_ms)
+            deadline = time.time() + self.max_age
+            version = None
+            while time.time() < deadline:
+                if version is None:
+                    snapshot = self.snapshot(timeout=self.heartbeat, sender_email=subscriber.sender_email)
+                    if snapshot is None:
+                        yield ': waiting\n\n'
+                        continue
+                    version, message = snapshot
+                    yield message
+                    continue
+                event = subscriber.pop(self.heartbeat)
+                if event is RESYNC:
+                    version = None
+                elif event is None:
+                    yield ': ping\n\n'
+                elif event[0] > version:
+                    version = event[0]
+                    yield event[1]
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'version': self.version,
+                'campaigns': len(self.state),
+                'polls': self.polls,
+                'published': self.published
+            }
+
+
+live_updates = UpdateHub(max_subscribers=int(os.environ.get('LIVE_UPDATES_MAX_STREAMS', 100)))
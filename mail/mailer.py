@@ -6,10 +6,18 @@ import uuid
 import json
 import sys
 import signal
+import time
+from collections import OrderedDict
 from datetime import datetime
-import sqlalchemy as sa
-from sqlalchemy.orm import sessionmaker
-from pixel_tracker_py2 import Base, PixelTrack  # Add PixelTrack import
+from smtp_pool import SMTPConnectionPool
+from tracking_store import sent_writer
+from attachment_cache import attachment_cache
+from recipient_source import RecipientSource
+from retry_policy import RetryScheduler, classify_error, TRANSIENT, PERMANENT
+from host_governor import get_governor, is_throttle
+from smtp_endpoints import smtp_endpoints, open_smtp
+from tracking_token import encode_token, message_ids
+from compiled_message import CompiledMessage, CompiledMessageCache, PIXEL_URL_PLACEHOLDER, UNDISCLOSED_RECIPIENTS, send_chunks
 import base64
 import re
 
@@ -25,17 +33,6 @@ except ImportError:
 from threading import Thread
 import logging
 
-# Attempt to import email MIME modules with fallback
-try:
-    from email.mime.multipart import MIMEMultipart
-    from email.mime.text import MIMEText
-    from email.mime.application import MIMEApplication
-except ImportError:
-    # Fallback for older Python versions
-    from email.MIMEMultipart import MIMEMultipart
-    from email.MIMEText import MIMEText
-    from email.MIMEApplication import MIMEApplication
-
 # Debug print
 print("Modules imported successfully!")
 
@@ -49,6 +46,12 @@ logging.basicConfig(
 # Global flag for interruption
 STOP_THREADS = False
 
+# Set MAILER_SMTP_DEBUG=1 to log the SMTP conversation (every message chunk) to stderr
+SMTP_DEBUG = os.environ.get('MAILER_SMTP_DEBUG') == '1'
+
+# Recipient domains with a multi-recipient batch being filled at the same time
+MAX_OPEN_BATCHES = 1000
+
 def signal_handler(signum, frame):
     """
     Handle keyboard interrupt and other signals
@@ -65,7 +68,9 @@ def get_campaign_id():
     return datetime.now().strftime("%d %B")
 
 class EmailSender(object):
-    def __init__(self, username, password, max_workers=5, tracking_server=None):
+    def __init__(self, username, password, max_workers=5, tracking_server=None,
+                 max_messages_per_connection=100, smtp_pool=None, track_opens=True,
+                 max_recipients_per_message=50):
         """
         Initialize email sender with SMTP credentials
         
@@ -73,6 +78,11 @@ class EmailSender(object):
         :param password: Email account password
         :param max_workers: Maximum number of concurrent email threads
         :param tracking_server: Optional tracking server URL
+        :param max_messages_per_connection: Messages sent before an SMTP session is recycled
+        :param smtp_pool: Optional SMTPConnectionPool shared between senders
+        :param track_opens: Add a per-recipient tracking pixel; when False every recipient
+                            gets the same message, so recipients are sent in batches
+        :param max_recipients_per_message: Recipients per transaction in batch mode
         """
         if not username or not password:
             raise ValueError("Email username and password are required")
@@ -83,10 +93,27 @@ class EmailSender(object):
         self.sent_count = 0
         self.failed_count = 0
         self.lock = threading.Lock()
-        self.queue = queue.Queue()
+        # Bounded so a streamed recipient list is read only as fast as it is sent
+        self.queue = queue.Queue(maxsize=max_workers * 100)
         self.results = []
         self.tracking_server = tracking_server or 'http://localhost:3000'
         self.error_messages = []
+        self.smtp_pool = smtp_pool or SMTPConnectionPool(
+            max_messages_per_connection=max_messages_per_connection)
+        self.compiled_messages = CompiledMessageCache()
+        # Optional callable(email_details, success, error, attempt) run once a message has its final result
+        self.on_result = None
+        # Optional callable(email_details, due) run when a retry is scheduled for time due
+        self.on_retry = None
+        # Transient failures wait here for another attempt
+        self.retries = RetryScheduler()
+        self.error_classes = {TRANSIENT: 0, PERMANENT: 0}
+        self.error_reasons = {}
+        self.governor = None
+        # Resolved (host, port, mode) and EHLO capabilities, see smtp_endpoints
+        self.endpoint = None
+        self.track_opens = track_opens
+        self.max_recipients_per_message = max_recipients_per_message
         
         # Simple domain extraction for SMTP settings
         try:
@@ -96,78 +123,186 @@ class EmailSender(object):
         
         print("Email sender initialization completed")  # Debug print
 
+    def _get_smtp_settings(self):
+        """
+        Determine SMTP host and port based on email provider
+        
+        :return: Tuple of (host, port)
+        """
+        print(f"\nGetting SMTP settings for domain: '{self.domain}'")  # Debug print
+        
+        # SMTP settings for different providers
+        smtp_settings = {
+            'gmail.com': ('smtp.gmail.com', 587),
+            'yahoo.com': ('smtp.mail.yahoo.com', 587),
+            'hotmail.com': ('smtp.live.com', 587),
+            'outlook.com': ('smtp.office365.com', 587),
+            'aol.com': ('smtp.aol.com', 587),
+            'rediffmail.com': ('smtp.rediffmail.com', 587),
+            'rediff.com': ('smtp.rediffmail.com', 587),
+            'rediffmailpro.com': ('smtp.rediffmailpro.com', 465),
+            'beenetmunication.com': ('smtp.rediffmailpro.com', 465)
+        }
+
+        # Find matching SMTP settings or use domain as SMTP server
+        if self.domain in smtp_settings:
+            host, port = smtp_settings[self.domain]
+            print(f"Found predefined SMTP settings - Host: {host}, Port: {port}")  # Debug print
+        else:
+            host = f"smtp.{self.domain}"
+            port = 587
+            print(f"Using default SMTP settings - Host: {host}, Port: {port}")  # Debug print
+        return host, port
+
+    def _smtp_endpoint(self, stale=None):
+        """
+        Get the SMTP endpoint for this account, probing it once per domain
+        
+        :param stale: Endpoint that stopped answering; it is forgotten and probed again
+        :return: Endpoint dictionary (host, port, mode, capabilities)
+        """
+        if stale is not None:
+            smtp_endpoints.invalidate(self.domain, stale)
+            if self.endpoint is stale:
+                self.endpoint = None
+        if self.endpoint is None:
+            host, port = self._get_smtp_settings()
+            self.endpoint = smtp_endpoints.resolve(self.domain, host, port)
+        return self.endpoint
+
     def _get_smtp_connection(self):
         """
-        Determine SMTP settings based on email provider
+        Open an authenticated SMTP connection for this account
         
         :return: SMTP connection object
         """
         try:
-            print(f"\nGetting SMTP settings for domain: '{self.domain}'")  # Debug print
-            
-            # SMTP settings for different providers
-            smtp_settings = {
-                'gmail.com': ('smtp.gmail.com', 587),
-                'yahoo.com': ('smtp.mail.yahoo.com', 587),
-                'hotmail.com': ('smtp.live.com', 587),
-                'outlook.com': ('smtp.office365.com', 587),
-                'aol.com': ('smtp.aol.com', 587),
-                'rediffmail.com': ('smtp.rediffmail.com', 587),
-                'rediff.com': ('smtp.rediffmail.com', 587),
-                'rediffmailpro.com': ('smtp.rediffmailpro.com', 465),
-                'beenetmunication.com': ('smtp.rediffmailpro.com', 465)
-            }
-
-            # Find matching SMTP settings or use domain as SMTP server
-            if self.domain in smtp_settings:
-                host, port = smtp_settings[self.domain]
-                print(f"Found predefined SMTP settings - Host: {host}, Port: {port}")  # Debug print
-            else:
-                host = f"smtp.{self.domain}"
-                port = 587
-                print(f"Using default SMTP settings - Host: {host}, Port: {port}")  # Debug print
-                
-            print(f"Attempting SMTP connection to {host}:{port}")  # Debug print
-            
-            # First try STARTTLS
+            endpoint = self._smtp_endpoint()
+            print(f"Attempting SMTP connection to {endpoint['host']}:{endpoint['port']} ({endpoint['mode']})")  # Debug print
             try:
-                print("Trying STARTTLS connection...")  # Debug print
-                smtp = smtplib.SMTP(host, port, timeout=30)
+                smtp = open_smtp(endpoint['host'], endpoint['port'], endpoint['mode'])
+            except (OSError, smtplib.SMTPException) as e:
+                # The cached endpoint stopped answering; probe again once
+                print(f"SMTP connection failed, rediscovering endpoint: {str(e)}")  # Debug print
+                endpoint = self._smtp_endpoint(stale=endpoint)
+                smtp = open_smtp(endpoint['host'], endpoint['port'], endpoint['mode'])
+            if SMTP_DEBUG:
                 smtp.set_debuglevel(1)
-                smtp.starttls()
-                print("Attempting login with STARTTLS...")  # Debug print
+            try:
                 smtp.login(self.username, self.password)
-                print("STARTTLS connection successful")  # Debug print
-                return smtp
-            except Exception as e:
-                print(f"STARTTLS connection failed: {str(e)}")  # Debug print
-                print("Trying SSL connection...")  # Debug print
-                try:
-                    smtp = smtplib.SMTP_SSL(host, 465, timeout=30)
-                    smtp.set_debuglevel(1)
-                    print("Attempting login with SSL...")  # Debug print
-                    smtp.login(self.username, self.password)
-                    print("SSL connection successful")  # Debug print
-                    return smtp
-                except Exception as ssl_error:
-                    print(f"SSL connection failed: {str(ssl_error)}")  # Debug print
-                    raise smtplib.SMTPAuthenticationError(-1, f"Failed to connect to SMTP server {host}. Error: {str(ssl_error)}")
-                
+            except Exception:
+                smtp.close()
+                raise
+            print("SMTP connection successful")  # Debug print
+            return smtp
+        except smtplib.SMTPAuthenticationError:
+            raise
         except Exception as e:
             print(f"SMTP connection error: {str(e)}")  # Debug print
             raise smtplib.SMTPAuthenticationError(-1, f"SMTP connection error: {str(e)}")
 
-    def add_tracking_pixel(self, html_body, recipient, campaign_id):
+    def _host_governor(self):
         """
-        Add tracking pixel to HTML email body
+        Get the rate/concurrency governor for this account's SMTP host
+        
+        :return: HostGovernor
+        """
+        if self.governor is None:
+            host, _ = self._get_smtp_settings()
+            self.governor = get_governor(host)
+        return self.governor
+
+    def _checkout_smtp(self):
+        """
+        Check out an SMTP session from the pool for one transaction
+        
+        At most the host governor's max_concurrent sessions are open per
+        account; when all of them are busy this waits for one to come back.
+        
+        :return: PooledConnection
+        """
+        host, port = self._get_smtp_settings()
+        return self.smtp_pool.acquire((host, port, self.username), self._get_smtp_connection,
+                                      max_open=self._host_governor().max_concurrent)
+
+    def _capabilities(self):
+        """
+        Cached EHLO capabilities of the account's endpoint, empty until it has been resolved
+        """
+        return (self.endpoint or {}).get('capabilities') or {}
+
+    def _send_options(self):
+        """
+        send_chunks arguments taken from the cached capabilities
+
+        send_chunks uses PIPELINING and SMTPUTF8 only if the live session advertises them too.
+        """
+        capabilities = self._capabilities()
+        return {
+            'pipelining': bool(capabilities.get('pipelining')),
+            'max_size': capabilities.get('size'),
+            'smtputf8': bool(capabilities.get('smtputf8'))
+        }
+
+    def _send_pooled(self, recipient, message):
+        """
+        Send a message over a pooled SMTP session
+        
+        Reconnects once if the server dropped the session or answered 421.
+        
+        :param recipient: Email address of recipient, or list of addresses for a batch
+        :param message: Wire chunks from build_message or build_batch_message
+        :return: Dictionary of refused recipients
+        """
+        conn = self._checkout_smtp()
+        try:
+            try:
+                refused = send_chunks(conn.smtp, self.username, recipient, message, **self._send_options())
+            except (smtplib.SMTPServerDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                logging.warning(f"SMTP session lost, reconnecting: {str(e)}")
+                conn = self.smtp_pool.reconnect(conn, self._get_smtp_connection)
+                refused = send_chunks(conn.smtp, self.username, recipient, message, **self._send_options())
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code != 421:
+                    raise
+                logging.warning("SMTP server closing session (421), reconnecting")
+                self._host_governor().on_throttle()
+                conn = self.smtp_pool.reconnect(conn, self._get_smtp_connection)
+                refused = send_chunks(conn.smtp, self.username, recipient, message, **self._send_options())
+            self.smtp_pool.mark_sent(conn)
+        finally:
+            # A session left in a bad state fails prepare() on its next checkout and is replaced
+            self.smtp_pool.release(conn)
+        return refused
+
+    def close(self):
+        """
+        Close idle pooled sessions
+        """
+        self.smtp_pool.close_all()
+
+    def tracking_url(self, recipient, campaign_id, message_id=None):
+        """
+        Build the tracking pixel URL for one message
         
-        :param html_body: Original HTML body
         :param recipient: Email recipient
         :param campaign_id: Campaign identifier
+        :param message_id: Message ID to encode as a signed token; falls back to the
+                           legacy query string URL when not given
+        :return: Tracking URL
+        """
+        if message_id is not None:
+            return f"{self.tracking_server}/t/{encode_token(message_id)}"
+        return f"{self.tracking_server}/track?campaign_id={campaign_id}&sender={self.username}&recipient={recipient}"
+
+    def insert_pixel(self, html_body, tracking_url):
+        """
+        Add a tracking pixel image pointing at tracking_url to an HTML body
+        
+        :param html_body: Original HTML body
+        :param tracking_url: Pixel URL
         :return: Modified HTML body with tracking pixel
         """
-        # Build tracking URL using configured server
-        tracking_url = f"{self.tracking_server}/track?campaign_id={campaign_id}&sender={self.username}&recipient={recipient}"
         pixel_tag = f'<img src="{tracking_url}" width="1" height="1" alt="" style="display:none">'
         
         # Add HTML wrapper if not present
@@ -186,148 +321,297 @@ class EmailSender(object):
         else:
             return html_body + pixel_tag
 
-    def send_single_email(self, recipient, subject, body, campaign_id, attachments=None):
+    def add_tracking_pixel(self, html_body, recipient, campaign_id, message_id=None):
         """
-        Send a single email
+        Add tracking pixel to HTML email body
+        
+        :param html_body: Original HTML body
+        :param recipient: Email recipient
+        :param campaign_id: Campaign identifier
+        :param message_id: Message ID to encode as a signed token
+        :return: Modified HTML body with tracking pixel
+        """
+        return self.insert_pixel(html_body, self.tracking_url(recipient, campaign_id, message_id))
+
+    def compile_message(self, subject, body, campaign_id, attachments=None):
+        """
+        Get the campaign's compiled message, serializing it on first use
+        
+        :param subject: Email subject
+        :param body: Email body text
+        :param campaign_id: Campaign identifier
+        :param attachments: List of file paths to attach
+        :return: CompiledMessage
+        """
+        key = (subject, body, campaign_id, tuple(attachments or ()))
+        from_header = '"{}" <{}>'.format(self.username.split('@')[0].capitalize(), self.username)
+        html_body = self.insert_pixel(body, PIXEL_URL_PLACEHOLDER) if self.track_opens else body
+        return self.compiled_messages.get(key, lambda: CompiledMessage(from_header, subject, html_body, attachments))
+
+    def build_message(self, recipient, subject, body, campaign_id, attachments=None, message_id=None):
+        """
+        Build the message for a single recipient from the compiled campaign message
         
         :param recipient: Email address of recipient
         :param subject: Email subject
         :param body: Email body text
         :param campaign_id: Campaign identifier
         :param attachments: List of file paths to attach
+        :param message_id: Message ID for the tracking token
+        :return: List of wire chunks for send_chunks
+        """
+        compiled = self.compile_message(subject, body, campaign_id, attachments)
+        pixel_url = self.tracking_url(recipient, campaign_id, message_id) if self.track_opens else ''
+        return compiled.render(recipient, pixel_url)
+
+    def build_batch_message(self, subject, body, campaign_id, attachments=None):
+        """
+        Build the untracked message sent to a whole batch, addressed to undisclosed recipients
+        
+        :return: List of wire chunks for send_chunks
+        """
+        return self.compile_message(subject, body, campaign_id, attachments).render(UNDISCLOSED_RECIPIENTS, '')
+
+    def record_sent(self, recipient, campaign_id, message_id=None):
+        """
+        Queue a sent email for the tracking database
+        
+        Rows are written in batches by the shared sent_writer thread.
+        
+        :param recipient: Email address of recipient
+        :param campaign_id: Campaign identifier
+        :param message_id: Message ID carried in the tracking token
+        :return: Tuple of (success, error_message)
+        """
+        sent_writer.put({
+            'id': str(uuid.uuid4()),
+            'campaign_id': campaign_id,
+            'sender_email': self.username,
+            'recipient': recipient,
+            'timestamp': datetime.utcnow(),
+            'is_sent': True,
+            'sent_timestamp': datetime.utcnow(),
+            'is_opened': False,
+            'message_id': message_id
+        })
+        logging.info(f'Email sent and queued for tracking - Campaign: {campaign_id}, Sender: {self.username}, Recipient: {recipient}')
+        
+        # Thread-safe increment of sent count
+        with self.lock:
+            self.sent_count += 1
+        
+        return True, None
+
+    def record_interrupted(self):
+        """
+        Count an email that was not attempted because sending was stopped
+
         :return: Tuple of (success, error_message)
         """
+        with self.lock:
+            self.failed_count += 1
+        return False, "Sending interrupted"
+
+    def _handle_failure(self, error_msg, error, email_details, attempt):
+        """
+        Classify a failed attempt and either schedule a retry or count a failure
+        
+        :param error_msg: Message describing the failure
+        :param error: Exception raised by the attempt
+        :param email_details: Tuple (recipient, subject, body, campaign_id, attachments)
+        :param attempt: Number of the attempt that failed
+        :return: (None, error_message) if a retry was scheduled, else (False, error_message)
+        """
+        kind, reason = classify_error(error)
+        if is_throttle(error):
+            self._host_governor().on_throttle()
+        with self.lock:
+            self.error_classes[kind] += 1
+            self.error_reasons[reason] = self.error_reasons.get(reason, 0) + 1
+
+        due = self.retries.schedule(email_details, attempt) if kind == TRANSIENT else None
+        if due is not None:
+            logging.warning(f"{error_msg} - attempt {attempt} failed ({reason}), retry scheduled")
+            if self.on_retry is not None:
+                self.on_retry(email_details, due)
+            return None, error_msg
+
+        logging.error(error_msg)
+        with self.lock:
+            self.failed_count += 1
+            self.error_messages.append(error_msg)
+        return False, error_msg
+
+    def send_single_email(self, recipient, subject, body, campaign_id, attachments=None, attempt=1):
+        """
+        Send a single email
+        
+        :param recipient: Email address of recipient
+        :param subject: Email subject
+        :param body: Email body text
+        :param campaign_id: Campaign identifier
+        :param attachments: List of file paths to attach
+        :param attempt: Attempt number, counted towards the retry limit
+        :return: Tuple of (success, error_message); success is None when a
+                 transient failure was scheduled for retry
+        """
         global STOP_THREADS
         if STOP_THREADS:
-            return False, "Sending interrupted"
+            return self.record_interrupted()
 
         logging.info(f"Starting to send email to {recipient}")
-        smtp = None
-        session = None
+        email_details = (recipient, subject, body, campaign_id, attachments)
         try:
-            # Create message
-            msg = MIMEMultipart()
-            msg['From'] = '"{}" <{}>'.format(self.username.split('@')[0].capitalize(), self.username)
-            msg['To'] = recipient
-            msg['Subject'] = subject
-
-            # Add tracking pixel and attach body
-            tracked_body = self.add_tracking_pixel(body, recipient, campaign_id)
-            msg.attach(MIMEText(tracked_body, 'html'))
-
-            # Attach files
-            if attachments:
-                for filepath in attachments:
-                    if os.path.exists(filepath):
-                        with open(filepath, 'rb') as file:
-                            part = MIMEApplication(file.read(), Name=os.path.basename(filepath))
-                            part['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(filepath))
-                            msg.attach(part)
-                            logging.info(f"Attached file: {filepath}")
-                    else:
-                        logging.warning(f'Attachment file not found - {filepath}')
-
-            # Get SMTP connection
-            logging.info(f"Establishing SMTP connection for {recipient}")
-            smtp = self._get_smtp_connection()
-            
-            # Send email
+            message_id = message_ids.next()
+            message = self.build_message(recipient, subject, body, campaign_id, attachments, message_id)
+
+            # Send email over the pooled SMTP session, within the host's rate and concurrency limits
             logging.info(f"Sending email to {recipient}")
-            smtp.sendmail(self.username, recipient, msg.as_string())
+            governor = self._host_governor()
+            with governor.slot():
+                self._send_pooled(recipient, message)
+            governor.on_success()
             logging.info(f"Email sent successfully to {recipient}")
-            
-            # Record sent email in tracking database
-            engine = sa.create_engine('sqlite:///tracking.db')
-            Base.metadata.create_all(engine)
-            Session = sessionmaker(bind=engine)
-            session = Session()
-            
-            try:
-                logging.info(f"Recording email sent status for {recipient}")
-                # Create new tracking record
-                track = PixelTrack(
-                    id=str(uuid.uuid4()),
-                    campaign_id=campaign_id,
-                    sender_email=self.username,
-                    recipient=recipient,
-                    is_sent=True,
-                    sent_timestamp=datetime.utcnow(),
-                    is_opened=False,
-                    opened_timestamp=None,
-                    user_agent=None,
-                    ip_address=None
-                )
-                session.add(track)
-                session.commit()
-                logging.info(f'Email sent and tracked - Campaign: {campaign_id}, Sender: {self.username}, Recipient: {recipient}')
-                
-                # Thread-safe increment of sent count
-                with self.lock:
-                    self.sent_count += 1
-                
-                return True, None
-                
-            except Exception as e:
-                error_msg = f'Database error while recording sent email: {str(e)}'
-                logging.error(error_msg)
-                session.rollback()
-                with self.lock:
-                    self.error_messages.append(error_msg)
-                return False, error_msg
                 
         except smtplib.SMTPAuthenticationError as e:
-            error_msg = f"SMTP Authentication failed: {str(e)}"
-            logging.error(error_msg)
-            with self.lock:
-                self.error_messages.append(error_msg)
-            return False, error_msg
+            return self._handle_failure(f"SMTP Authentication failed: {str(e)}", e, email_details, attempt)
         except smtplib.SMTPException as e:
-            error_msg = f"SMTP Error: {str(e)}"
-            logging.error(error_msg)
-            with self.lock:
-                self.error_messages.append(error_msg)
-            return False, error_msg
+            return self._handle_failure(f"SMTP Error: {str(e)}", e, email_details, attempt)
         except Exception as e:
-            error_msg = f"Error sending email: {str(e)}"
-            logging.error(error_msg)
+            return self._handle_failure(f"Error sending email: {str(e)}", e, email_details, attempt)
+
+        # Record sent email in tracking database
+        return self.record_sent(recipient, campaign_id, message_id)
+
+    def batch_results(self, batch, refused, attempt=1):
+        """
+        Per-recipient results of a batch transaction: refused recipients fail
+        (or are retried) on their own, the rest are recorded as sent
+        
+        :param batch: List of email_details tuples sent in one transaction
+        :param refused: Dictionary of refused address -> (code, message)
+        :param attempt: Number of the attempt
+        :return: List of (email_details, (success, error_message))
+        """
+        outcomes = []
+        for email_details in batch:
+            recipient, campaign_id = email_details[0], email_details[3]
+            if recipient in refused:
+                code, resp = refused[recipient]
+                if isinstance(resp, bytes):
+                    resp = resp.decode('utf-8', 'replace')
+                error = smtplib.SMTPRecipientsRefused({recipient: (code, resp)})
+                result = self._handle_failure(f"Recipient refused: {recipient} ({code} {resp})",
+                                              error, email_details, attempt)
+            else:
+                result = self.record_sent(recipient, campaign_id)
+            outcomes.append((email_details, result))
+        return outcomes
+
+    def send_batch(self, batch, attempt=1):
+        """
+        Send one untracked message to several recipients in a single SMTP transaction
+        
+        The envelope is pipelined when the server supports it. A failure of the
+        whole transaction is handled for each recipient as if sent one by one.
+        
+        :param batch: List of email_details tuples sharing subject, body, campaign and attachments
+        :param attempt: Attempt number, counted towards the retry limit
+        :return: List of (email_details, (success, error_message))
+        """
+        if STOP_THREADS:
+            return [(email_details, self.record_interrupted()) for email_details in batch]
+
+        recipients = [email_details[0] for email_details in batch]
+        _, subject, body, campaign_id, attachments = batch[0]
+        logging.info(f"Sending email to {len(recipients)} recipients in one transaction")
+        try:
+            message = self.build_batch_message(subject, body, campaign_id, attachments)
+            governor = self._host_governor()
+            with governor.slot():
+                refused = self._send_pooled(recipients, message)
+            governor.on_success()
+        except smtplib.SMTPRecipientsRefused as e:
+            if len(e.recipients) < len(recipients):
+                # Session closed (421) partway through the envelope; nothing was sent
+                return [(email_details, self._handle_failure(f"SMTP Error: {str(e)}", e, email_details, attempt))
+                        for email_details in batch]
+            refused = e.recipients
+        except smtplib.SMTPException as e:
+            return [(email_details, self._handle_failure(f"SMTP Error: {str(e)}", e, email_details, attempt))
+                    for email_details in batch]
+        except Exception as e:
+            return [(email_details, self._handle_failure(f"Error sending email: {str(e)}", e, email_details, attempt))
+                    for email_details in batch]
+        return self.batch_results(batch, refused, attempt)
+
+    def batch_emails(self, email_list):
+        """
+        Group emails into batches of identical messages per recipient domain
+        
+        Used when tracking is off. Emails of a domain are held back until their
+        batch is full, or until MAX_OPEN_BATCHES domains are waiting, so memory
+        stays bounded for streamed lists. A batch of one is yielded as a plain tuple.
+        
+        :param email_list: Iterable of email_details tuples
+        :return: Generator of email_details tuples and lists of them
+        """
+        batches = OrderedDict()
+        for email_details in email_list:
+            recipient, subject, body, campaign_id, attachments = email_details
+            key = (recipient.rsplit('@', 1)[-1].lower(), subject, body, campaign_id, tuple(attachments or ()))
+            batch = batches.setdefault(key, [])
+            batch.append(email_details)
+            if len(batch) >= self.max_recipients_per_message:
+                yield batches.pop(key)
+            elif len(batches) > MAX_OPEN_BATCHES:
+                batch = batches.popitem(last=False)[1]
+                yield batch if len(batch) > 1 else batch[0]
+        for batch in batches.values():
+            yield batch if len(batch) > 1 else batch[0]
+
+    def _process(self, item, attempt=1):
+        """
+        Send one queued email or batch and report results unless deferred for retry
+        """
+        if isinstance(item, list):
+            outcomes = self.send_batch(item, attempt)
+        else:
+            outcomes = [(item, self.send_single_email(*item, attempt=attempt))]
+        for email_details, (success, error) in outcomes:
+            if success is None:
+                continue
             with self.lock:
-                self.error_messages.append(error_msg)
-            return False, error_msg
-            
-        finally:
-            # Thread-safe increment of failed count if needed
-            if not smtp or not session:
-                with self.lock:
-                    self.failed_count += 1
-            
-            # Close database session
-            if session:
-                try:
-                    session.close()
-                except Exception as e:
-                    logging.error(f'Error closing database session: {str(e)}')
-                
-            # Close SMTP connection
-            if smtp:
-                try:
-                    smtp.quit()
-                except Exception as e:
-                    logging.error(f'Error closing SMTP connection: {str(e)}')
+                self.results.append((success, error))
+            if self.on_result is not None:
+                self.on_result(email_details, success, error, attempt)
 
     def worker(self):
         """
         Worker thread to process email queue
+        
+        Due retries are taken before new messages, but only once their backoff
+        has passed, so retries never hold up first attempts.
         """
         global STOP_THREADS
         while not STOP_THREADS:
             try:
-                email_details = self.queue.get(timeout=1)
+                retry = self.retries.pop_due()
+                if retry is not None:
+                    try:
+                        self._process(*retry)
+                    finally:
+                        self.retries.done()
+                    continue
+
+                email_details = self.queue.get(timeout=self.retries.wait_time())
                 if email_details is None:
+                    self.queue.task_done()
                     break
-                success, error = self.send_single_email(*email_details)
-                with self.lock:
-                    self.results.append((success, error))
-                self.queue.task_done()
+                try:
+                    self._process(email_details)
+                finally:
+                    self.queue.task_done()
             except queue.Empty:
                 continue
             except Exception as e:
@@ -338,11 +622,26 @@ class EmailSender(object):
                     self.error_messages.append(error_msg)
                 break
 
+    def _enqueue(self, email_details):
+        """
+        Put an email on the bounded queue, giving up if sending is interrupted
+        
+        :return: False if STOP_THREADS was set while waiting
+        """
+        while not STOP_THREADS:
+            try:
+                self.queue.put(email_details, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
     def send_emails_threaded(self, email_list):
         """
         Send multiple emails using thread pool
         
-        :param email_list: List of tuples (recipient, subject, body, campaign_id, attachments)
+        :param email_list: Iterable of tuples (recipient, subject, body, campaign_id, attachments);
+                           consumed lazily, so it can be a generator over a streamed list
         """
         global STOP_THREADS
         STOP_THREADS = False
@@ -352,6 +651,10 @@ class EmailSender(object):
         self.failed_count = 0
         self.results = []
         self.error_messages = []
+        self.error_classes = {TRANSIENT: 0, PERMANENT: 0}
+        self.error_reasons = {}
+        self.retries.clear()
+        self.compiled_messages.clear()
 
         # Create worker threads
         threads = []
@@ -361,54 +664,54 @@ class EmailSender(object):
             t.start()
             threads.append(t)
 
-        # Add emails to queue
-        for email_details in email_list:
-            if STOP_THREADS:
+        # Add emails to queue, waiting for the workers when it is full
+        total_count = 0
+        items = email_list if self.track_opens else self.batch_emails(email_list)
+        for item in items:
+            if not self._enqueue(item):
                 break
-            self.queue.put(email_details)
-
-        # Add stop signals
-        for _ in range(self.max_workers):
-            self.queue.put(None)
+            total_count += len(item) if isinstance(item, list) else 1
 
-        # Wait for all tasks to complete or interruption
+        # Wait for all tasks, and the retries they scheduled, to complete or interruption
         try:
             self.queue.join()
+            while not STOP_THREADS and not self.retries.idle():
+                time.sleep(0.2)
         except KeyboardInterrupt:
             STOP_THREADS = True
         finally:
             # Stop worker threads
+            for _ in range(self.max_workers):
+                try:
+                    self.queue.put_nowait(None)
+                except queue.Full:
+                    break
             for t in threads:
                 t.join(timeout=2)
+            self.smtp_pool.close_all()
+            # Make sure every sent row is in tracking.db before reporting
+            sent_writer.flush()
 
         # Log summary
-        logging.info('Email sending completed. Sent: {}, Failed: {}'.format(
-            self.sent_count, self.failed_count))
+        pool_stats = self.smtp_pool.stats()
+        logging.info('Email sending completed. Sent: {}, Failed: {}, SMTP pool hits: {}, misses: {}'.format(
+            self.sent_count, self.failed_count, pool_stats['hits'], pool_stats['misses']))
         
         # Return comprehensive results
         return {
             'success_count': self.sent_count,
             'failure_count': self.failed_count,
-            'total_count': len(email_list),
+            'total_count': total_count,
             'results': self.results,
-            'error_messages': list(set(self.error_messages))  # Unique error messages
+            'error_messages': list(set(self.error_messages)),  # Unique error messages
+            'smtp_pool': pool_stats,
+            'errors_by_class': dict(self.error_classes, reasons=dict(self.error_reasons)),
+            'retries': self.retries.stats(),
+            'governor': self._host_governor().stats(),
+            'tracking_writer': sent_writer.stats(),
+            'attachment_cache': attachment_cache.stats()
         }
 
-email_queue = queue.Queue()
-
-def process_queue():
-    while True:
-        email_data = email_queue.get()
-        try:
-            # Existing send logic
-            EmailSender.send_single_email(**email_data)
-        except Exception as e:
-            logging.error(f'Async send failed: {str(e)}')
-        email_queue.task_done()
-
-# Start worker thread
-Thread(target=process_queue, daemon=True).start()
-
 def read_file_lines(filepath):
     """
     Read lines from a file, stripping whitespace and removing empty lines
@@ -429,16 +732,12 @@ def parse_recipients(recipients_input, recipients_file=None):
     
     :param recipients_input: Comma-separated list of recipients
     :param recipients_file: Path to recipients file
-    :return: List of recipient email addresses
+    :return: RecipientSource yielding validated recipient email addresses in input
+             order, with duplicates removed (counted in its duplicates attribute)
     """
-    recipients = []
-    
     if recipients_file:
-        recipients = read_file_lines(recipients_file)
-    elif recipients_input:
-        recipients = [r.strip() for r in recipients_input.split(',') if r.strip()]
-        
-    return list(set(recipients))  # Remove duplicates
+        return RecipientSource.from_file(recipients_file)
+    return RecipientSource.from_text(recipients_input or '')
 
 def main():
     try:
@@ -463,10 +762,10 @@ def main():
             print("No valid accounts found. Exiting.")
             return
         
-        # Read recipients
-        recipients = read_file_lines(recipients_file)
+        # Recipients are streamed from the file while sending
+        recipients = parse_recipients(None, recipients_file)
         
-        if not recipients:
+        if recipients.is_empty():
             print("No recipients found. Exiting.")
             return
         
@@ -501,8 +800,8 @@ def main():
         # Add tracking pixel to body
         full_body = body + '\n\n' + tracking_pixel
         
-        # Prepare email list
-        email_list = [(recipient, subject, full_body, campaign_id, attachments or None) for recipient in recipients]
+        def email_list():
+            return ((recipient, subject, full_body, campaign_id, attachments or None) for recipient in recipients)
         
         # Select accounts to use
         print("\nAvailable Accounts:")
@@ -518,20 +817,29 @@ def main():
             except (ValueError, IndexError):
                 print("Invalid selection. Please try again.")
         
+        # Pick the sending engine (MAILER_ENGINE=asyncio for the event loop engine)
+        sender_class = EmailSender
+        if os.environ.get('MAILER_ENGINE') == 'asyncio':
+            from async_mailer import AsyncEmailSender
+            sender_class = AsyncEmailSender
+        
+        # MAILER_TRACK_OPENS=0 drops the per-recipient pixel so recipients can share one transaction
+        track_opens = os.environ.get('MAILER_TRACK_OPENS', '1') != '0'
+        
         # Send emails from selected accounts
         for username, password in selected_accounts:
             print("\nSending emails from {}".format(username))
-            sender = EmailSender(username, password)
-            results = sender.send_emails_threaded(email_list)
+            sender = sender_class(username, password, track_opens=track_opens)
+            results = sender.send_emails_threaded(email_list())
             print("\nEmail sending results:")
             for success, error in results['results']:
-                if success:
-                    print(f"Email sent successfully to {email_list[results['results'].index((success, error))][0]}")
-                else:
-                    print(f"Email sending failed to {email_list[results['results'].index((success, error))][0]}: {error}")
+                if not success:
+                    print(f"Email sending failed: {error}")
             print(f"\nTotal emails sent: {results['success_count']}")
             print(f"Total emails failed: {results['failure_count']}")
             print(f"Total emails attempted: {results['total_count']}")
+            if recipients.duplicates:
+                print(f"Duplicate recipients skipped: {recipients.duplicates}")
             print(f"Error messages: {', '.join(results['error_messages'])}")
 
     except KeyboardInterrupt:
@@ -0,0 +1,59 @@
+import datetime
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+# Database Setup
+Base = declarative_base()
+
+class PixelTrack(Base):
+    __tablename__ = 'pixel_tracks'
+    
+    id = sa.Column(sa.String, primary_key=True)
+    campaign_id = sa.Column(sa.String)
+    sender_email = sa.Column(sa.String, nullable=True)  # Make nullable for backward compatibility
+    recipient = sa.Column(sa.String, nullable=True)     # Make nullable for backward compatibility
+    timestamp = sa.Column(sa.DateTime, default=datetime.datetime.utcnow)
+    user_agent = sa.Column(sa.String, nullable=True)
+    ip_address = sa.Column(sa.String, nullable=True)
+    device_info = sa.Column(sa.String, nullable=True)   # Make nullable for backward compatibility
+    location = sa.Column(sa.String, nullable=True)      # Make nullable for backward compatibility
+    is_sent = sa.Column(sa.Boolean, default=False)      # Track if email was sent successfully
+    is_opened = sa.Column(sa.Boolean, default=False)    # Track if email was opened
+    sent_timestamp = sa.Column(sa.DateTime, nullable=True)  # When the email was sent
+    opened_timestamp = sa.Column(sa.DateTime, nullable=True)  # When the email was opened
+    message_id = sa.Column(sa.Integer, nullable=True)   # Compact ID carried in signed tracking tokens
+
+    __table_args__ = (
+        # One row per message; serves pixel lookups and the dashboard's
+        # group_by(campaign_id, sender_email) through its prefix
+        sa.Index('ix_pixel_tracks_campaign_sender_recipient',
+                 'campaign_id', 'sender_email', 'recipient', unique=True),
+        # Per-user stats filter on sender_email
+        sa.Index('ix_pixel_tracks_sender_campaign', 'sender_email', 'campaign_id'),
+        # Token opens update by message_id
+        sa.Index('ix_pixel_tracks_message_id', 'message_id', unique=True),
+        # Keyset pages of a campaign's recipients, one index per sort order;
+        # the implicit trailing rowid is the tie-breaker
+        sa.Index('ix_pixel_tracks_campaign_recipient', 'campaign_id', 'recipient'),
+        sa.Index('ix_pixel_tracks_campaign_opened_recipient', 'campaign_id', 'is_opened', 'recipient'),
+        sa.Index('ix_pixel_tracks_campaign_open_time', 'campaign_id', 'opened_timestamp'),
+    )
+
+class IdSequence(Base):
+    __tablename__ = 'id_sequences'
+
+    name = sa.Column(sa.String, primary_key=True)
+    next_value = sa.Column(sa.Integer, nullable=False, default=1)
+
+class CampaignRollup(Base):
+    __tablename__ = 'campaign_rollups'
+
+    # Maintained by triggers on pixel_tracks (see campaign_rollups.py); NULL keys are stored as ''
+    campaign_id = sa.Column(sa.String, primary_key=True)
+    sender_email = sa.Column(sa.String, primary_key=True)
+    tracks = sa.Column(sa.Integer, nullable=False, default=0)      # pixel_tracks rows in the group
+    recipients = sa.Column(sa.Integer, nullable=False, default=0)  # Rows with a recipient, one per message
+    sent = sa.Column(sa.Integer, nullable=False, default=0)
+    opened = sa.Column(sa.Integer, nullable=False, default=0)
+    first_open = sa.Column(sa.DateTime, nullable=True)
+    last_open = sa.Column(sa.DateTime, nullable=True)
@@ -0,0 +1,27 @@
+import base64
+
+# Create a 1x1 transparent GIF pixel
+PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# Fixed headers for every pixel response; the body never changes, so
+# there is nothing for mimetype guessing, etags or range handling to do
+PIXEL_HEADERS = (
+    ('Content-Type', 'image/gif'),
+    ('Content-Length', str(len(PIXEL_GIF))),
+    ('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0'),
+    ('Pragma', 'no-cache'),
+    ('Expires', '0'),
+)
+
+# Body as a one-item iterable so the response skips set_data/len per hit
+PIXEL_BODY = (PIXEL_GIF,)
+
+
+def pixel_response(response_class):
+    """
+    Build the pixel response from the prebuilt body and headers
+
+    :param response_class: Response class to instantiate, e.g. app.response_class
+    :return: Response for the 1x1 GIF
+    """
+    return response_class(PIXEL_BODY, status=200, headers=PIXEL_HEADERS)
@@ -1,42 +1,23 @@
-import base64
 import logging
 import os
 import json
 import datetime
 import uuid
-from flask import Flask, send_file, request, jsonify
+from flask import Flask, request, jsonify
 import sqlalchemy as sa
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
-import io
 import pytz
 
-# Database Setup
-Base = declarative_base()
-
-class PixelTrack(Base):
-    __tablename__ = 'pixel_tracks'
-    
-    id = sa.Column(sa.String, primary_key=True)
-    campaign_id = sa.Column(sa.String)
-    sender_email = sa.Column(sa.String, nullable=True)  # Make nullable for backward compatibility
-    recipient = sa.Column(sa.String, nullable=True)     # Make nullable for backward compatibility
-    timestamp = sa.Column(sa.DateTime, default=datetime.datetime.utcnow)
-    user_agent = sa.Column(sa.String, nullable=True)
-    ip_address = sa.Column(sa.String, nullable=True)
-    device_info = sa.Column(sa.String, nullable=True)   # Make nullable for backward compatibility
-    location = sa.Column(sa.String, nullable=True)      # Make nullable for backward compatibility
-    is_sent = sa.Column(sa.Boolean, default=False)      # Track if email was sent successfully
-    is_opened = sa.Column(sa.Boolean, default=False)    # Track if email was opened
-    sent_timestamp = sa.Column(sa.DateTime, nullable=True)  # When the email was sent
-    opened_timestamp = sa.Column(sa.DateTime, nullable=True)  # When the email was opened
+from models import PixelTrack
+from db import tracking_db, TRACKING_DB_PATH
+from tracking_store import open_row, open_buffer, get_device_info
+from pixel import pixel_response
+from stats_cache import stats_cache, TRACKING
 
 # Ensure log and tracking data can be stored in the current directory
 current_dir = os.path.dirname(os.path.abspath(__file__))
 log_path = os.path.join(current_dir, 'tracking_logs', 'pixel_tracking.log')
 tracking_data_path = os.path.join(current_dir, 'tracking_logs', 'tracking_data.json')
-db_path = os.path.join(current_dir, 'tracking.db')
+db_path = TRACKING_DB_PATH
 
 # Ensure tracking_logs directory exists
 if not os.path.exists(os.path.join(current_dir, 'tracking_logs')):
@@ -50,70 +31,11 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-# Create SQLAlchemy engine and session
-engine = sa.create_engine('sqlite:///{}'.format(db_path))
-
-def migrate_database():
-    """
-    Migrate database schema if needed
-    """
-    try:
-        # Attempt to query existing table to check schema
-        connection = engine.connect()
-        connection.execute("PRAGMA table_info(pixel_tracks)")
-        
-        # Check for new columns
-        try:
-            connection.execute("SELECT sender_email FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            # Column doesn't exist, add it
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN sender_email TEXT")
-        
-        try:
-            connection.execute("SELECT recipient FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN recipient TEXT")
-        
-        try:
-            connection.execute("SELECT device_info FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN device_info TEXT")
-        
-        try:
-            connection.execute("SELECT location FROM pixel_tracks LIMIT 1")
-        except OperationalError:
-            connection.execute("ALTER TABLE pixel_tracks ADD COLUMN location TEXT")
-        
-        connection.close()
-    except Exception as e:
-        logging.error('Database migration error: {}'.format(e))
-        # If migration fails, recreate the table
-        Base.metadata.drop_all(engine)
-        Base.metadata.create_all(engine)
-
-# Create tables and migrate if needed
-migrate_database()
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-# Create a 1x1 transparent GIF pixel
-PIXEL_GIF = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+# Shared scoped session; the engine, migrations and create_all live in db.py
+Session = tracking_db.Session
 
 app = Flask(__name__)
 
-def get_device_info(user_agent):
-    """
-    Extract basic device information from user agent
-    """
-    user_agent = user_agent.lower()
-    if 'mobile' in user_agent:
-        return 'Mobile'
-    elif 'tablet' in user_agent:
-        return 'Tablet'
-    elif 'windows' in user_agent or 'macintosh' in user_agent or 'linux' in user_agent:
-        return 'Desktop'
-    return 'Unknown'
-
 def track_pixel():
     """
     Track email engagement with comprehensive data collection
@@ -139,58 +61,24 @@ def track_pixel():
         'device_info': get_device_info(user_agent)
     }
     
-    # Save to database
-    session = Session()
-    try:
-        # Try to find existing record for this email
-        existing_track = session.query(PixelTrack).filter(
-            PixelTrack.campaign_id == campaign_id,
-            PixelTrack.sender_email == sender_email,
-            PixelTrack.recipient == recipient
-        ).first()
-        
-        if existing_track:
-            # Update existing record to mark as opened
-            existing_track.is_opened = True
-            existing_track.opened_timestamp = datetime.datetime.utcnow()
-            existing_track.user_agent = tracking_info['user_agent']
-            existing_track.ip_address = tracking_info['ip_address']
-            existing_track.device_info = tracking_info['device_info']
-        else:
-            # Create new record
-            pixel_track = PixelTrack(
-                id=track_id,
-                campaign_id=campaign_id,
-                sender_email=sender_email,
-                recipient=recipient,
-                user_agent=tracking_info['user_agent'],
-                ip_address=tracking_info['ip_address'],
-                device_info=tracking_info['device_info'],
-                is_opened=True,
-                opened_timestamp=datetime.datetime.utcnow()
-            )
-            session.add(pixel_track)
-            
-        session.commit()
-    except Exception as e:
-        logging.error('Database tracking error: {}'.format(e))
-        session.rollback()
-    finally:
-        session.close()
+    # Queue for the background writer; the pixel is returned without waiting on SQLite
+    if not open_buffer.put(open_row(
+        campaign_id,
+        sender_email,
+        recipient,
+        user_agent=tracking_info['user_agent'],
+        ip_address=tracking_info['ip_address'],
+        device_info=tracking_info['device_info']
+    )):
+        logging.error('Open event buffer full, dropped: {}'.format(tracking_info))
     
     # Log tracking
     logging.info('Pixel tracked: {}'.format(tracking_info))
     
     # Return transparent pixel
-    return send_file(
-        io.BytesIO(PIXEL_GIF),
-        mimetype='image/gif'
-    )
+    return pixel_response(app.response_class)
 
-def get_tracking_stats():
-    """
-    Provide comprehensive tracking statistics
-    """
+def _tracking_stats():
     session = Session()
     try:
         # Aggregate tracking data
@@ -201,9 +89,9 @@ def get_tracking_stats():
             sa.func.min(PixelTrack.timestamp).label('first_open'),
             sa.func.max(PixelTrack.timestamp).label('last_open')
         ).group_by(PixelTrack.campaign_id).all()
-        
+
         # Convert to list of dictionaries
-        stats_list = [
+        return [
             {
                 'campaign_id': stat[0],
                 'unique_recipients': stat[1],
@@ -212,13 +100,18 @@ def get_tracking_stats():
                 'last_open': stat[4]
             } for stat in stats
         ]
-        
-        return jsonify(stats_list)
+    finally:
+        session.close()
+
+def get_tracking_stats():
+    """
+    Provide comprehensive tracking statistics
+    """
+    try:
+        return jsonify(stats_cache.get_or_compute('tracking_stats', [TRACKING], _tracking_stats))
     except Exception as e:
         logging.error('Error retrieving tracking stats: {}'.format(e))
         return jsonify({'error': str(e)}), 500
-    finally:
-        session.close()
 
 # Define routes
 @app.route('/track')
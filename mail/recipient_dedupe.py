@@ -0,0 +1,163 @@
+import os
+import math
+import sqlite3
+import logging
+import tempfile
+from hashlib import blake2b
+
+
+def dedupe_key(address):
+    """
+    Comparison key for an address: surrounding whitespace removed, case folded
+    """
+    return address.strip().lower()
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, fp_rate=0.001):
+        """
+        Fixed-size Bloom filter over strings
+
+        :param capacity: Number of items the filter is sized for
+        :param fp_rate: Target false positive rate at capacity
+        """
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """
+        Add key to the filter
+
+        :return: True if key may already have been present
+        """
+        present = True
+        for pos in self._positions(key):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] |= mask
+        return present
+
+
+class SpillSet(object):
+    def __init__(self, spill_dir=None):
+        """
+        Exact set of strings kept in a temporary SQLite file
+
+        The primary key B-tree keeps the keys sorted on disk, so lookups stay
+        logarithmic without holding the keys in memory.
+
+        :param spill_dir: Directory for the temp file, defaults to the system temp dir
+        """
+        fd, self.path = tempfile.mkstemp(dir=spill_dir, prefix='recipients-seen-', suffix='.db')
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=OFF')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE seen (key TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def update(self, keys):
+        self.conn.executemany('INSERT OR IGNORE INTO seen (key) VALUES (?)', ((key,) for key in keys))
+
+    def add(self, key):
+        """
+        Add key to the set
+
+        :return: True if key was already present
+        """
+        return self.conn.execute('INSERT OR IGNORE INTO seen (key) VALUES (?)', (key,)).rowcount == 0
+
+    def close(self):
+        self.conn.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RecipientDeduplicator(object):
+    def __init__(self, threshold=None, mode=None, fp_rate=0.001, expected_items=10000000, spill_dir=None):
+        """
+        Order-preserving duplicate filter for a stream of addresses
+
+        Keys live in an in-memory set until threshold distinct addresses
+        have been seen, then move to the configured backend:
+
+        - 'spill': exact, disk-backed set in a temporary SQLite file
+        - 'bloom': Bloom filter sized for expected_items at fp_rate. A false
+          positive drops a unique address, so only use it where that is acceptable.
+
+        :param threshold: Distinct addresses kept in memory, defaults to RECIPIENT_DEDUPE_THRESHOLD or 1,000,000
+        :param mode: 'spill' or 'bloom', defaults to RECIPIENT_DEDUPE_MODE or 'spill'
+        :param fp_rate: Bloom filter false positive rate
+        :param expected_items: Bloom filter capacity
+        :param spill_dir: Directory for the spill file
+        """
+        self.threshold = threshold or int(os.environ.get('RECIPIENT_DEDUPE_THRESHOLD', 1000000))
+        self.mode = mode or os.environ.get('RECIPIENT_DEDUPE_MODE', 'spill')
+        if self.mode not in ('spill', 'bloom'):
+            raise ValueError("mode must be 'spill' or 'bloom'")
+        self.fp_rate = fp_rate
+        self.expected_items = expected_items
+        self.spill_dir = spill_dir
+        self.keys = set()
+        self.backend = None
+        self.duplicates = 0
+
+    def _switch_backend(self):
+        if self.mode == 'bloom':
+            backend = BloomFilter(max(self.expected_items, len(self.keys) * 2), self.fp_rate)
+            for key in self.keys:
+                backend.add(key)
+        else:
+            backend = SpillSet(self.spill_dir)
+            backend.update(self.keys)
+        logging.info('Recipient dedupe moved {} addresses to the {} backend'.format(len(self.keys), self.mode))
+        self.keys = set()
+        self.backend = backend
+
+    def seen(self, address):
+        """
+        Record an address
+
+        :return: True if it (or a case/whitespace variant) was seen before
+        """
+        key = dedupe_key(address)
+        if self.backend is not None:
+            duplicate = self.backend.add(key)
+        elif key in self.keys:
+            duplicate = True
+        else:
+            duplicate = False
+            self.keys.add(key)
+            if len(self.keys) >= self.threshold:
+                self._switch_backend()
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
+
+    def filter(self, addresses):
+        """
+        Yield addresses in input order, skipping ones seen before
+        """
+        try:
+            for address in addresses:
+                if not self.seen(address):
+                    yield address
+        finally:
+            self.close()
+
+    def close(self):
+        if isinstance(self.backend, SpillSet):
+            self.backend.close()
+        self.backend = None
+        self.keys = set()
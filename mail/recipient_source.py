@@ -0,0 +1,142 @@
+import os
+import re
+import shutil
+import logging
+import tempfile
+
+from recipient_dedupe import RecipientDeduplicator
+
+# Deliberately loose: one @, no whitespace or list separators, a dot in the domain
+EMAIL_RE = re.compile(r'^[^@\s,;<>"]+@[^@\s,;<>"]+\.[^@\s,;<>".]+$')
+
+# Separators accepted between addresses on one line
+SEPARATORS_RE = re.compile(r'[,;\s]+')
+
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+
+def normalize_address(value):
+    """
+    Normalize one address: strip whitespace and angle brackets, lowercase the domain
+
+    :param value: Raw address text
+    :return: Normalized address, or None if it does not look like an email address
+    """
+    address = value.strip().strip('<>').strip()
+    if not EMAIL_RE.match(address):
+        return None
+    local, domain = address.rsplit('@', 1)
+    return '{}@{}'.format(local, domain.lower())
+
+
+class RecipientSource(object):
+    def __init__(self, open_lines, name='recipients', dedupe=True):
+        """
+        Re-iterable stream of validated, normalized recipient addresses
+
+        Lines are read lazily, so memory use does not depend on the list size.
+
+        :param open_lines: Callable returning a fresh iterable of text lines
+        :param name: Label used in log messages
+        :param dedupe: Skip repeated addresses (case-insensitive), keeping the first occurrence
+        """
+        self.open_lines = open_lines
+        self.name = name
+        self.dedupe = dedupe
+        self.valid = 0
+        self.invalid = 0
+        self.duplicates = 0
+
+    @classmethod
+    def from_file(cls, filepath, dedupe=True):
+        """
+        Source reading one or more addresses per line from a text file
+        """
+        def open_lines():
+            with open(filepath, 'r', encoding='utf-8-sig', errors='replace') as file:
+                for line in file:
+                    yield line
+        return cls(open_lines, name=filepath, dedupe=dedupe)
+
+    @classmethod
+    def from_text(cls, text, dedupe=True):
+        """
+        Source for comma or newline separated addresses typed into a form
+        """
+        return cls(lambda: iter(text.splitlines()), name='manual input', dedupe=dedupe)
+
+    def __iter__(self):
+        addresses = self._validated()
+        self.duplicates = 0
+        if not self.dedupe:
+            for address in addresses:
+                yield address
+            return
+
+        deduplicator = RecipientDeduplicator()
+        for address in deduplicator.filter(addresses):
+            self.duplicates = deduplicator.duplicates
+            yield address
+        self.duplicates = deduplicator.duplicates
+        if self.duplicates:
+            logging.info('Removed {} duplicate recipients from {}'.format(self.duplicates, self.name))
+
+    def _validated(self):
+        self.valid = 0
+        self.invalid = 0
+        for line in self.open_lines():
+            for value in SEPARATORS_RE.split(line):
+                if not value:
+                    continue
+                address = normalize_address(value)
+                if address is None:
+                    self.invalid += 1
+                    if self.invalid <= 10:
+                        logging.warning('Skipping invalid recipient in {}: {}'.format(self.name, value))
+                    continue
+                self.valid += 1
+                yield address
+        if self.invalid:
+            logging.warning('Skipped {} invalid recipients in {}'.format(self.invalid, self.name))
+
+    def chunks(self, size=1000):
+        """
+        Yield addresses in lists of at most size items
+        """
+        chunk = []
+        for address in self:
+            chunk.append(address)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def is_empty(self):
+        """
+        True if the source yields no valid address; stops reading at the first one
+        """
+        for _ in self:
+            return False
+        return True
+
+
+def spool_upload(file_storage, spool_dir=None):
+    """
+    Copy an uploaded file to a temp file in fixed-size chunks
+
+    The upload is never held in memory as a whole; the caller removes the
+    returned file when it is done with it.
+
+    :param file_storage: werkzeug FileStorage
+    :param spool_dir: Directory for the spool file, defaults to the system temp dir
+    :return: Path of the spool file
+    """
+    with tempfile.NamedTemporaryFile(dir=spool_dir, prefix='recipients-', suffix='.txt', delete=False) as spool:
+        try:
+            shutil.copyfileobj(file_storage.stream, spool, SPOOL_CHUNK_SIZE)
+        except Exception:
+            spool.close()
+            os.remove(spool.name)
+            raise
+        return spool.name
@@ -0,0 +1,163 @@
+import heapq
+import random
+import smtplib
+import socket
+import threading
+import time
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Auth codes that mean the credentials are wrong, not that the server is busy
+AUTH_FAILURE_CODES = (530, 534, 535)
+
+
+def _reply_class(code):
+    if 400 <= code < 500:
+        return TRANSIENT, '{}xx'.format(code // 100)
+    return PERMANENT, '{}xx'.format(code // 100) if code >= 500 else 'unknown_reply'
+
+
+def classify_error(error):
+    """
+    Classify a send failure as transient (worth retrying) or permanent
+
+    Works for smtplib and aiosmtplib exceptions, which carry the SMTP reply
+    code in smtp_code and code respectively.
+
+    :param error: Exception raised while sending
+    :return: Tuple of (TRANSIENT or PERMANENT, reason label)
+    """
+    name = type(error).__name__
+    code = getattr(error, 'smtp_code', None)
+    if code is None and type(error).__module__.startswith('aiosmtplib'):
+        code = getattr(error, 'code', None)
+
+    if name == 'SMTPRecipientsRefused':
+        refused = error.recipients
+        # smtplib maps address -> (code, msg); aiosmtplib keeps a list of exceptions
+        codes = [reply[0] for reply in refused.values()] if isinstance(refused, dict) \
+            else [getattr(each, 'code', 0) for each in refused]
+        if codes and all(400 <= code < 500 for code in codes):
+            return TRANSIENT, 'recipient_4xx'
+        return PERMANENT, 'recipient_rejected'
+    if name == 'SMTPAuthenticationError':
+        # The senders report connection failures as SMTPAuthenticationError(-1, ...)
+        if code in AUTH_FAILURE_CODES:
+            return PERMANENT, 'auth'
+        if code == -1:
+            return TRANSIENT, 'connection'
+    if isinstance(error, smtplib.SMTPServerDisconnected) or name == 'SMTPServerDisconnected':
+        return TRANSIENT, 'disconnected'
+    if isinstance(code, int) and code > 0:
+        return _reply_class(code)
+
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return TRANSIENT, 'timeout'
+    if isinstance(error, (ConnectionError, OSError)):
+        return TRANSIENT, 'connection'
+    if name in ('SMTPConnectError', 'SMTPTimeoutError', 'SMTPReadTimeoutError', 'SMTPConnectTimeoutError'):
+        return TRANSIENT, 'connection'
+    return PERMANENT, 'other'
+
+
+class RetryScheduler(object):
+    def __init__(self, max_attempts=4, base_delay=30.0, max_delay=300.0, jitter=0.5):
+        """
+        Time-ordered heap of messages waiting to be retried
+
+        Delays grow exponentially (base_delay * 2^(attempt-1), capped at
+        max_delay) and are spread by +/- jitter so retries of a throttled
+        batch do not all land at once.
+
+        :param max_attempts: Attempts per message, including the first
+        :param base_delay: Delay before the first retry (seconds)
+        :param max_delay: Longest delay between attempts (seconds)
+        :param jitter: Random fraction added to or removed from each delay
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.heap = []
+        self.sequence = 0
+        self.active = 0
+        self.scheduled = 0
+        self.exhausted = 0
+
+    def delay(self, attempt):
+        """
+        Backoff before the attempt after `attempt`
+        """
+        delay = min(self.base_delay * (2 ** (attempt - 1)), self.max_delay)
+        return max(delay * (1 + random.uniform(-self.jitter, self.jitter)), 0)
+
+    def schedule(self, item, attempt):
+        """
+        Queue item for another attempt if it has attempts left
+
+        :param item: Message details to hand back from pop_due
+        :param attempt: Number of the attempt that just failed
+        :return: Time the retry is due, or None if max_attempts is used up
+        """
+        with self.lock:
+            if attempt >= self.max_attempts:
+                self.exhausted += 1
+                return None
+            self.sequence += 1
+            due = time.time() + self.delay(attempt)
+            heapq.heappush(self.heap, (due, self.sequence, item, attempt + 1))
+            self.scheduled += 1
+            return due
+
+    def pop_due(self):
+        """
+        Take the earliest retry whose time has come; call done() after handling it
+
+        :return: Tuple of (item, attempt), or None if nothing is due
+        """
+        with self.lock:
+            if not self.heap or self.heap[0][0] > time.time():
+                return None
+            _, _, item, attempt = heapq.heappop(self.heap)
+            self.active += 1
+            return item, attempt
+
+    def done(self):
+        with self.lock:
+            self.active -= 1
+
+    def wait_time(self, default=1.0):
+        """
+        Seconds until the next retry is due, at most default
+        """
+        with self.lock:
+            if not self.heap:
+                return default
+            return min(max(self.heap[0][0] - time.time(), 0), default)
+
+    def idle(self):
+        """
+        True when no retry is waiting or being handled
+        """
+        with self.lock:
+            return not self.heap and not self.active
+
+    def clear(self):
+        """
+        Drop waiting retries and reset the counters
+        """
+        with self.lock:
+            self.heap = []
+            self.active = 0
+            self.scheduled = 0
+            self.exhausted = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'scheduled': self.scheduled,
+                'exhausted': self.exhausted,
+                'waiting': len(self.heap)
+            }
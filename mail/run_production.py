@@ -1,12 +1,20 @@
 from waitress import serve
 from app import app
+from live_updates import live_updates
 import argparse
 
+# Threads kept free for ordinary requests; the rest may hold live dashboard streams
+RESERVED_THREADS = 8
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=3000)
     parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--threads', type=int, default=64)
     args = parser.parse_args()
-    
+
+    # Each open /dashboard/stream holds one waitress thread
+    live_updates.max_subscribers = min(live_updates.max_subscribers, max(1, args.threads - RESERVED_THREADS))
+
     print(f"Starting production server on {args.host}:{args.port}")
-    serve(app, host=args.host, port=args.port) 
\ No newline at end of file
+    serve(app, host=args.host, port=args.port, threads=args.threads)
@@ -0,0 +1,378 @@
+import time
+import atexit
+import logging
+import threading
+
+from db import mailer_db
+from tracking_store import BatchWriter
+
+# Message states
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+SENT = 'sent'
+FAILED = 'failed'
+
+CREATE_QUEUE_TABLE = """
+CREATE TABLE IF NOT EXISTS send_queue (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    last_error TEXT,
+    updated_at REAL
+)
+"""
+CREATE_QUEUE_INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS ix_send_queue_job_recipient ON send_queue (job_id, recipient)',
+    'CREATE INDEX IF NOT EXISTS ix_send_queue_job_state ON send_queue (job_id, state, id)',
+)
+
+# Claimable rows: never tried, or leased by a worker that did not finish in time
+CLAIMABLE = """
+SELECT id, recipient FROM send_queue
+WHERE job_id = ? AND (state = 'pending' OR (state = 'inflight' AND lease_until < ?))
+ORDER BY id LIMIT ?
+"""
+
+
+def get_db_connection():
+    """Get a pooled mailer.db connection; close() returns it to the pool"""
+    return mailer_db.raw_connection()
+
+
+class DurableSendQueue(object):
+    def __init__(self, lease_seconds=600, batch_size=500, ack_interval=0.2, renew_interval=None,
+                 max_hold=3600, ack_retries=5):
+        """
+        Per-message send state for campaign jobs, kept in mailer.db
+
+        Messages move pending -> inflight (leased) -> sent | failed. A leased
+        message whose worker died becomes claimable again once the lease
+        expires, so a restarted process picks up where the last one stopped.
+
+        Messages claimed by this process stay held until they are acked: a
+        background thread renews their leases every renew_interval while they
+        wait in a sender's queue or retry heap, and claim() never hands them
+        out a second time. A message held longer than max_hold (its worker
+        died, or its ack was lost) is let go: its lease runs out and it is
+        claimed again, so a job never waits on it forever.
+
+        :param lease_seconds: How long a claimed message stays reserved for its worker
+        :param batch_size: Rows per enqueue/claim/ack transaction
+        :param ack_interval: Maximum seconds a send result waits before it is written
+        :param renew_interval: Seconds between lease renewals, defaults to a third of lease_seconds
+        :param max_hold: Seconds after claim() that a message's lease stops being renewed
+        :param ack_retries: Attempts at writing a batch of acks before giving up on it
+        """
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.renew_interval = renew_interval or lease_seconds / 3.0
+        self.max_hold = max_hold
+        self.ack_retries = ack_retries
+        self.lock = threading.Lock()
+        self.table_ready = False
+        # job_id -> {recipient: claim time} of messages claimed here and not acked yet
+        self.held = {}
+        self.held_lock = threading.Lock()
+        self.renewer = None
+        self.renewals = 0
+        self.ack_writer = BatchWriter(self._write_acks, batch_size=batch_size,
+                                      flush_interval=ack_interval, name='send-queue-ack')
+
+    def _ensure_table(self):
+        if self.table_ready:
+            return
+        with self.lock:
+            if self.table_ready:
+                return
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(CREATE_QUEUE_TABLE)
+                for statement in CREATE_QUEUE_INDEXES:
+                    cursor.execute(statement)
+                conn.commit()
+            finally:
+                conn.close()
+            self.table_ready = True
+
+    def enqueue(self, job_id, recipients):
+        """
+        Add recipients to a job's queue, batch_size rows per transaction
+
+        Recipients already queued for the job are ignored.
+
+        :param job_id: Campaign job ID
+        :param recipients: Iterable of addresses
+        :return: Number of recipients read
+        """
+        self._ensure_table()
+        total = 0
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            batch = []
+            now = time.time()
+            for recipient in recipients:
+                batch.append((job_id, recipient, now))
+                if len(batch) >= self.batch_size:
+                    cursor.executemany('INSERT OR IGNORE INTO send_queue (job_id, recipient, updated_at) '
+                                       'VALUES (?, ?, ?)', batch)
+                    conn.commit()
+                    total += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany('INSERT OR IGNORE INTO send_queue (job_id, recipient, updated_at) '
+                                   'VALUES (?, ?, ?)', batch)
+                conn.commit()
+                total += len(batch)
+        finally:
+            conn.close()
+        return total
+
+    def claim(self, job_id, limit=None):
+        """
+        Lease up to limit claimable messages of a job
+
+        Expired leases on messages this process still holds are renewed
+        rather than claimed again. Send attempts are counted by ack(), not here.
+
+        :param job_id: Campaign job ID
+        :param limit: Maximum messages, defaults to batch_size
+        :return: List of recipient addresses
+        """
+        self._ensure_table()
+        now = time.time()
+        with self.held_lock:
+            held = set(self.held.get(job_id, ()))
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            # Take the write lock up front so concurrent claimers never lease the same rows
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(CLAIMABLE, (job_id, now, limit or self.batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.executemany(
+                    'UPDATE send_queue SET state = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                    [(INFLIGHT, now + self.lease_seconds, now, row[0]) for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        recipients = [row[1] for row in rows if row[1] not in held]
+        if recipients:
+            with self.held_lock:
+                self.held.setdefault(job_id, {}).update((recipient, now) for recipient in recipients)
+            self._start_renewer()
+        return recipients
+
+    def renew(self, job_id, recipients, seconds=None):
+        """
+        Extend the leases of inflight messages; a lease is never shortened
+
+        :param job_id: Campaign job ID
+        :param recipients: Iterable of addresses
+        :param seconds: Lease length from now, defaults to lease_seconds
+        :return: Number of messages renewed
+        """
+        lease_until = time.time() + (seconds or self.lease_seconds)
+        recipients = list(recipients)
+        renewed = 0
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            for start in range(0, len(recipients), self.batch_size):
+                cursor.executemany(
+                    "UPDATE send_queue SET lease_until = MAX(COALESCE(lease_until, 0), ?) "
+                    "WHERE job_id = ? AND recipient = ? AND state = 'inflight'",
+                    [(lease_until, job_id, recipient) for recipient in recipients[start:start + self.batch_size]])
+                renewed += cursor.rowcount
+                conn.commit()
+        finally:
+            conn.close()
+        return renewed
+
+    def _start_renewer(self):
+        with self.held_lock:
+            if self.renewer is not None:
+                return
+            self.renewer = threading.Thread(target=self._renew_held, name='send-queue-renew')
+            self.renewer.daemon = True
+            self.renewer.start()
+
+    def _renew_held(self):
+        while True:
+            time.sleep(self.renew_interval)
+            held = []
+            cutoff = time.time() - self.max_hold
+            with self.held_lock:
+                for job_id, claimed in self.held.items():
+                    expired = [recipient for recipient, claimed_at in claimed.items() if claimed_at < cutoff]
+                    for recipient in expired:
+                        del claimed[recipient]
+                    if expired:
+                        logging.warning('Job {}: {} messages held for over {}s without an ack, '
+                                        'letting their leases expire'.format(job_id, len(expired), self.max_hold))
+                    if claimed:
+                        held.append((job_id, list(claimed)))
+            for job_id, recipients in held:
+                try:
+                    self.renew(job_id, recipients)
+                    self.renewals += 1
+                except Exception as e:
+                    logging.error('Renewing leases of job {} failed: {}'.format(job_id, e))
+
+    def ack(self, job_id, recipient, state, error=None, attempts=0):
+        """
+        Record the outcome of a claimed message; written in batches in the background
+
+        :param job_id: Campaign job ID
+        :param recipient: Address the message was for
+        :param state: SENT, FAILED, or PENDING to give the message back unsent
+        :param error: Error message for FAILED
+        :param attempts: Send attempts made for the message since it was claimed
+        """
+        self.ack_writer.put({'job_id': job_id, 'recipient': recipient, 'state': state,
+                             'error': error, 'attempts': attempts, 'updated_at': time.time()})
+
+    def _write_acks(self, rows):
+        try:
+            for retry in range(self.ack_retries):
+                try:
+                    self._update_acks(rows)
+                    return
+                except Exception as e:
+                    if retry == self.ack_retries - 1:
+                        raise
+                    logging.warning('Writing {} send queue acks failed, retrying: {}'.format(len(rows), e))
+                    time.sleep(0.1 * 2 ** retry)
+        finally:
+            # Held until the ack is written, so an expired lease cannot be claimed in between;
+            # acks that could not be written are let go too, their leases expire
+            with self.held_lock:
+                for row in rows:
+                    self.held.get(row['job_id'], {}).pop(row['recipient'], None)
+
+    def _update_acks(self, rows):
+        conn = get_db_connection()
+        try:
+            conn.cursor().executemany(
+                'UPDATE send_queue SET state = ?, last_error = ?, attempts = attempts + ?, lease_until = NULL, '
+                'updated_at = ? WHERE job_id = ? AND recipient = ?',
+                [(row['state'], row['error'], row['attempts'], row['updated_at'], row['job_id'], row['recipient'])
+                 for row in rows])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def flush(self, timeout=30):
+        """
+        Block until every ack so far is written, at most timeout seconds
+
+        :return: True if the flush completed in time
+        """
+        return self.ack_writer.flush(timeout)
+
+    def release_held(self, job_id):
+        """
+        Return messages this process claimed for a job but never acked to pending
+
+        Called once the job's sender has stopped, for messages that were
+        claimed but not handed to it before an interruption.
+        """
+        with self.held_lock:
+            recipients = list(self.held.pop(job_id, ()))
+        if not recipients:
+            return
+        conn = get_db_connection()
+        try:
+            conn.cursor().executemany(
+                "UPDATE send_queue SET state = 'pending', lease_until = NULL "
+                "WHERE job_id = ? AND recipient = ? AND state = 'inflight'",
+                [(job_id, recipient) for recipient in recipients])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def release_job(self, job_id):
+        """
+        Return a job's leased messages to pending, for a job that is known not to be running
+        """
+        self._ensure_table()
+        conn = get_db_connection()
+        try:
+            conn.cursor().execute(
+                "UPDATE send_queue SET state = 'pending', lease_until = NULL WHERE job_id = ? AND state = 'inflight'",
+                (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def next_lease_expiry(self, job_id):
+        """
+        Earliest lease expiry among a job's inflight messages, or None if there are none
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT MIN(lease_until) FROM send_queue WHERE job_id = ? AND state = 'inflight'",
+                           (job_id,))
+            return cursor.fetchone()[0]
+        finally:
+            conn.close()
+
+    def counts(self, job_id):
+        """
+        Number of a job's messages in each state
+
+        :param job_id: Campaign job ID
+        :return: Dictionary of state -> count
+        """
+        self._ensure_table()
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT state, COUNT(*) FROM send_queue WHERE job_id = ? GROUP BY state', (job_id,))
+            counts = dict.fromkeys((PENDING, INFLIGHT, SENT, FAILED), 0)
+            counts.update(cursor.fetchall())
+            return counts
+        finally:
+            conn.close()
+
+    def iter_claims(self, job_id, stop=None):
+        """
+        Yield a job's recipients, claiming them batch by batch as the consumer needs them
+
+        Waits for messages leased by another worker, or still held by this
+        process, when nothing else is left, and ends once the job has no
+        pending or inflight messages. Messages held here stop being renewed
+        after max_hold, so the wait is bounded.
+
+        :param job_id: Campaign job ID
+        :param stop: Optional callable; iteration ends early when it returns True
+        """
+        while not (stop and stop()):
+            recipients = self.claim(job_id)
+            if recipients:
+                for recipient in recipients:
+                    yield recipient
+                continue
+            # Let this process' own acks land before deciding what is left
+            self.flush()
+            expiry = self.next_lease_expiry(job_id)
+            if expiry is None:
+                return
+            logging.info('Job {}: waiting for leased messages to be acknowledged or expire'.format(job_id))
+            time.sleep(min(max(expiry - time.time(), 0.2), 1))
+
+
+send_queue = DurableSendQueue()
+atexit.register(send_queue.ack_writer.stop)
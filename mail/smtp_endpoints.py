@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import smtplib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+ENDPOINTS_PATH = os.environ.get('SMTP_ENDPOINTS_FILE', os.path.join(BASE_DIR, 'smtp_endpoints.json'))
+
+# Connection modes
+STARTTLS = 'starttls'
+SSL = 'ssl'
+
+
+def endpoint_candidates(host, port):
+    """
+    (host, port, mode) combinations to probe for an SMTP host, configured one first
+
+    :param host: SMTP host name
+    :param port: Configured port; 465 means implicit SSL, anything else STARTTLS
+    :return: List of (host, port, mode) tuples
+    """
+    if port == 465:
+        return [(host, 465, SSL), (host, 587, STARTTLS)]
+    return [(host, port, STARTTLS), (host, 465, SSL)]
+
+
+def open_smtp(host, port, mode, timeout=30):
+    """
+    Open an encrypted, not yet authenticated SMTP session and say EHLO
+
+    :param host: SMTP host name
+    :param port: SMTP port
+    :param mode: STARTTLS or SSL
+    :param timeout: Socket timeout in seconds
+    :return: smtplib.SMTP or smtplib.SMTP_SSL object
+    """
+    if mode == SSL:
+        smtp = smtplib.SMTP_SSL(host, port, timeout=timeout)
+    else:
+        smtp = smtplib.SMTP(host, port, timeout=timeout)
+    try:
+        if mode == STARTTLS:
+            smtp.starttls()
+        # The capabilities advertised before STARTTLS do not count after it
+        smtp.ehlo()
+    except Exception:
+        smtp.close()
+        raise
+    return smtp
+
+
+def capabilities(smtp):
+    """
+    EHLO extensions the senders care about
+
+    :param smtp: smtplib session that has said EHLO
+    :return: Dictionary with pipelining, 8bitmime, smtputf8 flags and size (bytes, or None)
+    """
+    size = smtp.esmtp_features.get('size', '').strip()
+    return {
+        'pipelining': smtp.has_extn('pipelining'),
+        'size': int(size) if size.isdigit() and int(size) else None,
+        '8bitmime': smtp.has_extn('8bitmime'),
+        'smtputf8': smtp.has_extn('smtputf8')
+    }
+
+
+def probe(host, port, mode, timeout=10):
+    """
+    Connect to one candidate endpoint and record what it supports
+
+    :return: Endpoint dictionary (host, port, mode, capabilities, resolved_at)
+    """
+    smtp = open_smtp(host, port, mode, timeout=timeout)
+    try:
+        return {
+            'host': host,
+            'port': port,
+            'mode': mode,
+            'capabilities': capabilities(smtp),
+            'resolved_at': time.time()
+        }
+    finally:
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+
+class EndpointCache(object):
+    def __init__(self, path=ENDPOINTS_PATH, ttl=7 * 24 * 3600, probe_timeout=10):
+        """
+        Resolved SMTP endpoints per mail domain, persisted to a JSON file
+
+        The first lookup for a domain probes STARTTLS and implicit SSL at the
+        same time and keeps whichever answers first; later connections for
+        any account of that domain go straight to it until the entry is ttl
+        seconds old or the endpoint stops answering.
+
+        :param path: JSON file the cache is kept in
+        :param ttl: Seconds an endpoint is trusted before it is probed again
+        :param probe_timeout: Connect timeout for each probe
+        """
+        self.path = path
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.entries = None
+        self.resolving = {}
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        try:
+            with open(self.path, 'r') as file:
+                self.entries = json.load(file)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Could not save SMTP endpoint cache {}: {}'.format(self.path, e))
+
+    def get(self, domain):
+        """
+        Cached endpoint for a domain, or None if unknown or expired
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(domain)
+            if entry and time.time() - entry.get('resolved_at', 0) < self.ttl:
+                return entry
+            return None
+
+    def put(self, domain, endpoint):
+        with self.lock:
+            self._load()
+            self.entries[domain] = endpoint
+            self._save()
+
+    def invalidate(self, domain, stale=None):
+        """
+        Forget a domain's endpoint so the next resolve() probes again
+
+        :param domain: Mail domain
+        :param stale: Endpoint that failed; if given, a newer cached endpoint
+                      (already re-probed by another caller) is kept
+        """
+        with self.lock:
+            self._load()
+            entry = self.entries.get(domain)
+            if entry is None or (stale is not None and entry.get('resolved_at') != stale.get('resolved_at')):
+                return
+            del self.entries[domain]
+            self._save()
+
+    def discover(self, host, port):
+        """
+        Probe the candidate endpoints of a host in parallel; the first to answer wins
+
+        :return: Endpoint dictionary
+        """
+        candidates = endpoint_candidates(host, port)
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        try:
+            futures = [executor.submit(probe, h, p, mode, self.probe_timeout) for h, p, mode in candidates]
+            error = None
+            for future in as_completed(futures):
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+            raise error
+        finally:
+            # Do not wait for the slower probe; it closes its own connection
+            executor.shutdown(wait=False)
+
+    def resolve(self, domain, host, port):
+        """
+        Endpoint to use for a domain, probing once if it is not cached
+
+        Concurrent callers for the same domain share one probe.
+
+        :param domain: Mail domain of the sender account
+        :param host: Configured SMTP host
+        :param port: Configured SMTP port
+        :return: Endpoint dictionary
+        """
+        endpoint = self.get(domain)
+        if endpoint is not None:
+            return endpoint
+        with self.lock:
+            domain_lock = self.resolving.setdefault(domain, threading.Lock())
+        with domain_lock:
+            endpoint = self.get(domain)
+            if endpoint is None:
+                endpoint = self.discover(host, port)
+                logging.info('Resolved SMTP endpoint for {}: {}:{} ({}) {}'.format(
+                    domain, endpoint['host'], endpoint['port'], endpoint['mode'], endpoint['capabilities']))
+                self.put(domain, endpoint)
+            return endpoint
+
+
+smtp_endpoints = EndpointCache(ttl=int(os.environ.get('SMTP_ENDPOINT_TTL', 7 * 24 * 3600)))
@@ -0,0 +1,239 @@
+import smtplib
+import threading
+import time
+import logging
+
+
+class PooledConnection(object):
+    def __init__(self, key, smtp):
+        """
+        Authenticated SMTP session handed out by SMTPConnectionPool
+
+        :param key: Pool key (host, port, username)
+        :param smtp: Connected and logged in smtplib.SMTP object
+        """
+        self.key = key
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.time()
+        self.closed = False
+
+
+class SMTPConnectionPool(object):
+    def __init__(self, max_messages_per_connection=100, noop_interval=30, max_idle_per_key=10):
+        """
+        Pool of authenticated SMTP sessions keyed by (host, port, username)
+
+        Sessions are checked out for one transaction at a time and counted
+        from connect until they are closed, so acquire() can cap how many
+        are open per key.
+
+        :param max_messages_per_connection: Retire a session after this many messages
+        :param noop_interval: Send NOOP before reusing a session idle for this many seconds
+        :param max_idle_per_key: Maximum idle sessions kept per key
+        """
+        self.max_messages_per_connection = max_messages_per_connection
+        self.noop_interval = noop_interval
+        self.max_idle_per_key = max_idle_per_key
+        self.lock = threading.Lock()
+        # Notified whenever a session is returned or closed
+        self.available = threading.Condition(self.lock)
+        self.idle = {}
+        self.open = {}
+        self.waits = 0
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.retired = 0
+
+    def acquire(self, key, connect, max_open=None):
+        """
+        Check out a usable session for key, reusing an idle one when possible
+
+        Blocks while max_open sessions for key are open and none is idle.
+        Hand the session back with release() after the transaction.
+
+        :param key: Pool key (host, port, username)
+        :param connect: Callable returning a new authenticated smtplib.SMTP
+        :param max_open: Maximum sessions open at once for key, unlimited if None
+        :return: PooledConnection
+        """
+        while True:
+            with self.available:
+                while True:
+                    idle = self.idle.get(key)
+                    if idle:
+                        conn = idle.pop()
+                        break
+                    if max_open is None or self.open.get(key, 0) < max_open:
+                        conn = None
+                        self.open[key] = self.open.get(key, 0) + 1
+                        self.misses += 1
+                        break
+                    self.waits += 1
+                    self.available.wait()
+            if conn is None:
+                break
+            if self.prepare(conn):
+                with self.lock:
+                    self.hits += 1
+                return conn
+            self.discard(conn)
+
+        try:
+            return PooledConnection(key, connect())
+        except Exception:
+            self._closed(key)
+            raise
+
+    def _closed(self, key):
+        with self.available:
+            self.open[key] -= 1
+            self.available.notify()
+
+    def prepare(self, conn):
+        """
+        Reset a session between transactions
+
+        Sends RSET after a previous transaction and NOOP if the session
+        has been idle longer than noop_interval.
+
+        :param conn: PooledConnection
+        :return: True if the session is usable, False if it must be replaced
+        """
+        try:
+            if conn.messages_sent:
+                code = conn.smtp.rset()[0]
+                if code != 250:
+                    return False
+            if time.time() - conn.last_used > self.noop_interval:
+                return self.is_alive(conn)
+            return True
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def is_alive(self, conn):
+        """
+        Check a session with NOOP
+
+        :param conn: PooledConnection
+        :return: True if the server answered 250
+        """
+        try:
+            return conn.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def mark_sent(self, conn):
+        """
+        Record a completed transaction on a session
+
+        :param conn: PooledConnection
+        :return: True if the session reached max_messages_per_connection
+        """
+        conn.messages_sent += 1
+        conn.last_used = time.time()
+        return conn.messages_sent >= self.max_messages_per_connection
+
+    def reconnect(self, conn, connect):
+        """
+        Replace a broken session with a fresh one for the same key
+
+        The new session takes over the old one's place in the open count.
+
+        :param conn: Checked out PooledConnection that failed
+        :param connect: Callable returning a new authenticated smtplib.SMTP
+        :return: The same PooledConnection, connected again
+        """
+        try:
+            conn.smtp.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.reconnects += 1
+        try:
+            conn.smtp = connect()
+        except Exception:
+            self.discard(conn)
+            raise
+        conn.messages_sent = 0
+        conn.last_used = time.time()
+        return conn
+
+    def release(self, conn):
+        """
+        Return a session to the pool, retiring it if it is used up
+
+        :param conn: PooledConnection
+        """
+        if conn.closed:
+            return
+        if conn.messages_sent >= self.max_messages_per_connection:
+            self.retire(conn)
+            return
+        with self.available:
+            idle = self.idle.setdefault(conn.key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append(conn)
+                self.available.notify()
+                return
+        self.retire(conn)
+
+    def retire(self, conn):
+        """
+        Close a session cleanly with QUIT
+
+        :param conn: PooledConnection
+        """
+        if conn.closed:
+            return
+        conn.closed = True
+        with self.lock:
+            self.retired += 1
+        try:
+            conn.smtp.quit()
+        except Exception as e:
+            logging.error(f'Error closing SMTP connection: {str(e)}')
+        self._closed(conn.key)
+
+    def discard(self, conn):
+        """
+        Drop a broken session without waiting for QUIT
+
+        :param conn: PooledConnection
+        """
+        if conn.closed:
+            return
+        conn.closed = True
+        try:
+            conn.smtp.close()
+        except Exception:
+            pass
+        self._closed(conn.key)
+
+    def close_all(self):
+        """
+        Close every idle session in the pool
+        """
+        with self.lock:
+            conns = [conn for idle in self.idle.values() for conn in idle]
+            self.idle = {}
+        for conn in conns:
+            self.retire(conn)
+
+    def stats(self):
+        """
+        Pool hit/miss counters
+
+        :return: Dictionary of counters
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reconnects': self.reconnects,
+                'retired': self.retired,
+                'idle': sum(len(idle) for idle in self.idle.values()),
+                'open': sum(self.open.values()),
+                'waits': self.waits
+            }
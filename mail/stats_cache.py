@@ -0,0 +1,187 @@
+import os
+import time
+import logging
+import threading
+
+try:
+    from cachelib import SimpleCache, RedisCache
+except ImportError:
+    SimpleCache = RedisCache = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+REDIS_URL = os.environ.get('STATS_CACHE_REDIS_URL', os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+
+# Invalidation scopes: every pixel_tracks write bumps TRACKING and the
+# sender's scope, user changes bump USERS
+TRACKING = 'tracking'
+USERS = 'users'
+
+
+def sender_scope(sender_email):
+    """
+    Scope bumped by writes for one sender account (a user's stats)
+    """
+    return 'sender:{}'.format(sender_email or '')
+
+
+def make_backend(redis_url=REDIS_URL, threshold=5000):
+    """
+    Redis when it answers (shared by every worker process), else an in-process SimpleCache
+
+    :return: cachelib cache, or None if cachelib is not installed
+    """
+    if SimpleCache is None:
+        logging.warning('cachelib is not installed, stats are not cached')
+        return None
+    if redis is None:
+        logging.warning('redis is not installed, stats are cached per process and other '
+                        'processes\' writes show up only after the TTL')
+    elif redis_url:
+        try:
+            client = redis.from_url(redis_url, socket_connect_timeout=1, socket_timeout=1)
+            client.ping()
+            logging.info('Stats cache using Redis at {}'.format(redis_url))
+            return RedisCache(host=client, key_prefix='stats:')
+        except Exception as e:
+            logging.warning('Redis unavailable for the stats cache ({}), stats are cached per process '
+                            'and other processes\' writes show up only after the TTL'.format(e))
+    return SimpleCache(threshold=threshold)
+
+
+class StatsCache(object):
+    def __init__(self, backend=None, ttl=30, stale_ttl=3600, lock_timeout=30, wait_interval=0.05):
+        """
+        Read-through cache for aggregate stats with write-driven invalidation
+
+        Each entry is stored under its key plus the current generation of
+        every scope it depends on. Write paths bump the generations, so the
+        next read misses without anyone having to know which keys exist;
+        ttl bounds staleness for writes made by processes that do not share
+        the backend. On a miss one caller (whoever wins the add() lock)
+        recomputes while the others get the previous value, or wait for the
+        new one if there is none yet.
+
+        :param backend: cachelib cache, created by make_backend() on first use if None
+        :param ttl: Seconds a computed value is served
+        :param stale_ttl: Seconds the previous value is kept for callers waiting on a recompute
+        :param lock_timeout: Seconds a recompute lock is held at most
+        :param wait_interval: Poll interval while waiting for another caller's recompute
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lock_timeout = lock_timeout
+        self.wait_interval = wait_interval
+        self.lock = threading.Lock()
+        self.ready = backend is not None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _backend(self):
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    self.backend = make_backend()
+                    self.ready = True
+        return self.backend
+
+    def _call(self, method, *args, **kwargs):
+        # A cache outage must never fail the request; treat it as a miss
+        try:
+            return getattr(self.backend, method)(*args, **kwargs)
+        except Exception as e:
+            self.errors += 1
+            logging.warning('Stats cache {} failed: {}'.format(method, e))
+            return None
+
+    def generations(self, scopes):
+        """
+        Current generation of each scope, starting unseen scopes at a time-based value
+
+        Starting from the clock rather than 0 means a scope that was evicted
+        or lost with a Redis restart cannot come back to a generation that
+        older entries were stored under.
+        """
+        keys = ['gen:{}'.format(scope) for scope in scopes]
+        values = self._call('get_many', *keys) or [None] * len(keys)
+        generations = []
+        for key, value in zip(keys, values):
+            if value is None:
+                self._call('add', key, int(time.time() * 1000), timeout=0)
+                value = self._call('get', key)
+            generations.append(value)
+        return generations
+
+    def bump(self, scopes):
+        """
+        Invalidate every entry depending on any of the scopes; called after a write commits
+
+        :param scopes: Iterable of scope names
+        """
+        if self._backend() is None:
+            return
+        for scope in set(scopes):
+            self._call('inc', 'gen:{}'.format(scope))
+
+    def get_or_compute(self, key, scopes, compute, ttl=None):
+        """
+        Cached value for key, recomputed by one caller when a scope changed or it expired
+
+        :param key: Cache key, unique per function and arguments
+        :param scopes: Scopes the value depends on
+        :param compute: Callable returning the value (not None); its exceptions propagate
+        :param ttl: Seconds to serve the value, defaults to the cache's ttl
+        :return: The value
+        """
+        if self._backend() is None:
+            return compute()
+        entry_key = '{}@{}'.format(key, ':'.join(str(g) for g in self.generations(scopes)))
+        value = self._call('get', entry_key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        lock_key = 'lock:' + entry_key
+        deadline = time.time() + self.lock_timeout
+        while True:
+            if self._call('add', lock_key, 1, timeout=self.lock_timeout) is not False:
+                self.misses += 1
+                try:
+                    value = compute()
+                    self._call('set', entry_key, value, timeout=ttl or self.ttl)
+                    self._call('set', 'last:' + key, value, timeout=self.stale_ttl)
+                finally:
+                    self._call('delete', lock_key)
+                return value
+
+            # Someone else is recomputing this entry
+            value = self._call('get', 'last:' + key)
+            if value is not None:
+                self.stale_hits += 1
+                return value
+            time.sleep(self.wait_interval)
+            value = self._call('get', entry_key)
+            if value is not None:
+                self.hits += 1
+                return value
+            if time.time() > deadline:
+                self.misses += 1
+                return compute()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'errors': self.errors
+        }
+
+
+stats_cache = StatsCache(ttl=int(os.environ.get('STATS_CACHE_TTL', 30)))
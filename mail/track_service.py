@@ -0,0 +1,130 @@
+"""
+Minimal tracking pixel service
+
+Plain WSGI (app) and ASGI (asgi_app) callables with no Flask, sessions,
+templates or import-time schema work. Handles signed tokens and both
+legacy URL shapes:
+
+    /t/<token>
+    /track?campaign_id=<campaign>&sender=<sender>&recipient=<recipient>
+    /track/<campaign>/<recipient>?sender=<sender>
+
+Run as many worker processes behind one listener, e.g.:
+
+    gunicorn -w 8 -b 0.0.0.0:8080 track_service:app
+    uvicorn --workers 8 --host 0.0.0.0 --port 8080 track_service:asgi_app
+
+Each worker buffers open events and upserts them in the background
+(see tracking_store.OpenEventBuffer); the database engine is created
+lazily in each worker after fork.
+"""
+from urllib.parse import parse_qs
+
+from pixel import PIXEL_BODY, PIXEL_HEADERS
+from tracking_store import open_row, open_buffer, message_open_row, get_device_info
+from tracking_token import decode_token
+
+NOT_FOUND_HEADERS = [('Content-Type', 'text/plain'), ('Content-Length', '9')]
+ASGI_PIXEL_HEADERS = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                      for name, value in PIXEL_HEADERS]
+ASGI_NOT_FOUND_HEADERS = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                          for name, value in NOT_FOUND_HEADERS]
+
+
+def parse_track_request(path, query_string):
+    """
+    Extract tracking parameters from either URL shape
+
+    :param path: Decoded request path
+    :param query_string: Raw query string
+    :return: Message ID for token URLs, tuple of (campaign_id, sender, recipient) for
+             legacy URLs, or None if the path is not a tracking URL
+    """
+    if path.startswith('/t/'):
+        # Unverifiable tokens resolve to 0, which is never allocated
+        return decode_token(path[len('/t/'):]) or 0
+    if path == '/track':
+        params = parse_qs(query_string)
+        campaign_id = params.get('campaign_id', [None])[0]
+        recipient = params.get('recipient', [None])[0]
+    elif path.startswith('/track/'):
+        parts = path[len('/track/'):].split('/')
+        if len(parts) != 2:
+            return None
+        campaign_id, recipient = parts
+        params = parse_qs(query_string)
+    else:
+        return None
+    return campaign_id, params.get('sender', [None])[0], recipient
+
+
+def record_hit(params, user_agent, ip_address):
+    """
+    Queue an open event if the token verified or all tracking parameters are present
+    """
+    if isinstance(params, int):
+        if params:
+            open_buffer.put(message_open_row(
+                params,
+                user_agent=user_agent,
+                ip_address=ip_address,
+                device_info=get_device_info(user_agent)
+            ))
+        return
+    campaign_id, sender, recipient = params
+    if campaign_id and sender and recipient:
+        open_buffer.put(open_row(
+            campaign_id,
+            sender,
+            recipient,
+            user_agent=user_agent,
+            ip_address=ip_address,
+            device_info=get_device_info(user_agent)
+        ))
+
+
+def app(environ, start_response):
+    """
+    WSGI entry point
+    """
+    # WSGI hands the path over as latin-1 decoded bytes
+    path = environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace')
+    params = parse_track_request(path, environ.get('QUERY_STRING', ''))
+    if params is None:
+        start_response('404 Not Found', list(NOT_FOUND_HEADERS))
+        return [b'Not Found']
+
+    record_hit(params, environ.get('HTTP_USER_AGENT', 'unknown'), environ.get('REMOTE_ADDR'))
+    start_response('200 OK', list(PIXEL_HEADERS))
+    return PIXEL_BODY
+
+
+async def asgi_app(scope, receive, send):
+    """
+    ASGI entry point
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                open_buffer.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    params = parse_track_request(scope['path'], scope.get('query_string', b'').decode('latin-1'))
+    if params is None:
+        await send({'type': 'http.response.start', 'status': 404, 'headers': ASGI_NOT_FOUND_HEADERS})
+        await send({'type': 'http.response.body', 'body': b'Not Found'})
+        return
+
+    user_agent = 'unknown'
+    for name, value in scope.get('headers', ()):
+        if name == b'user-agent':
+            user_agent = value.decode('latin-1')
+            break
+    client = scope.get('client')
+    record_hit(params, user_agent, client[0] if client else None)
+    await send({'type': 'http.response.start', 'status': 200, 'headers': ASGI_PIXEL_HEADERS})
+    await send({'type': 'http.response.body', 'body': PIXEL_BODY[0]})
@@ -0,0 +1,461 @@
+import atexit
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BatchWriter(object):
+    def __init__(self, write_rows, batch_size=500, flush_interval=0.2, name='batch-writer'):
+        """
+        Background thread that collects rows from many producers and writes them in batches
+
+        :param write_rows: Callable taking a list of row dicts and writing them in one transaction
+        :param batch_size: Flush once this many rows are pending
+        :param flush_interval: Flush at least this often (seconds) while rows are pending
+        :param name: Thread name, also used in log messages
+        """
+        self.write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def _ensure_started(self):
+        # Started lazily so forked server workers each get their own thread
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run, name=self.name)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def put(self, row):
+        """
+        Queue a row for the next batch
+
+        :param row: Dictionary of column values
+        """
+        self._ensure_started()
+        self.queue.put(row)
+
+    def flush(self, timeout=30):
+        """
+        Block until every row queued so far has been written
+
+        A writer thread that has exited (after stop(), or in a forked child)
+        is started again first, so rows queued since are written and the
+        wait cannot outlive the thread.
+
+        :param timeout: Maximum seconds to wait, None to wait indefinitely
+        :return: True if the flush completed in time
+        """
+        if self.thread is None:
+            return True
+        self._ensure_started()
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10):
+        """
+        Flush pending rows and stop the writer thread
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        waiters = []
+        deadline = None
+        stopping = False
+        while not stopping:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+            except queue.Empty:
+                pass
+
+            if stopping or waiters or len(batch) >= self.batch_size or \
+                    (deadline is not None and time.time() >= deadline):
+                if batch:
+                    self._write(batch)
+                    batch = []
+                deadline = None
+                for waiter in waiters:
+                    waiter.set()
+                waiters = []
+
+    def _write(self, batch):
+        started = time.time()
+        try:
+            self.write_rows(batch)
+        except Exception as e:
+            logging.error('{}: failed to write {} rows: {}'.format(self.name, len(batch), e))
+            with self.lock:
+                self.errors += 1
+                self.rows_dropped += len(batch)
+            return
+        elapsed_ms = (time.time() - started) * 1000
+        with self.lock:
+            self.rows_written += len(batch)
+            self.flushes += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+
+    def stats(self):
+        """
+        Queue depth and flush latency counters
+
+        :return: Dictionary of counters
+        """
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'rows_written': self.rows_written,
+                'rows_dropped': self.rows_dropped,
+                'flushes': self.flushes,
+                'errors': self.errors,
+                'last_flush_ms': round(self.last_flush_ms, 2),
+                'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+                'max_flush_ms': round(self.max_flush_ms, 2)
+            }
+
+
+def write_sent_rows(rows):
+    """
+    Insert a batch of "sent" pixel_tracks rows in a single transaction
+
+    A row that already exists for the same message (re-send, or an open
+    recorded first) is marked as sent instead.
+
+    :param rows: List of row dicts
+    """
+    from sqlalchemy.dialects.sqlite import insert
+    from models import PixelTrack
+    from db import tracking_db
+    from stats_cache import stats_cache, TRACKING, sender_scope
+
+    stmt = insert(PixelTrack.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['campaign_id', 'sender_email', 'recipient'],
+        set_={
+            'is_sent': stmt.excluded.is_sent,
+            'sent_timestamp': stmt.excluded.sent_timestamp,
+            'message_id': stmt.excluded.message_id
+        }
+    )
+    with tracking_db.engine.begin() as conn:
+        conn.execute(stmt, rows)
+    stats_cache.bump([TRACKING] + [sender_scope(row.get('sender_email')) for row in rows])
+
+
+class OpenEventBuffer(object):
+    def __init__(self, write_rows, capacity=10000, overflow='drop_oldest', batch_size=500,
+                 flush_interval=0.5, block_timeout=1.0, name='open-buffer'):
+        """
+        Bounded write-behind buffer for open events
+
+        Events are coalesced per (campaign_id, sender_email, recipient), keeping
+        the first open, and upserted in batches by a background thread so the
+        pixel response never waits for SQLite.
+
+        :param write_rows: Callable taking a list of row dicts and writing them in one transaction
+        :param capacity: Maximum number of distinct pending events
+        :param overflow: 'drop_oldest' to evict the oldest pending event when full,
+                         'block' to wait up to block_timeout for room (then drop the new event)
+        :param batch_size: Maximum rows per write
+        :param flush_interval: Seconds between flushes
+        :param block_timeout: Seconds a producer waits for room in 'block' mode
+        :param name: Thread name, also used in log messages
+        """
+        if overflow not in ('drop_oldest', 'block'):
+            raise ValueError("overflow must be 'drop_oldest' or 'block'")
+        self.write_rows = write_rows
+        self.capacity = capacity
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.name = name
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.stopping = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+
+    def _ensure_started(self):
+        # Started lazily so forked server workers each get their own thread
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.stopping = False
+                    self.thread = threading.Thread(target=self._run, name=self.name)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def put(self, row):
+        """
+        Queue an open event without touching the database
+
+        :param row: Row dict from open_row
+        :return: False if the event was dropped because the buffer was full
+        """
+        self._ensure_started()
+        key = open_key(row)
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+                return True
+            if len(self.pending) >= self.capacity:
+                if self.overflow == 'drop_oldest':
+                    self.pending.popitem(last=False)
+                    self.dropped += 1
+                elif not self.not_full.wait_for(lambda: len(self.pending) < self.capacity,
+                                                self.block_timeout):
+                    self.dropped += 1
+                    return False
+            self.pending[key] = row
+            self.enqueued += 1
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.notify()
+        return True
+
+    def flush(self):
+        """
+        Write every pending event now, from the calling thread
+        """
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                batch = []
+                while self.pending and len(batch) < self.batch_size:
+                    batch.append(self.pending.popitem(last=False)[1])
+                self.not_full.notify_all()
+            self._write(batch)
+
+    def stop(self, timeout=10):
+        """
+        Stop the flusher thread and write pending events
+        """
+        if self.thread is not None and self.thread.is_alive():
+            with self.lock:
+                self.stopping = True
+                self.wakeup.notify()
+            self.thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.stopping and len(self.pending) < self.batch_size:
+                    self.wakeup.wait(self.flush_interval)
+                if self.stopping:
+                    return
+            self.flush()
+
+    def _write(self, batch):
+        started = time.time()
+        try:
+            self.write_rows(batch)
+        except Exception as e:
+            logging.error('{}: failed to write {} open events: {}'.format(self.name, len(batch), e))
+            with self.lock:
+                self.errors += 1
+                self.dropped += len(batch)
+            return
+        with self.lock:
+            self.flushed += len(batch)
+            self.flushes += 1
+            self.last_flush_ms = (time.time() - started) * 1000
+
+    def stats(self):
+        """
+        Buffer depth and dropped/flushed event counters
+
+        :return: Dictionary of counters
+        """
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'flushed': self.flushed,
+                'flushes': self.flushes,
+                'errors': self.errors,
+                'last_flush_ms': round(self.last_flush_ms, 2)
+            }
+
+
+def get_device_info(user_agent):
+    """
+    Extract basic device information from user agent
+    """
+    user_agent = user_agent.lower()
+    if 'mobile' in user_agent:
+        return 'Mobile'
+    elif 'tablet' in user_agent:
+        return 'Tablet'
+    elif 'windows' in user_agent or 'macintosh' in user_agent or 'linux' in user_agent:
+        return 'Desktop'
+    return 'Unknown'
+
+
+def open_row(campaign_id, sender_email, recipient, user_agent=None, ip_address=None, device_info=None):
+    """
+    Build a pixel_tracks row for an open event
+
+    :return: Row dict for write_open_rows
+    """
+    now = datetime.datetime.utcnow()
+    return {
+        'id': str(uuid.uuid4()),
+        'campaign_id': campaign_id,
+        'sender_email': sender_email,
+        'recipient': recipient,
+        'timestamp': now,
+        'user_agent': user_agent,
+        'ip_address': ip_address,
+        'device_info': device_info,
+        'is_opened': True,
+        'opened_timestamp': now
+    }
+
+
+def message_open_row(message_id, user_agent=None, ip_address=None, device_info=None):
+    """
+    Build an open event for a verified tracking token
+
+    :return: Row dict for write_open_rows
+    """
+    now = datetime.datetime.utcnow()
+    return {
+        'message_id': message_id,
+        'user_agent': user_agent,
+        'ip_address': ip_address,
+        'device_info': device_info,
+        'opened_timestamp': now
+    }
+
+
+def open_key(row):
+    """
+    Key identifying the message an open event belongs to
+    """
+    if 'message_id' in row:
+        return row['message_id']
+    return (row['campaign_id'], row['sender_email'], row['recipient'])
+
+
+def write_open_rows(rows):
+    """
+    Record open events with one atomic upsert per row
+
+    Inserts a new opened row, or marks the existing row for the same
+    (campaign_id, sender_email, recipient) as opened. Rows that are already
+    opened keep their first open, so concurrent hits for one recipient
+    cannot overwrite each other.
+
+    Token opens (from message_open_row) update their row by message_id
+    instead, with no string matching.
+
+    :param rows: List of row dicts from open_row or message_open_row
+    """
+    # Imported here so the pixel service loads SQLAlchemy on the flusher
+    # thread instead of at import time
+    import sqlalchemy as sa
+    from sqlalchemy.dialects.sqlite import insert
+    from models import PixelTrack
+    from db import tracking_db
+    from stats_cache import stats_cache, TRACKING, sender_scope
+
+    table = PixelTrack.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['campaign_id', 'sender_email', 'recipient'],
+        set_={
+            'is_opened': True,
+            'opened_timestamp': stmt.excluded.opened_timestamp,
+            'user_agent': stmt.excluded.user_agent,
+            'ip_address': stmt.excluded.ip_address,
+            'device_info': sa.func.coalesce(stmt.excluded.device_info, table.c.device_info)
+        },
+        where=sa.func.coalesce(table.c.is_opened, False) == False  # noqa: E712
+    )
+    keyed_rows = [row for row in rows if 'message_id' not in row]
+    token_rows = [row for row in rows if 'message_id' in row]
+    senders = set(row['sender_email'] for row in keyed_rows)
+    with tracking_db.engine.begin() as conn:
+        if keyed_rows:
+            conn.execute(stmt, keyed_rows)
+        if token_rows:
+            conn.execute(
+                table.update()
+                .where(table.c.message_id == sa.bindparam('b_message_id'))
+                .where(sa.func.coalesce(table.c.is_opened, False) == False)  # noqa: E712
+                .values(
+                    is_opened=True,
+                    opened_timestamp=sa.bindparam('b_opened_timestamp'),
+                    user_agent=sa.bindparam('b_user_agent'),
+                    ip_address=sa.bindparam('b_ip_address'),
+                    device_info=sa.bindparam('b_device_info')
+                ),
+                [dict(('b_' + name, value) for name, value in row.items()) for row in token_rows]
+            )
+            # Token opens only carry the message id; look up whose stats they change
+            senders.update(conn.execute(
+                sa.select(table.c.sender_email).distinct()
+                .where(table.c.message_id.in_([row['message_id'] for row in token_rows]))
+            ).scalars())
+    stats_cache.bump([TRACKING] + [sender_scope(sender) for sender in senders])
+
+
+# Shared by every EmailSender in the process
+sent_writer = BatchWriter(write_sent_rows, name='sent-writer')
+atexit.register(sent_writer.stop)
+
+# Shared by the pixel handlers in the process
+open_buffer = OpenEventBuffer(
+    write_open_rows,
+    capacity=int(os.environ.get('OPEN_BUFFER_SIZE', 10000)),
+    overflow=os.environ.get('OPEN_BUFFER_OVERFLOW', 'drop_oldest')
+)
+atexit.register(open_buffer.stop)
@@ -0,0 +1,129 @@
+"""
+Signed compact tracking tokens
+
+A token is base64url(message_id bytes + truncated HMAC-SHA256), about
+16 characters, so a pixel hit can be verified with one hash and
+resolved to a single pixel_tracks row by message_id.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+SECRET_PATH = os.path.join(BASE_DIR, 'tracking_secret.key')
+
+MAC_SIZE = 8
+MAX_TOKEN_LENGTH = 32
+
+_secret = None
+_secret_lock = threading.Lock()
+
+
+def get_secret():
+    """
+    HMAC key shared by the senders and every tracking process
+
+    Taken from TRACKING_SECRET, or generated once and kept in
+    tracking_secret.key next to the databases.
+    """
+    global _secret
+    if _secret is None:
+        with _secret_lock:
+            if _secret is None:
+                secret = os.environ.get('TRACKING_SECRET')
+                if secret:
+                    _secret = secret.encode('utf-8')
+                else:
+                    try:
+                        fd = os.open(SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, 'wb') as f:
+                            f.write(binascii.hexlify(os.urandom(32)))
+                    except FileExistsError:
+                        pass
+                    with open(SECRET_PATH, 'rb') as f:
+                        _secret = f.read().strip()
+    return _secret
+
+
+def _mac(payload):
+    return hmac.new(get_secret(), payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def encode_token(message_id):
+    """
+    :param message_id: Positive integer message ID
+    :return: URL-safe token string
+    """
+    payload = message_id.to_bytes((message_id.bit_length() + 7) // 8 or 1, 'big')
+    return base64.urlsafe_b64encode(payload + _mac(payload)).rstrip(b'=').decode('ascii')
+
+
+def decode_token(token):
+    """
+    Verify a token and extract its message ID
+
+    :param token: Token string from a pixel URL
+    :return: Message ID, or None for forged or malformed tokens
+    """
+    if not token or len(token) > MAX_TOKEN_LENGTH:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) <= MAC_SIZE:
+        return None
+    payload, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+    if not hmac.compare_digest(mac, _mac(payload)):
+        return None
+    return int.from_bytes(payload, 'big')
+
+
+class MessageIdAllocator(object):
+    def __init__(self, name='message_id', block_size=1000):
+        """
+        Hands out unique message IDs, reserving them from tracking.db in blocks
+
+        :param name: Row name in id_sequences
+        :param block_size: IDs reserved per database round trip
+        """
+        self.name = name
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.limit = 0
+
+    def _reserve_block(self):
+        import sqlalchemy as sa
+        from models import IdSequence
+        from db import tracking_db
+
+        table = IdSequence.__table__
+        with tracking_db.engine.begin() as conn:
+            updated = conn.execute(
+                table.update()
+                .where(table.c.name == self.name)
+                .values(next_value=table.c.next_value + self.block_size)
+            ).rowcount
+            if not updated:
+                conn.execute(table.insert().values(name=self.name, next_value=1 + self.block_size))
+            end = conn.execute(sa.select(table.c.next_value).where(table.c.name == self.name)).scalar()
+        self.next_id = end - self.block_size
+        self.limit = end
+
+    def next(self):
+        """
+        :return: New unique message ID
+        """
+        with self.lock:
+            if self.next_id >= self.limit:
+                self._reserve_block()
+            message_id = self.next_id
+            self.next_id += 1
+            return message_id
+
+
+message_ids = MessageIdAllocator()